@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Measure the cost of creating FSM instances, using the SIP transactions,
+which are the FSMs that a busy server creates most of.
+"""
+import argparse
+import gc
+import logging
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from sipparty.fsm import RetryThread
+from sipparty.sip.transaction.client import (
+    InviteClientTransaction, NonInviteClientTransaction)
+from sipparty.sip.transaction.server import (
+    InviteServerTransaction, NonInviteServerTransaction)
+
+TransactionClasses = (
+    InviteServerTransaction, NonInviteServerTransaction,
+    InviteClientTransaction, NonInviteClientTransaction)
+
+
+def main():
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-n', '--number', type=int, default=2000,
+        help='How many instances of each class to create.')
+    args = ap.parse_args()
+    number = args.number
+
+    logging.disable(logging.CRITICAL)
+
+    # A server keeps the retry thread running, so don't time starting it.
+    retry_thread = RetryThread()  # noqa
+
+    for tclass in TransactionClasses:
+        # Create one first so that any lazy class setup isn't timed.
+        tclass()
+        construct_s = timeit.timeit(tclass, number=number)
+
+        if tracemalloc is None:
+            size = 'unknown'
+        else:
+            gc.collect()
+            tracemalloc.start()
+            instances = [tclass() for _ in range(number)]
+            size = '%d' % (tracemalloc.get_traced_memory()[0] / number)
+            tracemalloc.stop()
+            assert len(instances) == number
+
+        print('%s: %.1f us to construct, %s bytes each' % (
+            tclass.__name__, construct_s / number * 1e6, size))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
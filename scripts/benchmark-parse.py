@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""Measure how many SIP messages per second can be parsed, comparing the
+single pass message scanner with the old parser which split the whole message
+up with a regular expression and added the headers one at a time.
+
+Then measure how long each type of header takes to parse, comparing the
+compiled parseinfo plans with interpreting the parseinfo on every parse.
+"""
+import argparse
+import logging
+import re
+import sys
+import timeit
+
+from sipparty.parse import Parser
+from sipparty.sip import Header, Message
+from sipparty.sip.body import Body
+from sipparty.sip.message import MessageResponse, UnparsedHeader
+from sipparty.sip.prot import bdict
+from sipparty.sip.request import Request
+from sipparty.sip.response import Response
+from sipparty.util import astr
+
+HeaderSeparatorRE = re.compile(
+    b"(%(CRLF)s(?:(%(token)s)%(COLON)s|%(CRLF)s))" % bdict)
+
+Via = (
+    b'Via: SIP/2.0/UDP pc33.atlanta.com;branch=z9hG4bK776asdhds\r\n'
+    b'Via: SIP/2.0/UDP bigbox3.site3.atlanta.com'
+    b';branch=z9hG4bK77ef4c2312983.1;received=192.0.2.2\r\n')
+Dialog = (
+    b'Max-Forwards: 70\r\n'
+    b'To: Bob <sip:bob@biloxi.com>%(to_tag)s\r\n'
+    b'From: Alice <sip:alice@atlanta.com>;tag=1928301774\r\n'
+    b'Call-ID: a84b4c76e66710@pc33.atlanta.com\r\n'
+    b'CSeq: %(cseq)s\r\n')
+SDP = (
+    b'v=0\r\n'
+    b'o=alice 2890844526 2890844526 IN IP4 pc33.atlanta.com\r\n'
+    b's=-\r\n'
+    b'c=IN IP4 pc33.atlanta.com\r\n'
+    b't=0 0\r\n'
+    b'm=audio 49172 RTP/AVP 0\r\n'
+    b'a=rtpmap:0 PCMU/8000\r\n')
+
+
+def Corpus():
+    invite = (
+        b'INVITE sip:bob@biloxi.com SIP/2.0\r\n' + Via +
+        Dialog % {b'to_tag': b'', b'cseq': b'314159 INVITE'} +
+        b'Contact: <sip:alice@pc33.atlanta.com>\r\n'
+        b'Content-Type: application/sdp\r\n'
+        b'Content-Length: %d\r\n\r\n' % len(SDP) + SDP)
+    ok = (
+        b'SIP/2.0 200 OK\r\n' + Via +
+        Dialog % {b'to_tag': b';tag=a6c85cf', b'cseq': b'314159 INVITE'} +
+        b'Contact: <sip:bob@192.0.2.4>\r\n'
+        b'Content-Type: application/sdp\r\n'
+        b'Content-Length: %d\r\n\r\n' % len(SDP) + SDP)
+    ack = (
+        b'ACK sip:bob@192.0.2.4 SIP/2.0\r\n' + Via +
+        Dialog % {b'to_tag': b';tag=a6c85cf', b'cseq': b'314159 ACK'} +
+        b'Content-Length: 0\r\n\r\n')
+    bye = (
+        b'BYE sip:alice@pc33.atlanta.com SIP/2.0\r\n' + Via +
+        Dialog % {b'to_tag': b';tag=a6c85cf', b'cseq': b'231 BYE'} +
+        b'Content-Length: 0\r\n\r\n')
+    return [invite, ok, ack, bye]
+
+
+def OldParse(string):
+    "The parser from before the message scanner."
+    lines = HeaderSeparatorRE.split(string)
+    line_iter = iter(lines)
+    startline = next(line_iter)
+    if Message.ResponseRE.match(startline):
+        message = MessageResponse(
+            startline=Response.Parse(startline), configure_bindings=False)
+    else:
+        requestline = Request.Parse(startline)
+        message = getattr(Message, requestline.type)(
+            startline=requestline, autofillheaders=False,
+            configure_bindings=False)
+
+    used_bytes = len(startline)
+    while True:
+        hnamebytes = len(next(line_iter))
+        hname = next(line_iter)
+        if hname is None:
+            break
+        hcontents = next(line_iter)
+        message.addHeader(UnparsedHeader(astr(hname), hcontents))
+        used_bytes += hnamebytes + len(hcontents)
+
+    used_bytes += 4
+    clen = message.content_lengthheader.number
+    if hasattr(message, 'content_typeheader'):
+        ctype = message.content_typeheader.content_type
+        message.addBody(
+            Body(type=ctype, content=string[used_bytes:used_bytes + clen]))
+    return message
+
+
+HeaderCorpus = (
+    ('From', b'Alice <sip:alice@atlanta.com>;tag=1928301774'),
+    ('To', b'Bob <sip:bob@biloxi.com>;tag=a6c85cf'),
+    ('Contact', b'<sip:alice@pc33.atlanta.com>'),
+    ('Via', b'SIP/2.0/UDP pc33.atlanta.com;branch=z9hG4bK776asdhds'),
+    ('CSeq', b'314159 INVITE'),
+    ('Call-ID', b'a84b4c76e66710@pc33.atlanta.com'),
+    ('Max-Forwards', b'70'),
+    ('Content-Length', b'142'),
+    ('Content-Type', b'application/sdp'))
+
+log = logging.getLogger(__name__)
+
+
+def InterpretedParse(cls, string):
+    "Parser.Parse as it was before the parseinfo was compiled."
+    pi = cls.parseinfo
+
+    log.debug("%r Parse.", cls.__name__)
+
+    if not isinstance(string, bytes):
+        raise TypeError(
+            'String to parse of type %r is not a bytes-like type.' %
+            type(string))
+
+    if Parser.Repeats in pi and pi[Parser.Repeats]:
+        log.debug("  repeats")
+        result = []
+        repeats = True
+    else:
+        log.debug("  does not repeat")
+        repeats = False
+
+    while len(string) > 0:
+        log.debug("  %r", string)
+        mo = cls.SimpleParse(string)
+
+        if Parser.Constructor in pi:
+            constructor_gp, constructor_func = pi[Parser.Constructor]
+            obj = constructor_func(mo.group(constructor_gp))
+            obj.parse(string, mo)
+        elif pi.get(Parser.PassMappingsToInit, False):
+            log.debug("  initialize class.")
+            attrs = InterpretedMappings(mo, pi[Parser.Mappings])
+            obj = cls(**attrs)
+            getattr(obj, 'parsecust', lambda str_, mo_: None)(string, mo)
+        else:
+            obj = cls()
+            obj.parse(string, mo)
+
+        if not repeats:
+            log.debug("  finished.")
+            result = obj
+            break
+
+        result.append(obj)
+        string = string[len(mo.group(0)):]
+
+    log.debug("Parse result %r", result)
+    return result
+
+
+def InterpretedInstanceParse(self, string, mo=None):
+    log.debug("%r parse:", self.__class__.__name__)
+    log.debug("  %r", string)
+
+    if mo is None:
+        mo = self.SimpleParse(string)
+
+    if Parser.Mappings in self.parseinfo:
+        avs = InterpretedMappings(mo, self.parseinfo[Parser.Mappings])
+        for attr, val in avs.items():
+            setattr(self, attr, val)
+
+    if hasattr(self, "parsecust"):
+        log.debug(
+            "Parse to parsecust of %r instance", self.__class__.__name__)
+        self.parsecust(string=string, mo=mo)
+
+
+def InterpretedMappings(mo, mappings):
+    attr_vals = {}
+    for mapping, gpnum in zip(mappings, range(1, len(mappings) + 1)):
+        if mapping is None:
+            continue
+
+        log.debug("  group %d mapping %r", gpnum, mapping)
+        data = mo.group(gpnum)
+        if not data:
+            log.debug("  no data")
+            continue
+
+        def identity(x):
+            return x
+        gen = identity
+        attr = mapping[0]
+        if len(mapping) > 1 and mapping[1] is not None:
+            gen = mapping[1]
+
+        if hasattr(gen, 'Parse'):
+            gen = gen.Parse
+
+        log.debug("  raw text %r", data)
+        attr_vals[attr] = gen(data)
+        log.debug("  generated data %r", attr_vals[attr])
+
+    return attr_vals
+
+
+def TimeHeaders(number):
+    ":returns: The microseconds to parse each header in `HeaderCorpus`."
+    times = []
+    for htype, value in HeaderCorpus:
+        hclass = getattr(Header, htype)
+        hclass.Parse(value)
+        parse_s = min(timeit.repeat(
+            lambda: hclass.Parse(value), number=number, repeat=3))
+        times.append(parse_s / number * 1e6)
+    return times
+
+
+def main():
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-n', '--number', type=int, default=500,
+        help='How many times to parse each message in the corpus.')
+    args = ap.parse_args()
+    number = args.number
+
+    logging.disable(logging.CRITICAL)
+
+    corpus = Corpus()
+    for msg_data in corpus:
+        Message.Parse(msg_data)
+
+    def parse_all(parse):
+        for msg_data in corpus:
+            parse(msg_data)
+
+    messages = number * len(corpus)
+    for name, parse in (
+            ('old parser', OldParse), ('scanner', Message.Parse)):
+        parse_s = timeit.timeit(lambda: parse_all(parse), number=number)
+        print('%s: %.0f messages per second' % (name, messages / parse_s))
+
+    compiled_us = TimeHeaders(number)
+    compiled_parse = Parser.__dict__['Parse']
+    compiled_instance_parse = Parser.__dict__['parse']
+    Parser.Parse = classmethod(InterpretedParse)
+    Parser.parse = InterpretedInstanceParse
+    try:
+        interpreted_us = TimeHeaders(number)
+    finally:
+        Parser.Parse = compiled_parse
+        Parser.parse = compiled_instance_parse
+
+    for (htype, _), compiled, interpreted in zip(
+            HeaderCorpus, compiled_us, interpreted_us):
+        print('%s: %.1f us interpreted, %.1f us compiled (%.2fx)' % (
+            htype, interpreted, compiled, interpreted / compiled))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
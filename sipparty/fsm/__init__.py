@@ -96,8 +96,11 @@ effects.
     limitations under the License.
 """
 from .fsm import (
-    AsyncFSM, FSM, FSMTimeout, InitialStateKey, LockedFSM, TransitionKeys,
-    tsk, UnexpectedInput)
+    AsyncFSM, FSM, FSMStateEvents, FSMThreadPool, FSMTimeout,
+    InitialStateKey, LockedFSM, TransitionKeys, tsk, UnexpectedInput)
+from .callbackexecutor import (
+    CallbackExecutor, CallbackLatency, EventLoopCallbackExecutor,
+    ThreadPoolCallbackExecutor)
 from .retrythread import RetryThread
 from .fsmtimer import Timer
 
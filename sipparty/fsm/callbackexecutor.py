@@ -0,0 +1,208 @@
+"""callbackexecutor.py
+
+Policies for running callbacks into application code, such as FSM delegate
+methods, so that a slow callback need not hold up the thread that the SIP
+stack is running on:
+
+- `CallbackExecutor` calls them inline, which is the default behaviour.
+- `ThreadPoolCallbackExecutor` calls them on a pool of threads.
+- `EventLoopCallbackExecutor` calls them on an asyncio event loop, and if a
+  callback returns a coroutine it is run to completion on the loop.
+
+The asynchronous policies return a `concurrent.futures.Future` for the
+callback's result, which can be used to get back into the stack once it has
+completed, for example by hitting an FSM with an input, which is thread
+safe for `LockedFSM` instances.
+
+All policies record how long each named callback takes, see `latencies`.
+
+Copyright 2016 David Park
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from concurrent.futures import (CancelledError, Future, ThreadPoolExecutor)
+import logging
+import threading
+from ..util import Clock
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+log = logging.getLogger(__name__)
+
+
+class CallbackLatency(object):
+    """How long calls to one callback have taken, in seconds."""
+
+    def __init__(self):
+        super(CallbackLatency, self).__init__()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def __repr__(self):
+        return '%s(count=%d, mean=%f, max=%f)' % (
+            type(self).__name__, self.count, self.mean, self.max)
+
+
+class CallbackExecutor(object):
+    """Calls callbacks inline, recording how long they take."""
+
+    # Callbacks that take longer than this many seconds are logged, unless
+    # it is None.
+    slow_callback_s = 0.1
+
+    def __init__(self):
+        super(CallbackExecutor, self).__init__()
+        self._ce_lock = threading.Lock()
+        self._ce_latencies = {}
+
+    @property
+    def is_inline(self):
+        "Whether `call` returns the callback's result rather than a future."
+        return True
+
+    def call(self, name, callback, *args, **kwargs):
+        """Call `callback` with `args` and `kwargs`.
+
+        :param name: The name to record the callback's latency under.
+        :returns: The callback's result.
+        """
+        start = Clock()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            self._ce_record(name, Clock() - start)
+
+    def latencies(self):
+        """:returns:
+            A dictionary of `CallbackLatency` instances by callback name.
+        """
+        with self._ce_lock:
+            return dict(self._ce_latencies)
+
+    def reset_latencies(self):
+        with self._ce_lock:
+            self._ce_latencies = {}
+
+    def _ce_record(self, name, duration):
+        with self._ce_lock:
+            latency = self._ce_latencies.get(name)
+            if latency is None:
+                latency = CallbackLatency()
+                self._ce_latencies[name] = latency
+            latency.count += 1
+            latency.total += duration
+            if duration > latency.max:
+                latency.max = duration
+
+        slow_s = self.slow_callback_s
+        if slow_s is not None and duration > slow_s:
+            log.warning(
+                'Callback %s took %f seconds (more than %f)', name, duration,
+                slow_s)
+
+    def _ce_run(self, name, callback, args, kwargs):
+        "Call the callback on behalf of an asynchronous executor."
+        try:
+            return CallbackExecutor.call(self, name, callback, *args, **kwargs)
+        except Exception:
+            log.exception('Exception from callback %s', name)
+            raise
+
+
+class ThreadPoolCallbackExecutor(CallbackExecutor):
+    """Calls callbacks on a pool of threads."""
+
+    def __init__(self, max_workers=4):
+        super(ThreadPoolCallbackExecutor, self).__init__()
+        self.max_workers = max_workers
+        self._tpce_executor = ThreadPoolExecutor(max_workers)
+
+    @property
+    def is_inline(self):
+        return False
+
+    def call(self, name, callback, *args, **kwargs):
+        """:returns: A `concurrent.futures.Future` of the callback's result.
+        """
+        return self._tpce_executor.submit(
+            self._ce_run, name, callback, args, kwargs)
+
+    def shutdown(self, wait=True):
+        self._tpce_executor.shutdown(wait)
+
+
+class EventLoopCallbackExecutor(CallbackExecutor):
+    """Calls callbacks on an asyncio event loop."""
+
+    def __init__(self, loop):
+        if asyncio is None:
+            raise TypeError(
+                '%s needs asyncio, which is not available.' % (
+                    type(self).__name__,))
+        super(EventLoopCallbackExecutor, self).__init__()
+        self.loop = loop
+
+    @property
+    def is_inline(self):
+        return False
+
+    def call(self, name, callback, *args, **kwargs):
+        """:returns: A `concurrent.futures.Future` of the callback's result,
+        or of the result of the coroutine it returned.
+        """
+        future = Future()
+        self.loop.call_soon_threadsafe(
+            self._elce_start, future, name, callback, args, kwargs)
+        return future
+
+    def _elce_start(self, future, name, callback, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        start = Clock()
+        try:
+            result = callback(*args, **kwargs)
+        except Exception as exc:
+            log.exception('Exception from callback %s', name)
+            self._ce_record(name, Clock() - start)
+            future.set_exception(exc)
+            return
+
+        if not asyncio.iscoroutine(result):
+            self._ce_record(name, Clock() - start)
+            future.set_result(result)
+            return
+
+        def coroutine_done(task):
+            self._ce_record(name, Clock() - start)
+            if task.cancelled():
+                future.set_exception(CancelledError())
+                return
+            exc = task.exception()
+            if exc is not None:
+                log.error('Exception from callback %s: %r', name, exc)
+                future.set_exception(exc)
+                return
+            future.set_result(task.result())
+
+        asyncio.ensure_future(result, loop=self.loop).add_done_callback(
+            coroutine_done)
@@ -17,26 +17,30 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from collections import (Callable, Iterable, OrderedDict)
+from collections import (Callable, deque, Iterable, OrderedDict)
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from functools import partial
 import logging
 from six import iteritems
-from six.moves import queue
 import time
 import threading
-from weakref import ref
+from weakref import ref, WeakSet
 from ..classmaker import classbuilder
 from ..util import (
     CCPropsFor, class_or_instance_method, Enum, OnlyWhenLocked)
 from . import (fsmtimer, retrythread)
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
 
 log = logging.getLogger(__name__)
 
 __all__ = [
-    'AsyncFSM', 'FSMError', 'UnexpectedInput', 'FSMTimeout', 'FSM',
-    'FSMClassInitializer', 'InitialStateKey', 'LockedFSM', 'TransitionKeys',
-    'tsk']
+    'AsyncFSM', 'FSMError', 'UnexpectedInput', 'FSMStateEvents',
+    'FSMThreadPool', 'FSMTimeout', 'FSM', 'FSMClassInitializer',
+    'InitialStateKey', 'LockedFSM', 'TransitionKeys', 'tsk']
 
 
 class FSMError(Exception):
@@ -86,6 +90,64 @@ class FSMClassInitializer(type):
         # Add any predefined actions on state entry.
         self.AddActionsOnStateEntry()
 
+        self.PrecomputeClassTables()
+
+
+class FSMThreadPool(object):
+    """A bounded pool of threads shared by the instances of an FSM class to
+    run their `tsk.StartThreads` actions, which counts how much work is
+    waiting and running.
+    """
+
+    def __init__(self, max_workers, name='FSM'):
+        super(FSMThreadPool, self).__init__()
+        self.max_workers = max_workers
+        self.name = name
+        self.submitted = 0
+        self.completed = 0
+        self._ftp_executor = ThreadPoolExecutor(max_workers)
+        self._ftp_lock = threading.Lock()
+        self._ftp_queued = 0
+        self._ftp_active = 0
+
+    @property
+    def queue_depth(self):
+        "The number of actions waiting for a worker."
+        return self._ftp_queued
+
+    @property
+    def active_workers(self):
+        "The number of workers running an action."
+        return self._ftp_active
+
+    def submit(self, action):
+        with self._ftp_lock:
+            self._ftp_queued += 1
+            self.submitted += 1
+        return self._ftp_executor.submit(self._ftp_run, action)
+
+    def shutdown(self, wait=True):
+        self._ftp_executor.shutdown(wait)
+
+    def _ftp_run(self, action):
+        with self._ftp_lock:
+            self._ftp_queued -= 1
+            self._ftp_active += 1
+        try:
+            return action()
+        finally:
+            with self._ftp_lock:
+                self._ftp_active -= 1
+                self.completed += 1
+
+    def __repr__(self):
+        return '%s(%r, max_workers=%d, queued=%d, active=%d)' % (
+            type(self).__name__, self.name, self.max_workers,
+            self._ftp_queued, self._ftp_active)
+
+
+_fsm_threadPoolsLock = threading.Lock()
+
 
 @classbuilder(mc=(
     CCPropsFor(("States", "Inputs", "Actions")), FSMClassInitializer))
@@ -97,6 +159,8 @@ class FSM:
     it is called when the class is created (using the
     :py:class:`FSMClassInitializer` metaclass) and
     is used to set up the standard transitions and timers for a class.
+    `PrecomputeClassTables` - for subclassing; called once the class's
+    transitions have been added, to work out anything that can be from them.
 
     Class or instance:
     `addTimer` - add a timer that the transitions can control. If called as a
@@ -128,11 +192,36 @@ class FSM:
 
     NextFSMNum = 1
 
+    # The most threads that the instances of an FSM class use at once for
+    # their `tsk.StartThreads` actions. Each class has its own pool.
+    ThreadPoolSize = 4
+
+    # If not None, the `CallbackExecutor` that methods of the delegate are
+    # called with. If it calls them asynchronously the action's result is the
+    # future of the delegate method's result, and the delegate method should
+    # hit the FSM itself to carry on once it has finished.
+    delegate_executor = None
+
     # These are Cumulative Properties (see the metaclass).
     States = Enum((InitialStateKey,))
     Inputs = Enum(tuple())
     Actions = Enum(tuple())
 
+    @classmethod
+    def thread_pool(cls):
+        """:returns: The `FSMThreadPool` for this class, creating it if
+        necessary.
+        """
+        pool = cls.__dict__.get('_fsm_threadPool')
+        if pool is None:
+            with _fsm_threadPoolsLock:
+                pool = cls.__dict__.get('_fsm_threadPool')
+                if pool is None:
+                    pool = FSMThreadPool(
+                        cls.ThreadPoolSize, name=cls.__name__)
+                    cls._fsm_threadPool = pool
+        return pool
+
     @classmethod
     def delegate_method_name(cls, action_name):
         return 'fsm_dele_' + action_name
@@ -178,6 +267,13 @@ class FSM:
         for state, act in state_acts:
             cls.add_action_on_state_entry(state, act)
 
+    @classmethod
+    def PrecomputeClassTables(cls):
+        """Subclasses may override this to work out anything they need from
+        the class's transitions when the class is created. Instances that
+        add their own transitions must not use the result.
+        """
+
     #
     # =================== CLASS OR INSTANCE INTERFACE ========================
     #
@@ -196,73 +292,58 @@ class FSM:
         (must have already been added with addTimer).
         stop_timers: list of timer names to stop when doing this transition
         (must have already been added with addTimer).
+
+        Transitions added to the class are compiled once and shared by all of
+        its instances. Adding a transition to an instance gives it its own
+        copy of the table first.
         """
         log.detail(
             "addTransition self: %r %s:%s->%s", self, input, old_state,
             new_state)
 
-        self_is_class = isinstance(self, type)
-        timrs_dict = self._fsm_timers
-
-        trans_dict = self._fsm_transitions
-        if old_state not in trans_dict:
-            state_trans = OrderedDict()
-        else:
-            state_trans = trans_dict[old_state]
-
-        if input in state_trans:
+        if input in self._fsm_transitions.get(old_state, ()):
             log.debug(self)
             raise ValueError(
                 "FSM %r already has a transition for input %r into state "
                 "%r." %
                 (self._fsm_name, input, old_state))
 
-        result = {}
-        result[self.KeyNewState] = new_state
-        result[self.KeyAction] = self._fsm_makeAction(action)
-
         log.detail("  addTransition threads: %r", start_threads)
-        result[self.KeyStartThreads] = (
-            [] if start_threads is None else
-            [self._fsm_makeThreadAction(thr) for thr in start_threads]
-            if isinstance(start_threads, tuple) or
-            isinstance(start_threads, list) else
-            [self._fsm_makeThreadAction(start_threads)])
-
-        # Link up the timers.
-        for key, timer_names in (
-                (self.KeyStartTimers, start_timers),
-                (self.KeyStopTimers, stop_timers)):
-
-            if self_is_class:
-                # If we're the class, just store the names. They will be
-                # converted into Timer instances when instances are created.
-                result[key] = timer_names or []
-                continue
-
-            timers = []
-            result[key] = timers
-
-            if not timer_names:
-                # No timers specified, so leave a blank list.
-                continue
-
-            for timer_name in timer_names:
+        if start_threads is None:
+            start_threads = ()
+        elif not isinstance(start_threads, (tuple, list)):
+            start_threads = (start_threads,)
+
+        result = {
+            self.KeyNewState: new_state,
+            self.KeyAction: self._fsm_compileAction(action),
+            self.KeyStartThreads: tuple(
+                self._fsm_compileAction(thr) for thr in start_threads),
+            self.KeyStartTimers: tuple(start_timers or ()),
+            self.KeyStopTimers: tuple(stop_timers or ()),
+        }
+
+        if not isinstance(self, type):
+            # Class timers are only looked up when instances are created,
+            # since they may be added after the transitions that use them.
+            for timer_name in (
+                    result[self.KeyStartTimers] + result[self.KeyStopTimers]):
                 log.debug('Add timer %r to fsm %r', timer_name, self.name)
-                if timer_name not in timrs_dict:
+                if timer_name not in self._fsm_timers:
                     raise KeyError("No such timer %r." % (timer_name))
-                timers.append(timrs_dict[timer_name])
 
         # No exceptions, so update state.
+        trans_dict = self._fsm_ownAttribute('_fsm_transitions')
+        state_trans = OrderedDict(trans_dict.get(old_state, ()))
         state_trans[input] = result
         trans_dict[old_state] = state_trans
 
         if input not in self.Inputs:
-            self.Inputs.add(input)
+            self._fsm_ownAttribute('Inputs').add(input)
 
         for state in (old_state, new_state):
             if state not in self.States:
-                self.States.add(state)
+                self._fsm_ownAttribute('States').add(state)
 
         log.detail("%r: %r -> %r", old_state, input, result[self.KeyNewState])
 
@@ -273,39 +354,12 @@ class FSM:
         Timers must be independent of transitions because they may be stopped
         or started at any transition.
         """
-        if isinstance(self, type):
-            # Class, just save the parameters for when we instantiate and
-            # create the actual generator and action then.
-            self._fsm_timers[name] = (action, retryer)
-            return
-
-        if isinstance(retryer, str):
-
-            weak_self = ref(self)
-            retryer_name = retryer
-
-            def weak_retry_wrapper():
-                self = weak_self()
-                if self is None:
-                    log.warning(
-                        'Retryer for timer %s has been released, returning '
-                        'empty list of retry times', name)
-                    return iter(())
-
-                try:
-                    retryer = getattr(self, retryer_name)
-                except AttributeError as exc:
-                    exc.args = (
-                        "Can't make an action with string %s as it is not a "
-                        "method;%s" % (retryer, exc.args[0]),)
-                    raise
-
-                return retryer()
-
-            retryer = weak_retry_wrapper
-
-        newtimer = fsmtimer.Timer(name, self._fsm_makeAction(action), retryer)
-        self._fsm_timers[name] = newtimer
+        self._fsm_compileAction(action)
+        if not isinstance(self, type):
+            # Make the timer now so that any problems are reported now.
+            self._fsm_ownAttribute('_fsm_timerInstances')[name] = (
+                self._fsm_makeTimer(name, action, retryer))
+        self._fsm_ownAttribute('_fsm_timers')[name] = (action, retryer)
 
     @class_or_instance_method
     def add_action_on_state_entry(self, state, action):
@@ -314,12 +368,11 @@ class FSM:
                 'Cannot add action for entry into non-existent state %r' % (
                     state,))
 
-        act_list = self._fsm_state_entry_actions.get(state)
-        if act_list is None:
-            act_list = []
-            self._fsm_state_entry_actions[state] = act_list
-
-        act_list.append(self._fsm_makeAction(action))
+        compiled_action = self._fsm_compileAction(action)
+        state_entry_actions = self._fsm_ownAttribute(
+            '_fsm_state_entry_actions')
+        state_entry_actions[state] = (
+            tuple(state_entry_actions.get(state, ())) + (compiled_action,))
 
     #
     # =================== INSTANCE INTERFACE =================================
@@ -370,53 +423,20 @@ class FSM:
             self.__class__.NextFSMNum += 1
 
         self._fsm_name = name
-        self._fsm_weakDelegate = None
-        self.delegate = delegate
+        self._fsm_weakDelegate = None if delegate is None else ref(delegate)
         self.__processing_hit = False
 
-        # Need to learn configuration from the class.
-        class_transitions = self._fsm_transitions
-        self._fsm_transitions = OrderedDict()
-        class_timers = self._fsm_timers
-        self._fsm_timers = {}
-        # It's important that the timers are scheduled predictably for
-        # the case where timers are due to pop at the same time, so we need to
-        # track the running timers in a list.
+        # The transitions, timers and actions are the class's compiled ones
+        # until the instance changes them (see `_fsm_ownAttribute`). Timers
+        # are only created when first used. It's important that the timers
+        # are scheduled predictably for the case where timers are due to pop
+        # at the same time, so we need to track the running timers in a list.
         self._fsm_running_timers = []
-        self.Inputs = copy(self.Inputs)
-
-        self._fsm_state = getattr(self, '_fsm_state')
+        self._fsm_state = self._fsm_state
         log.debug("Initial state of %r instance is %r.",
                   self.__class__.__name__, self._fsm_state)
 
-        # If the class had any pre-set transitions or timers, set them up now.
-        for timer_name, (action, retryer) in iteritems(class_timers):
-            self.addTimer(timer_name, action, retryer)
-
-        # Ditto for transitions.
-        for os, inp, ns, act, start_tmrs, stop_tmrs, strt_thrs in [
-                (os, inp, result[self.KeyNewState],
-                 result[self.KeyAction],
-                 result[self.KeyStartTimers], result[self.KeyStopTimers],
-                 result[self.KeyStartThreads])
-                for os, state_trans in iteritems(class_transitions)
-                for inp, result in iteritems(state_trans)]:
-            self.addTransition(
-                os, inp, ns, act, start_tmrs, stop_tmrs, strt_thrs)
-
-        class_state_entries = self._fsm_state_entry_actions
-        self._fsm_state_entry_actions = {}
-        for state, act in (
-                (s, a) for s, acts in iteritems(class_state_entries)
-                for a in acts):
-            self.add_action_on_state_entry(state, act)
-
-        self.__input_queue = queue.Queue()
-        self._fsm_oldThreadQueue = queue.Queue()
-
-        log.detail(
-            "  %r instance after init: %r", self.__class__.__name__, self)
-        return
+        self.__input_queue = deque()
 
     def checkTimers(self):
         "Check all the timers that are running."
@@ -440,6 +460,16 @@ class FSM:
         self.__queue_next_hit((input, args, kwargs))
         self.__process_queued_hits()
 
+    def cancel_threads(self):
+        """Ask the FSM's thread actions to stop. Each finishes its current
+        run, but is not retried.
+        """
+        self._fsm_threadsCancelledEvent().set()
+        retries = self.__dict__.get('_fsm_threadActionRetries')
+        if retries is not None:
+            for handle in list(retries.values()):
+                handle.cancel()
+
     def raise_unexpected_input(self, input):
         raise(UnexpectedInput("%r instance fsm has no input %r." % (
             type(self).__name__, input)))
@@ -472,10 +502,30 @@ class FSM:
     # ======================= INTERNAL METHODS ===============================
     #
     @class_or_instance_method
-    def _fsm_makeAction(self, action):
-        # action is either a callable, which is called directly, or it is a
-        # method name, in which case we bind it to a method if we can.
-        log.debug("make action %r", action)
+    def _fsm_ownAttribute(self, name):
+        """:returns:
+            The value of attribute `name`, which instances share with their
+            class until they change it, so copy first.
+        """
+        if isinstance(self, type):
+            return getattr(self, name)
+
+        value = self.__dict__.get(name)
+        if value is None:
+            class_value = getattr(type(self), name, None)
+            value = {} if class_value is None else copy(class_value)
+            setattr(self, name, value)
+        return value
+
+    @class_or_instance_method
+    def _fsm_compileAction(self, action):
+        """Check an action and normalize it to a tuple of subactions.
+
+        An action is either a callable, which is called directly, or a method
+        name, or a tuple of a method name and arguments to pass to it before
+        those given to the action, or a list of any of those.
+        """
+        log.debug("compile action %r", action)
 
         if action is None:
             return None
@@ -502,165 +552,249 @@ class FSM:
                 for _act in action_list):
             _raise_ValueError()
 
-        if isinstance(self, type):
-            # Delay actually building the action until we have an instance
-            # for it.
-            return action
-
-        weak_self = ref(self)
-
-        def weak_perform_actions(*args, **kwargs):
-            """Find action to run if self is not released and run it.
+        return tuple(action_list)
 
-            The Lookup order is:
+    def _fsm_runAction(self, action_list, args, kwargs):
+        """Run a compiled action.
 
-            If self has a method with the correct name, it is run.
-            If the delegate exists and has a method with the correct name, it
-            is run too.
-            If both were run, the result of the self method is returned.
-            If just one was run, then the result of just that one is returned.
-
-            Otherwise AttributeError is raised.
-            """
-            log.debug("Action list: %r", action_list)
-            assert len(action_list)
-            self = weak_self()
-            if self is None:
-                return None
+        The Lookup order for each subaction is:
 
-            for action in action_list:
-                run_delegate = False
-                run_self = False
-                run_callable = False
+        If self has a method with the correct name, it is run.
+        If the delegate exists and has a method with the correct name, it
+        is run too.
+        If both were run, the result of the self method is returned.
+        If just one was run, then the result of just that one is returned.
 
-                if isinstance(action, Callable):
-                    crv = action(*args, **kwargs)
-                    run_callable = True
-                    continue
+        Otherwise AttributeError is raised.
+        """
+        log.debug("Action list: %r", action_list)
+        assert len(action_list)
+        for action in action_list:
+            run_delegate = False
+            run_self = False
+            run_callable = False
+
+            if isinstance(action, Callable):
+                crv = action(*args, **kwargs)
+                run_callable = True
+                continue
 
-                if isinstance(action, str):
-                    action_name = action
-                    action_partial_args = ()
-                else:
-                    action_name = action[0]
-                    action_partial_args = action[1:]
+            if isinstance(action, str):
+                action_name = action
+                action_partial_args = ()
+            else:
+                action_name = action[0]
+                action_partial_args = action[1:]
 
-                func = getattr(self, action_name, None)
-                if isinstance(func, Callable):
+            func = getattr(self, action_name, None)
+            if isinstance(func, Callable):
+                log.debug(
+                    'Call self.%s(*%s)', action_name, action_partial_args)
+                run_self = True
+                srv = partial(func, *action_partial_args)(*args, **kwargs)
+
+            dele = getattr(self, "delegate", None)
+            delegate_method_name = FSM.delegate_method_name(action_name)
+            if dele is not None:
+                method = getattr(dele, delegate_method_name, None)
+                if isinstance(method, Callable):
                     log.debug(
-                        'Call self.%s(*%s)', action_name, action_partial_args)
-                    run_self = True
-                    srv = partial(func, *action_partial_args)(*args, **kwargs)
-
-                dele = getattr(self, "delegate", None)
-                delegate_method_name = FSM.delegate_method_name(action_name)
-                if dele is not None:
-                    method = getattr(dele, delegate_method_name, None)
-                    if isinstance(method, Callable):
-                        log.debug(
-                            "Call self.delegate.%s(*%s)", delegate_method_name,
-                            action_partial_args)
-
-                        run_delegate = True
+                        "Call self.delegate.%s(*%s)", delegate_method_name,
+                        action_partial_args)
+
+                    run_delegate = True
+                    executor = self.delegate_executor
+                    if executor is None:
                         drv = partial(method, self, *action_partial_args)(
                             *args, **kwargs)
+                    else:
+                        drv = executor.call(
+                            delegate_method_name, method, self,
+                            *(tuple(action_partial_args) + args), **kwargs)
+
+            if not run_delegate:
+                # The delegate was not run, so see if we have a default
+                # delegate method.
+                method = getattr(self, delegate_method_name, None)
+                if isinstance(method, Callable):
+                    log.debug(
+                        "Call self.%s(*%s)", delegate_method_name,
+                        action_partial_args)
+
+                    run_delegate = True
+                    drv = partial(method, *action_partial_args)(
+                        *args, **kwargs)
+
+            if not (run_self or run_delegate):
+                # The action could not be resolved.
+                raise AttributeError(
+                    "Action {0!r} is not a callable or a method on the "
+                    "{1} instance "
+                    "(attribute value was {2}) and its delegate {3!r} "
+                    "had no "
+                    "such attribute and no default delegate method on "
+                    "the {1!r} instance was implemented.".format(
+                        action_name, self.__class__.__name__,
+                        getattr(self, action_name, '<not present>'),
+                        getattr(self, 'delegate', None)))
+
+        if run_self:
+            return srv
+
+        if run_delegate:
+            return drv
+
+        if run_callable:
+            return crv
+
+        # It would be a bug to reach here.
+        assert any((run_self, run_delegate, run_callable)), (
+            "This is a bug. Actions shouldn't exist unless they have more "
+            "than one subactions to perform.")
 
-                if not run_delegate:
-                    # The delegate was not run, so see if we have a default
-                    # delegate method.
-                    method = getattr(self, delegate_method_name, None)
-                    if isinstance(method, Callable):
-                        log.debug(
-                            "Call self.%s(*%s)", delegate_method_name,
-                            action_partial_args)
-
-                        run_delegate = True
-                        drv = partial(method, *action_partial_args)(
-                            *args, **kwargs)
+    def _fsm_makeAction(self, action):
+        """:returns:
+            A callable that runs `action` if this FSM has not been released,
+            without holding a reference to it.
+        """
+        action_list = self._fsm_compileAction(action)
+        if action_list is None:
+            return None
 
-                if not (run_self or run_delegate):
-                    # The action could not be resolved.
-                    raise AttributeError(
-                        "Action {0!r} is not a callable or a method on the "
-                        "{1} instance "
-                        "(attribute value was {2}) and its delegate {3!r} "
-                        "had no "
-                        "such attribute and no default delegate method on "
-                        "the {1!r} instance was implemented.".format(
-                            action_name, self.__class__.__name__,
-                            getattr(self, action_name, '<not present>'),
-                            getattr(self, 'delegate', None)))
-
-            del self
-            if run_self:
-                return srv
-
-            if run_delegate:
-                return drv
-
-            if run_callable:
-                return crv
-
-            # It would be a bug to reach here.
-            assert any((run_self, run_delegate, run_callable)), (
-                "This is a bug. Actions shouldn't exist unless they have more "
-                "than one subactions to perform.")
+        weak_self = ref(self)
+
+        def weak_perform_actions(*args, **kwargs):
+            self = weak_self()
+            if self is None:
+                return None
+            return self._fsm_runAction(action_list, args, kwargs)
 
         weak_perform_actions.action_list = str(action_list)
         return weak_perform_actions
 
-    @class_or_instance_method
-    def _fsm_makeThreadAction(self, action):
-
-        weak_method = self._fsm_makeAction(action)
-        if isinstance(self, type):
-            # Delay deciding whether the action is appropriate because we
-            # can't bind the action name to a method at this point as we are
-            # the class not the instance.
-            return weak_method
+    def _fsm_makeTimer(self, name, action, retryer):
+        if isinstance(retryer, str):
 
-        weak_self = ref(self)
-        owner_thread = threading.currentThread()
+            weak_self = ref(self)
+            retryer_name = retryer
 
-        def fsmThread():
-            cthr = threading.currentThread()
-            log.debug("FSM Thread %r in.", cthr.name)
-            while owner_thread.isAlive():
+            def weak_retry_wrapper():
                 self = weak_self()
-                log.debug("Self is %r.", self)
-                del self
+                if self is None:
+                    log.warning(
+                        'Retryer for timer %s has been released, returning '
+                        'empty list of retry times', name)
+                    return iter(())
+
                 try:
-                    wait = weak_method()
-                except Exception:
-                    log.exception("Exception in %r thread.", cthr.name)
-                    break
+                    retryer = getattr(self, retryer_name)
+                except AttributeError as exc:
+                    exc.args = (
+                        "Can't make an action with string %s as it is not a "
+                        "method;%s" % (retryer, exc.args[0]),)
+                    raise
 
-                if wait is None:
-                    break
+                return retryer()
 
-                log.debug("Thread %r wants to try again in %02f seconds.",
-                          cthr.name, wait)
-                time.sleep(wait)
-            else:
+            retryer = weak_retry_wrapper
+
+        return fsmtimer.Timer(name, self._fsm_makeAction(action), retryer)
+
+    def _fsm_timer(self, name):
+        """:returns: The instance's timer called `name`, creating it from the
+        class's definition the first time it is used.
+        """
+        timers = self._fsm_ownAttribute('_fsm_timerInstances')
+        timer = timers.get(name)
+        if timer is None:
+            try:
+                action, retryer = self._fsm_timers[name]
+            except KeyError:
+                raise KeyError("No such timer %r." % (name,))
+            timer = self._fsm_makeTimer(name, action, retryer)
+            timers[name] = timer
+        return timer
+
+    def _fsm_threadsCancelledEvent(self):
+        event = self.__dict__.get('_fsm_threadsCancelled')
+        if event is None:
+            event = self.__dict__.setdefault(
+                '_fsm_threadsCancelled', threading.Event())
+        return event
+
+    def _fsm_makeThreadAction(self, action_list):
+        """:returns:
+            A callable to run on the class's thread pool, which runs
+            `action_list`, and if that returns a time to wait, schedules
+            itself to be submitted to the pool again after that time, so that
+            a worker is only held while the action is running.
+        """
+        weak_self = ref(self)
+        # The thread that hit the FSM. Thread actions stop if it exits.
+        owner_thread = threading.currentThread()
+        cancelled = self._fsm_threadsCancelledEvent()
+
+        def fsmThread():
+            if not owner_thread.is_alive():
                 log.warning(
-                    "Owner thread died, so finishing FSM thread %r.",
-                    cthr.name)
+                    "Owner thread died, so finishing FSM thread action %r.",
+                    fsmThread.name)
+                return
 
             self = weak_self()
-            if self is not None:
+            if self is None or cancelled.is_set():
+                log.debug(
+                    "FSM freed or cancelled, finishing thread action %r.",
+                    fsmThread.name)
+                return
+
+            log.debug("FSM thread action %r in.", fsmThread.name)
+            try:
+                wait = self._fsm_runAction(action_list, (), {})
+            except Exception:
+                log.exception(
+                    "Exception in %r thread action.", fsmThread.name)
+                return
+
+            if wait is not None:
                 log.debug(
-                    "Thread %r finishing, put on FSM's old thread queue.",
-                    cthr.name)
-                self._fsm_oldThreadQueue.put(cthr)
-                # Do not pop the timer now, because this could attempt to
-                # garbage collect another thread also attempting to garbage
-                # collect, leading to a deadlock.
-                # self._fsm_popTimerNow()
-            log.debug("FSM Thread %r out.", cthr.name)
-
-        fsmThread.name = str(action)
+                    "Thread action %r wants to try again in %02f seconds.",
+                    fsmThread.name, wait)
+                self._fsm_scheduleThreadAction(fsmThread, wait)
+            log.debug("FSM thread action %r out.", fsmThread.name)
+
+        fsmThread.name = str(action_list)
         return fsmThread
 
+    def _fsm_scheduleThreadAction(self, thread_action, wait):
+        """Submit `thread_action` to the thread pool again in `wait`
+        seconds, unless the thread actions are cancelled first.
+        """
+        dct = self.__dict__
+        rthr = dct.get('_fsm_threadActionRetryThread')
+        if rthr is None:
+            rthr = dct.setdefault(
+                '_fsm_threadActionRetryThread', retrythread.RetryThread())
+        retries = dct.get('_fsm_threadActionRetries')
+        if retries is None:
+            retries = dct.setdefault('_fsm_threadActionRetries', {})
+
+        handle = rthr.addRetryTime(
+            retrythread.Clock() + wait,
+            action=partial(
+                FSM._fsm_resubmitThreadAction, thread_action=thread_action),
+            owner=self)
+        retries[id(thread_action)] = handle
+
+        # cancel_threads sets the event before cancelling the handles, so
+        # either it has seen this handle or we see the event.
+        if self._fsm_threadsCancelledEvent().is_set():
+            handle.cancel()
+
+    def _fsm_resubmitThreadAction(self, thread_action):
+        self._fsm_threadActionRetries.pop(id(thread_action), None)
+        self.thread_pool().submit(thread_action)
+
     def __str__(self):
         return "\n".join([line for line in self._fsm_strgen()])
 
@@ -677,7 +811,7 @@ class FSM:
         yield "Current state: %r" % self._fsm_state
 
     def __queue_next_hit(self, hit_tuple):
-        self.__input_queue.put(hit_tuple)
+        self.__input_queue.append(hit_tuple)
 
     def __process_queued_hits(self):
         if self.__processing_hit:
@@ -686,8 +820,8 @@ class FSM:
                 self.name)
             return
 
-        while not self.__input_queue.empty():
-            input, args, kwargs = self.__input_queue.get()
+        while self.__input_queue:
+            input, args, kwargs = self.__input_queue.popleft()
             log.debug("Process input %r.", input)
             try:
                 self.__processing_hit = True
@@ -695,18 +829,18 @@ class FSM:
             finally:
                 self.__processing_hit = False
                 log.debug("Items left on queue: %d",
-                          self.__input_queue.qsize())
+                          len(self.__input_queue))
 
     def _fsm_hit(self, input, *args, **kwargs):
         """When the FSM is hit, the following actions are taken in the
         following order:
 
-        1. Join any threads we're expecting to join.
-        2. Stop any timers we're expecting are running.
-        3. Update the state.
-        4. Start any timers for the transition.
-        5. Start any threads.
-        6. If there are any old threads, tidy them up.
+        1. Stop any timers we're expecting are running.
+        2. Run the transition's action.
+        3. Start any timers for the transition.
+        4. Submit any thread actions to the class's thread pool.
+        5. Update the state.
+        6. Run the actions for entering the new state.
         """
         log.detail("_fsm_hit %r %r %r", input, args, kwargs)
 
@@ -734,27 +868,27 @@ class FSM:
             self._fsm_name, input, old_state, new_state)
 
         for st in res[self.KeyStopTimers]:
-            self.stop_timer(st)
+            self.stop_timer(self._fsm_timer(st))
 
-        # The action is complex; see _fsm_makeAction.
+        # The action is complex; see _fsm_compileAction.
         action = res[self.KeyAction]
         if action is not None:
             log.debug("Run transition's action %r", action)
             try:
-                action(*args, **kwargs)
+                self._fsm_runAction(action, args, kwargs)
             except Exception as exc:
                 log.error("Hit %s processing FSM actions %r: %s" % (
-                    type(exc).__name__, action.action_list, exc))
+                    type(exc).__name__, str(action), exc))
                 raise
 
         for st in res[self.KeyStartTimers]:
-            self.start_timer(st)
+            self.start_timer(self._fsm_timer(st))
 
-        for thrAction in res[self.KeyStartThreads]:
-            log.info("Starting FSM thread: %r.", thrAction.name)
-            thrname = thrAction.name
-            thrThread = threading.Thread(target=thrAction, name=thrname)
-            thrThread.start()
+        if res[self.KeyStartThreads]:
+            pool = self.thread_pool()
+            for thrAction in res[self.KeyStartThreads]:
+                log.info("Submit FSM thread action: %r.", thrAction)
+                pool.submit(self._fsm_makeThreadAction(thrAction))
 
         # It is only when everything has succeeded that we know we can update
         # the state.
@@ -763,25 +897,10 @@ class FSM:
         # Perform actions registered for state entry.
         acts = self._fsm_state_entry_actions.get(new_state, ())
         for act in acts:
-            act(*args, **kwargs)
+            self._fsm_runAction(act, args, kwargs)
 
         log.debug("Done hit.")
 
-    def _fsm_garbageCollect(self):
-
-        selfthr = threading.currentThread()
-        while not self._fsm_oldThreadQueue.empty():
-            thr = self._fsm_oldThreadQueue.get()
-
-            # Garbage collection from the garbage collectable FSM threads is
-            # illegal as that can cause deadlocks between two separate FSM
-            # threads attempting to collect each other.
-            assert thr is not selfthr
-
-            log.debug("Joining thread %r", thr.name)
-            thr.join()
-            log.debug("Joined thread %r", thr.name)
-
     @class_or_instance_method
     def _fsm_setState(self, new_state):
         "Should only be called from methods that have the lock."
@@ -801,32 +920,99 @@ class LockedFSM(FSM):
         # Initialize support for the util.OnlyWhenLocked decorator.
         self._lock = threading.RLock()
         self._lock_holdingThread = None
-        self._fsm_stateChangeCondition = threading.Condition(self._lock)
+
+        # Only created if someone waits for a state change.
+        self._fsm_stateChangeCondition = None
 
         log.detail('LockedFSM after init: %r', self)
 
     hit = OnlyWhenLocked(FSM.hit, allow_recursion=True)
 
+    def _fsm_stateCondition(self):
+        with self._lock:
+            if self._fsm_stateChangeCondition is None:
+                self._fsm_stateChangeCondition = threading.Condition(
+                    self._lock)
+            return self._fsm_stateChangeCondition
 
-class AsyncFSM(LockedFSM):
 
-    def __init__(self, *args, **kwargs):
-        super(AsyncFSM, self).__init__(*args, **kwargs)
+def _ResolveFuture(future, result):
+    if not future.done():
+        future.set_result(result)
 
-        # If we pass ourselves directly to the RetryThread, then we'll get
-        # a retain deadlock so neither us nor the thread can be freed.
-        # Fortunately python 2.7 has a nice weak references module.
-        weak_self = ref(self)
 
-        def check_weak_self_timers():
-            self = weak_self()
-            if self is None:
+class FSMStateEvents(object):
+    """Asynchronous iterator over the states an `AsyncFSM` enters, for use
+    with ``async for``. Create with `AsyncFSM.events`.
+
+    Iteration stops after a state for which `until(state)` is true, or once
+    `close` has been called.
+    """
+
+    def __init__(self, loop, until=None):
+        super(FSMStateEvents, self).__init__()
+        self._fse_loop = loop
+        self._fse_until = until
+        self._fse_states = deque()
+        self._fse_getter = None
+        self._fse_finished = False
+
+    def close(self):
+        """Stop iterating once the states already entered are consumed.
+        Must be called on the event loop's thread.
+        """
+        self._fse_finished = True
+        self._fse_wake()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        self._fse_getter = self._fse_loop.create_future()
+        getter = self._fse_getter
+        self._fse_wake()
+        return getter
+
+    def _fse_push(self, state):
+        if self._fse_finished:
+            return
+        self._fse_states.append(state)
+        until = self._fse_until
+        if until is not None and until(state):
+            self._fse_finished = True
+        self._fse_wake()
+
+    def _fse_wake(self):
+        getter = self._fse_getter
+        if getter is None:
+            return
+        if not getter.done():
+            if self._fse_states:
+                getter.set_result(self._fse_states.popleft())
+            elif self._fse_finished:
+                getter.set_exception(StopAsyncIteration())
+            else:
                 return
+        self._fse_getter = None
 
-            self.__backgroundTimerPop()
 
+class AsyncFSM(LockedFSM):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncFSM, self).__init__(*args, **kwargs)
+
+        # Futures from `wait_for_state`, as (condition, future, loop), and
+        # iterators from `events`, which are resolved from `_fsm_setState`
+        # on their event loops rather than by blocking a thread each. Both
+        # are created when first needed.
+        self._fsm_stateWaiters = None
+        self._fsm_stateEvents = None
+
+        # Each running timer has its own handle on the RetryThread, which
+        # holds us weakly, so that a timer pop only checks the timer that is
+        # due, and we don't get a retain deadlock with the thread.
+        self._fsm_timerHandles = None
         self._fsm_thread = retrythread.RetryThread()
-        self._fsm_thread.add_action(check_weak_self_timers)
 
     def start_timer(self, timer):
         """Override of the superclass to implement background timer scheduling.
@@ -834,16 +1020,23 @@ class AsyncFSM(LockedFSM):
         :param timer: The FSMTimer to start.
         """
         super(AsyncFSM, self).start_timer(timer)
-        self._fsm_thread.addRetryTime(timer.nextPopTime)
+        self._fsm_scheduleTimer(timer)
+
+    def stop_timer(self, timer):
+        """Override of the superclass to cancel background timer scheduling.
+
+        :param timer: The FSMTimer to stop.
+        """
+        super(AsyncFSM, self).stop_timer(timer)
+        self._fsm_scheduleTimer(timer)
 
     def checkTimers(self):
         """Check all the timers."""
-        for timer in self._fsm_running_timers:
+        for timer in list(self._fsm_running_timers):
             # Squelch the exception if the timer isn't running yet, because
             # that's easier than checking each one first.
             timer.check(exception_if_not_running=False)
-            if timer.nextPopTime is not None:
-                self._fsm_thread.addRetryTime(timer.nextPopTime)
+            self._fsm_scheduleTimer(timer)
 
     def waitForStateCondition(self, condition, timeout=5):
         if not isinstance(condition, Callable):
@@ -853,16 +1046,63 @@ class AsyncFSM(LockedFSM):
 
         now = time.time()
         then = now + (timeout if timeout is not None else 0)
-        with self._fsm_stateChangeCondition:
+        state_condition = self._fsm_stateCondition()
+        with state_condition:
             while timeout is None or then > now:
                 state = self._fsm_state
                 if condition(state):
                     break
-                self._fsm_stateChangeCondition.wait(then - now)
+                state_condition.wait(then - now)
                 now = time.time()
             else:
                 raise FSMTimeout("Timeout waiting for condition.")
 
+    def wait_for_state(self, condition, loop=None):
+        """Wait for a state without blocking a thread.
+
+        :param condition:
+            Either a callable taking the state and returning whether it is
+            the one wanted, or the state wanted.
+        :param loop:
+            The asyncio event loop to resolve the future on, by default the
+            current one.
+        :returns:
+            A future whose result is the first state satisfying `condition`,
+            which is already resolved if the current state does.
+        """
+        if not isinstance(condition, Callable):
+            wanted_state = condition
+
+            def condition(state):
+                return state == wanted_state
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            state = self._fsm_state
+            if condition(state):
+                future.set_result(state)
+            else:
+                if self._fsm_stateWaiters is None:
+                    self._fsm_stateWaiters = []
+                self._fsm_stateWaiters.append((condition, future, loop))
+        return future
+
+    def events(self, until=None, loop=None):
+        """:returns:
+            An `FSMStateEvents` asynchronous iterator over the states entered
+            from now on, until one for which `until(state)` is true.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        events = FSMStateEvents(loop, until=until)
+        with self._lock:
+            if self._fsm_stateEvents is None:
+                self._fsm_stateEvents = WeakSet()
+            self._fsm_stateEvents.add(events)
+        return events
+
     def addFDSource(self, fd, action):
         self._fsm_thread.addInputFD(fd, action)
 
@@ -875,11 +1115,64 @@ class AsyncFSM(LockedFSM):
 
     @class_or_instance_method
     def _fsm_setState(self, new_state):
-        with self._fsm_stateChangeCondition:
+        with self._lock:
             super(AsyncFSM, self)._fsm_setState(new_state)
-            self._fsm_stateChangeCondition.notify_all()
+            if self._fsm_stateChangeCondition is not None:
+                self._fsm_stateChangeCondition.notify_all()
+            self._fsm_resolveStateWaiters(new_state)
+
+    def _fsm_resolveStateWaiters(self, new_state):
+        "Should only be called with the lock."
+        waiters = self._fsm_stateWaiters
+        if waiters:
+            remaining = []
+            for waiter in waiters:
+                condition, future, loop = waiter
+                if future.done():
+                    # Cancelled.
+                    continue
+                if not condition(new_state):
+                    remaining.append(waiter)
+                    continue
+                try:
+                    loop.call_soon_threadsafe(
+                        _ResolveFuture, future, new_state)
+                except RuntimeError:
+                    log.debug('Event loop closed, not resolving %r', future)
+            self._fsm_stateWaiters = remaining
+
+        for events in list(self._fsm_stateEvents or ()):
+            try:
+                events._fse_loop.call_soon_threadsafe(
+                    events._fse_push, new_state)
+            except RuntimeError:
+                log.debug('Event loop closed, discarding %r', events)
+                self._fsm_stateEvents.discard(events)
+
+    def _fsm_scheduleTimer(self, timer):
+        """Make sure the timer's handle on the RetryThread matches its next
+        pop time, cancelling it if the timer is no longer running.
+        """
+        pop_time = timer.nextPopTime
+        with self._lock:
+            if self._fsm_timerHandles is None:
+                self._fsm_timerHandles = {}
+            handle = self._fsm_timerHandles.pop(timer.name, None)
+            if handle is not None:
+                if handle.active and handle.time == pop_time:
+                    self._fsm_timerHandles[timer.name] = handle
+                    return
+                handle.cancel()
+
+            if pop_time is None:
+                return
+
+            self._fsm_timerHandles[timer.name] = self._fsm_thread.addRetryTime(
+                pop_time, action=partial(AsyncFSM._fsm_backgroundTimerPop,
+                                         timer=timer),
+                owner=self)
 
-    def __backgroundTimerPop(self):
-        log.debug("__backgroundTimerPop")
-        self.checkTimers()
-        self._fsm_garbageCollect()
+    def _fsm_backgroundTimerPop(self, timer):
+        log.debug("background pop of timer %s", timer.name)
+        timer.check(exception_if_not_running=False)
+        self._fsm_scheduleTimer(timer)
@@ -14,8 +14,29 @@ bgthr.addRetryTime(0.0)
 # Will do a pop right away (but from the background thread, not the calling
 # thread).
 
+handle = bgthr.addRetryTime(5.5, action=myfsm_check, owner=myfsm)
+# Will call myfsm_check(myfsm) in 5.5 seconds, and nothing else, unless the
+# handle is cancelled or myfsm has been freed by then.
+handle.cancel()
+
 Timing will not be very precise, and basically depends on the latency of
-python's and therefore the OS's select implementation.
+python's and therefore the OS's select implementation. File descriptors are
+waited on with epoll (or the best equivalent from `selectors`) where
+available, and the thread only wakes up for data or the next retry time.
+
+To run inside an asyncio application, set `RetryThread.event_loop` to the
+application's event loop before any RetryThreads are created. FD sources are
+then registered with the loop's `add_reader` and `add_writer`, retry times
+are scheduled with its `call_at`, and no background thread is started, so
+all actions run on the loop's thread.
+
+Alternatively set `RetryThread.separate_timer_thread` before any
+RetryThreads are created to wait for retry times on a thread of their own, so
+that they are not held up by reading from the file descriptors. Due handles
+are passed back to the file descriptor thread to be run, which does so before
+it moves on to the next ready file descriptor, so that all the actions are
+still run by the one thread. How late handles are run is recorded in either
+case, see `RetryThread.timer_lateness_mean` etc.
 
 Copyright 2015 David Park
 
@@ -31,6 +52,10 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from collections import deque
+from functools import partial
+from heapq import (heapify, heappop, heappush)
+from itertools import count
 import logging
 from select import error as select_error, select
 from six import PY2
@@ -39,6 +64,10 @@ import sys
 import threading
 from weakref import ref
 from ..util import (Clock, OnlyWhenLocked, Singleton)
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
 
 log = logging.getLogger(__name__)
 
@@ -51,6 +80,113 @@ class MainThreadDeadException(RuntimeError):
     pass
 
 
+_main_thread_watcher = None
+_main_thread_watcher_lock = threading.Lock()
+
+
+def _watch_main_thread():
+    """Start a daemon thread that wakes all the RetryThreads when the main
+    thread finishes, so that they don't need to wake up periodically to check
+    whether they should exit.
+    """
+    global _main_thread_watcher
+    with _main_thread_watcher_lock:
+        if _main_thread_watcher is not None:
+            return
+
+        def watch():
+            threading.main_thread().join()
+            insts = getattr(RetryThread, '_St_SharedInstances', None) or {}
+            for rthr in list(insts.values()):
+                rthr._rthr_triggerSpin()
+
+        _main_thread_watcher = threading.Thread(
+            name='RetryThread main thread watcher', target=watch)
+        _main_thread_watcher.daemon = True
+        _main_thread_watcher.start()
+
+
+class RetryHandle(object):
+    """A single scheduled pop of a `RetryThread`.
+
+    If the handle has an action, only that action is called when the handle
+    pops, otherwise the actions added to the thread with
+    `RetryThread.add_action` are called.
+
+    If an owner is given it is held weakly and passed to the action when the
+    handle pops. Handles whose owner has been freed, or which have been
+    cancelled, are dropped without being actioned.
+    """
+
+    def __init__(self, time, action=None, owner=None, on_cancel=None):
+        super(RetryHandle, self).__init__()
+        self.time = time
+        self._rh_action = action
+        self._rh_weakOwner = None if owner is None else ref(owner)
+        self._rh_generic = action is None
+        self._rh_onCancel = on_cancel
+        self._rh_done = False
+        self._rh_cancelled = False
+        self._rh_scheduled = True
+        # Whether the thread has counted the handle as cancelled, which is
+        # set under the thread's lock, unlike `_rh_cancelled`.
+        self._rh_counted = False
+
+    @property
+    def is_generic(self):
+        return self._rh_generic
+
+    @property
+    def active(self):
+        if self._rh_done:
+            return False
+        return self._rh_weakOwner is None or self._rh_weakOwner() is not None
+
+    @property
+    def cancelled(self):
+        return self._rh_cancelled
+
+    def cancel(self):
+        """Cancel the handle so that it will never pop."""
+        if self._rh_done:
+            return
+        on_cancel = self._rh_onCancel
+        self.__finish()
+        self._rh_cancelled = True
+        if on_cancel is not None:
+            on_cancel(self)
+
+    def pop(self):
+        """Run the handle's action, unless it is no longer active.
+
+        A handle only ever pops once.
+        """
+        action = self._rh_action
+        weak_owner = self._rh_weakOwner
+        self.__finish()
+        if action is None:
+            return None
+
+        if weak_owner is None:
+            return action()
+
+        owner = weak_owner()
+        if owner is None:
+            log.debug('Owner of %r freed, not popping', self)
+            return None
+        return action(owner)
+
+    def __finish(self):
+        self._rh_done = True
+        self._rh_action = None
+        self._rh_weakOwner = None
+        self._rh_onCancel = None
+
+    def __repr__(self):
+        return '%s(time=%r, action=%r)' % (
+            type(self).__name__, self.time, self._rh_action)
+
+
 class _FDSource(object):
 
     def __init__(self, selectable, action):
@@ -100,9 +236,233 @@ class _FDSource(object):
             type(self).__name__, self._fds_selectable, self._fds_action)
 
 
+class _SelectPoller(object):
+    """Polls FD sources using `select`.
+
+    The lists of fds to select on are only rebuilt when the registrations
+    change, not on every poll.
+    """
+
+    def __init__(self):
+        super(_SelectPoller, self).__init__()
+        self._sp_sources = {}
+        self._sp_fds = []
+        self._sp_outputSources = {}
+        self._sp_outputFDs = []
+
+    def register(self, fdsrc):
+        self._sp_sources[int(fdsrc)] = fdsrc
+        self._sp_fds = list(self._sp_sources)
+
+    def unregister(self, fd):
+        self._sp_sources.pop(fd, None)
+        self._sp_fds = list(self._sp_sources)
+
+    def register_output(self, fdsrc):
+        self._sp_outputSources[int(fdsrc)] = fdsrc
+        self._sp_outputFDs = list(self._sp_outputSources)
+
+    def unregister_output(self, fd):
+        self._sp_outputSources.pop(fd, None)
+        self._sp_outputFDs = list(self._sp_outputSources)
+
+    def poll(self, timeout):
+        """Wait up to `timeout` seconds for FD sources to become readable, or
+        writable for those registered for output.
+
+        :returns: A list of the ready `_FDSource`s.
+        """
+        fds = self._sp_fds
+        srcs = self._sp_sources
+        osrcs = self._sp_outputSources
+        rfds, wfds, efds = select(fds, self._sp_outputFDs, fds, timeout)
+        ready = [srcs[fd] for fd in set(rfds) | set(efds) if fd in srcs]
+        ready.extend(osrcs[fd] for fd in wfds if fd in osrcs)
+        return ready
+
+    def find_dead_fds(self):
+        dead_fds = []
+        for fd in set(self._sp_fds) | set(self._sp_outputFDs):
+            try:
+                log.debug('Test fd %d', fd)
+                select([fd], [], [fd], 0)
+            except select_error:
+                dead_fds.append(fd)
+        return dead_fds
+
+
+class _SelectorsPoller(object):
+    """Polls FD sources using the best `selectors` selector for the platform
+    (epoll on linux), which keeps the registrations in the kernel.
+    """
+
+    def __init__(self):
+        super(_SelectorsPoller, self).__init__()
+        self._selp_selector = selectors.DefaultSelector()
+
+    def register(self, fdsrc):
+        self._selp_set_source(int(fdsrc), 0, fdsrc)
+
+    def unregister(self, fd):
+        self._selp_set_source(fd, 0, None)
+
+    def register_output(self, fdsrc):
+        self._selp_set_source(int(fdsrc), 1, fdsrc)
+
+    def unregister_output(self, fd):
+        self._selp_set_source(fd, 1, None)
+
+    def poll(self, timeout):
+        ready = []
+        for key, events in self._selp_selector.select(timeout):
+            rsrc, wsrc = key.data
+            if events & selectors.EVENT_READ and rsrc is not None:
+                ready.append(rsrc)
+            if events & selectors.EVENT_WRITE and wsrc is not None:
+                ready.append(wsrc)
+        return ready
+
+    def find_dead_fds(self):
+        dead_fds = []
+        for fd in list(self._selp_selector.get_map()):
+            try:
+                select([fd], [], [fd], 0)
+            except select_error:
+                dead_fds.append(fd)
+        return dead_fds
+
+    def _selp_set_source(self, fd, index, fdsrc):
+        """Set the read (index 0) or write (index 1) source for `fd`, and
+        update the events it is registered for to match.
+        """
+        sel = self._selp_selector
+        try:
+            key = sel.get_key(fd)
+        except (KeyError, ValueError):
+            key = None
+
+        srcs = list(key.data) if key is not None else [None, None]
+        srcs[index] = fdsrc
+        events = (
+            (selectors.EVENT_READ if srcs[0] is not None else 0) |
+            (selectors.EVENT_WRITE if srcs[1] is not None else 0))
+        if key is None:
+            if events:
+                sel.register(fd, events, srcs)
+        elif events:
+            sel.modify(fd, events, srcs)
+        else:
+            try:
+                sel.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+
+
+def _EventLoopCall(func, *args):
+    try:
+        func(*args)
+    except (OSError, ValueError) as exc:
+        log.warning('Exception calling %r on event loop: %s', func, exc)
+
+
+def _EventLoopCallSoon(loop, func, *args):
+    """Call `func(*args)` on `loop`'s thread, from any thread."""
+    try:
+        loop.call_soon_threadsafe(_EventLoopCall, func, *args)
+    except RuntimeError as exc:
+        # The loop has been closed.
+        log.debug('Could not call %r on event loop: %s', func, exc)
+
+
+class _EventLoopPoller(object):
+    """Registers FD sources with an asyncio event loop, which calls
+    `ready(fdsrc)` when each is ready.
+
+    Registrations are passed to the loop with `call_soon_threadsafe`, so they
+    can be made from any thread, and are made in the order requested.
+    """
+
+    def __init__(self, loop, ready):
+        super(_EventLoopPoller, self).__init__()
+        self._elp_loop = loop
+        self._elp_ready = ready
+        self._elp_fds = set()
+        self._elp_outputFDs = set()
+
+    def register(self, fdsrc):
+        fd = int(fdsrc)
+        self._elp_fds.add(fd)
+        _EventLoopCallSoon(
+            self._elp_loop, self._elp_loop.add_reader, fd, self._elp_ready,
+            fdsrc)
+
+    def unregister(self, fd):
+        self._elp_fds.discard(fd)
+        _EventLoopCallSoon(self._elp_loop, self._elp_loop.remove_reader, fd)
+
+    def register_output(self, fdsrc):
+        fd = int(fdsrc)
+        self._elp_outputFDs.add(fd)
+        _EventLoopCallSoon(
+            self._elp_loop, self._elp_loop.add_writer, fd, self._elp_ready,
+            fdsrc)
+
+    def unregister_output(self, fd):
+        self._elp_outputFDs.discard(fd)
+        _EventLoopCallSoon(self._elp_loop, self._elp_loop.remove_writer, fd)
+
+    def close(self):
+        for fd in list(self._elp_fds):
+            self.unregister(fd)
+        for fd in list(self._elp_outputFDs):
+            self.unregister_output(fd)
+
+
+class _TimerWakeup(object):
+    """How a `RetryThread` wakes its timer thread, which is kept separate
+    from the `RetryThread` so the timer thread need not hold a reference to
+    it while it waits.
+    """
+
+    def __init__(self, lock):
+        super(_TimerWakeup, self).__init__()
+        self.condition = threading.Condition(lock)
+        self.generation = 0
+        self.stopped = False
+
+    def wake(self, stop=False):
+        with self.condition:
+            self.generation += 1
+            if stop:
+                self.stopped = True
+            self.condition.notify_all()
+
+
 class RetryThread(Singleton):
 
-    max_select_wait = 2.0
+    # If not None, the longest time the thread will wait for FD events or the
+    # next retry time before doing a pass anyway.
+    max_select_wait = None
+
+    # The type of object used to wait for FD events.
+    poller_type = _SelectPoller if selectors is None else _SelectorsPoller
+
+    # Retry times are allowed to pop up to this many seconds late, so that
+    # times which are close together share one wake-up.
+    timer_slack = 0.0
+
+    # The heap of retry times is rebuilt without its cancelled handles when
+    # they make up more than this fraction of it.
+    max_cancelled_fraction = 0.5
+
+    # If not None, the asyncio event loop that new RetryThreads run their FD
+    # sources and retry times on instead of a background thread.
+    event_loop = None
+
+    # Whether new RetryThreads wait for their retry times on a separate
+    # thread from the one that waits for FD events. Ignored when using an
+    # event loop.
+    separate_timer_thread = False
 
     def __init__(self, name=None, **kwargs):
         """Initialize a new RetryThread.
@@ -133,12 +493,34 @@ class RetryThread(Singleton):
 
         log.info("INIT %s instance name %s", type(self).__name__, self.name)
         self._rthr_retryTimes = []
+        self._rthr_retryCount = count()
+        self._rthr_cancelledCount = 0
+        self._rthr_genericHandles = {}
         self._rthr_nextTimesLock = threading.Lock()
         self._rthr_next_wait = None
         self.__actions = []
 
+        # Statistics for how late handles are popped after their times.
+        self.timer_pops = 0
+        self.timer_lateness_total = 0.0
+        self.timer_lateness_max = 0.0
+
         self._rthr_fdSources = {}
+        self._rthr_outputFDSources = {}
         self._rthr_dead_fds = set()
+        self._rthr_loop = self.event_loop
+        self._rthr_loopTimer = None
+        self._rthr_loopTimerTime = None
+        self._rthr_separateTimers = (
+            self._rthr_loop is None and self.separate_timer_thread)
+        self._rthr_timerWakeup = None
+        self._rthr_firedHandles = deque()
+        if self._rthr_loop is None:
+            self._rthr_poller = self.poller_type()
+        else:
+            self._rthr_poller = _EventLoopPoller(
+                self._rthr_loop,
+                partial(RetryThread._rthr_loop_weak_fd_ready, ref(self)))
 
         self._rthr_cancelled = False
         self._rthr_thread = None
@@ -152,7 +534,11 @@ class RetryThread(Singleton):
         self._rthr_triggerRunFD, self._rthr_trigger_run_read_fd = socketpair()
         self.addInputFD(
             self._rthr_trigger_run_read_fd,
-            lambda selectable: selectable.recv(1))
+            lambda selectable: selectable.recv(4096))
+
+        if self._rthr_loop is None:
+            # Only the select thread needs waking when the main thread ends.
+            _watch_main_thread()
 
     @OnlyWhenLocked
     def addInputFD(self, fd, action):
@@ -166,6 +552,13 @@ class RetryThread(Singleton):
             raise KeyError(
                 "Duplicate FD source %r added to thread." % newinput)
 
+        try:
+            self._rthr_poller.register(newinput)
+        except (OSError, ValueError) as exc:
+            log.warning('Adding dead file descriptor %d: %s', newfd, exc)
+            self._rthr_dead_fds.add(newfd)
+            return
+
         self._rthr_fdSources[newfd] = newinput
         self._rthr_maybe_create()
         self._rthr_triggerSpin()
@@ -176,6 +569,7 @@ class RetryThread(Singleton):
         fd = int(_FDSource(fd, None))
         if fd in self._rthr_fdSources:
             del self._rthr_fdSources[fd]
+            self._rthr_poller.unregister(fd)
         elif fd in self._rthr_dead_fds:
             self._rthr_dead_fds.discard(fd)
         else:
@@ -185,34 +579,108 @@ class RetryThread(Singleton):
         self._rthr_maybe_cancel()
         self._rthr_triggerSpin()
 
+    @OnlyWhenLocked
+    def addOutputFD(self, fd, action):
+        """Add file descriptor `fd` to be watched for being writable, with
+        `action` to be called each time it is, until `rmOutputFD` is called.
+        """
+        newoutput = _FDSource(fd, action)
+        newfd = int(newoutput)
+        log.debug('Add output FD %d:%s', newfd, fd)
+        if newfd in self._rthr_outputFDSources:
+            raise KeyError(
+                "Duplicate output FD source %r added to thread." % newoutput)
+
+        self._rthr_poller.register_output(newoutput)
+        self._rthr_outputFDSources[newfd] = newoutput
+        self._rthr_maybe_create()
+        self._rthr_triggerSpin()
+
+    @OnlyWhenLocked
+    def rmOutputFD(self, fd):
+        log.debug('Remove output FD %s', fd)
+        fd = int(_FDSource(fd, None))
+        if fd not in self._rthr_outputFDSources:
+            raise KeyError(
+                "Output FD %r cannot be removed as it is not on the thread." %
+                fd)
+        del self._rthr_outputFDSources[fd]
+        self._rthr_poller.unregister_output(fd)
+
+        self._rthr_maybe_cancel()
+        self._rthr_triggerSpin()
+
     def add_action(self, action):
         self.__actions.append(action)
 
-    def addRetryTime(self, ctime):
-        """Add a time when we should retry the action. If the time is already
-        in the list, then the new time is not re-added."""
-        log.debug("Add retry time %f to %r", ctime, self._rthr_retryTimes)
+    def addRetryTime(self, ctime, action=None, owner=None):
+        """Add a time when we should retry.
+
+        :param ctime: The `Clock` time at which to pop.
+        :param action:
+            The action to call at `ctime`. If `None`, then the actions added
+            with `add_action` are called instead, and if there is already such
+            a generic pop at `ctime` the new time is not re-added.
+        :param owner:
+            If not `None`, held weakly and passed as the only argument to
+            `action`. If the owner is freed before `ctime` the pop is dropped.
+        :returns: The `RetryHandle` for the pop, which may be cancelled.
+        """
+        log.debug("Add retry time %f", ctime)
         with self._rthr_nextTimesLock:
-            ii = 0
-            for ii, time in zip(
-                    range(len(self._rthr_retryTimes)), self._rthr_retryTimes):
-                if ctime < time:
-                    break
-
-                if ctime == time:
+            if action is None:
+                handle = self._rthr_genericHandles.get(ctime)
+                if handle is not None and handle.active:
                     # This time is already present, no need to re-add it.
                     log.debug("Time already in list.")
-                    return
-            else:
-                ii = len(self._rthr_retryTimes)
+                    return handle
 
-            new_rts = list(self._rthr_retryTimes)
-            new_rts.insert(ii, ctime)
-            self._rthr_retryTimes = new_rts
-            log.debug("Retry times: %r", self._rthr_retryTimes)
+            new_handle = RetryHandle(
+                ctime, action=action, owner=owner,
+                on_cancel=self._rthr_weakCancelCallback())
+            if action is None:
+                self._rthr_genericHandles[ctime] = new_handle
+
+            # The thread is already waiting for the current head, so only
+            # needs waking if the new time is earlier.
+            rts = self._rthr_retryTimes
+            new_head = not rts or ctime < rts[0][0]
+
+            # The count breaks ties so handles for the same time pop in the
+            # order they were added, and handles are never compared.
+            heappush(rts, (ctime, next(self._rthr_retryCount), new_handle))
+            log.debug("%d retry times", len(rts))
 
         self._rthr_maybe_create()
-        self._rthr_triggerSpin()
+        if new_head:
+            if self._rthr_loop is not None:
+                _EventLoopCallSoon(
+                    self._rthr_loop, RetryThread._rthr_loop_weak_schedule,
+                    ref(self))
+            elif self._rthr_separateTimers:
+                wakeup = self._rthr_timerWakeup
+                if wakeup is not None:
+                    wakeup.wake()
+            else:
+                self._rthr_triggerSpin()
+        return new_handle
+
+    @property
+    def uses_event_loop(self):
+        return self._rthr_loop is not None
+
+    @property
+    def uses_separate_timer_thread(self):
+        return self._rthr_separateTimers
+
+    @property
+    def timer_lateness_mean(self):
+        """The mean time in seconds between when handles were due and when
+        they were popped.
+        """
+        if not self.timer_pops:
+            return 0.0
+        return self.timer_lateness_total / self.timer_pops
 
     #
     # =================== MAGIC METHODS =======================================
@@ -220,18 +688,22 @@ class RetryThread(Singleton):
     def __del__(self):
         log.info('DELETE %s instance: %s', type(self).__name__, self.name)
 
+        if self._rthr_loop is not None:
+            self._rthr_poller.close()
+            if self._rthr_loopTimer is not None:
+                _EventLoopCallSoon(
+                    self._rthr_loop, self._rthr_loopTimer.cancel)
+
         self._rthr_cancelled = True
         self._rthr_triggerSpin()
+        wakeup = self._rthr_timerWakeup
+        if wakeup is not None:
+            wakeup.wake(stop=True)
 
-        # self._rthr_trigger_run_read_fd.close()
+        # The read end of the trigger and the poller are left for the garbage
+        # collector, since the worker may still be waiting on them and
+        # closing them would lose the trigger.
         self._rthr_triggerRunFD.close()
-        try:
-            self._rthr_trigger_run_read_fd.close()
-        except Exception as exc:
-            log.debug(
-                'Exception attempting to join thread in __del__: %s',
-                exc
-            )
         getattr(super(RetryThread, self), '__del__', lambda: None)()
 
     #
@@ -259,11 +731,19 @@ class RetryThread(Singleton):
         log.info('STOP thread "%s"', thr_name)
 
     @staticmethod
-    def _rthr_get_fd_sources_and_next_wait(weak_self):
+    def _rthr_get_poller_and_wait(weak_self):
         self = weak_self()
         if self is None:
             RetryThread._rthr_raise_no_self()
-        return dict(self._rthr_fdSources), self._rthr_next_wait
+
+        # The timer thread waits for the retry times if there is one.
+        next_wait = (
+            None if self._rthr_separateTimers else self._rthr_next_wait)
+        max_wait = self.max_select_wait
+        if max_wait is not None and (
+                next_wait is None or next_wait > max_wait):
+            next_wait = max_wait
+        return self._rthr_poller, next_wait
 
     @staticmethod
     def _rhr_weak_single_and_should_continue(weak_self):
@@ -281,41 +761,25 @@ class RetryThread(Singleton):
 
         Return whether to retry or not.
         """
-        rsrcs, next_wait = RetryThread._rthr_get_fd_sources_and_next_wait(
-            weak_self
-        )
-        rsrckeys = list(rsrcs.keys())
+        poller, wait = RetryThread._rthr_get_poller_and_wait(weak_self)
         thr_name = threading.current_thread().name
         self = None
 
         try:
-            actual_wait = (
-                RetryThread.max_select_wait
-                if next_wait is None or next_wait > RetryThread.max_select_wait
-                else next_wait
-            )
-            log.debug(
-                "thread %s select %r from %r wait %r.",
-                thr_name, select, rsrckeys,
-                actual_wait)
-            rfds, wfds, efds = select(
-                rsrckeys, [], rsrckeys, actual_wait)
+            log.debug("thread %s poll wait %r.", thr_name, wait)
+            ready_srcs = poller.poll(wait)
         except select_error as exc:
             # One of the FDs is bad... work out which one and tidy up.
             log.warning(
-                "thread %s one of %r is a bad file descriptor: %r", thr_name,
-                rsrckeys, exc)
+                "thread %s one of the fds is a bad file descriptor: %r",
+                thr_name, exc)
             self = weak_self()
             if self is None:
                 RetryThread._rthr_raise_no_self()
 
-            for rk in rsrckeys:
-                try:
-                    log.debug('Test fd %d', rk)
-                    select([rk], [], [rk], 0)
-                except select_error:
-                    log.warning('Removing dead file descriptor %d', rk)
-                    self._mark_input_fd_dead(rk)
+            for fd in poller.find_dead_fds():
+                log.warning('Removing dead file descriptor %d', fd)
+                self._mark_input_fd_dead(fd)
 
             # Exceptions hold onto information about the stack,
             # which means holding onto some of the objects on the
@@ -333,51 +797,261 @@ class RetryThread(Singleton):
         if self is None:
             RetryThread._rthr_raise_no_self()
 
-        log.debug("%s process %r, %r, %r", self, rfds, wfds, efds)
-        if len(rfds) > 0:
-            self._rthr_processSelectedReadFDs(rfds, rsrcs)
+        if self._rthr_separateTimers:
+            # Run the handles the timer thread has found are due first, and
+            # then between each source. They are checked once more at the
+            # end as the trigger for them may have been read with the
+            # sources.
+            self._rthr_pop_fired_handles()
+            log.debug("%s process %d sources", self, len(ready_srcs))
+            if ready_srcs:
+                self._rthr_processSelectedFDs(ready_srcs)
+                self._rthr_pop_fired_handles()
+            return
+
+        log.debug("%s process %d sources", self, len(ready_srcs))
+        if ready_srcs:
+            self._rthr_processSelectedFDs(ready_srcs)
 
         # Check timers.
         log.debug("%s check timers", self)
-        with self._rthr_nextTimesLock:
-            numrts = len(self._rthr_retryTimes)
-            if numrts == 0:
-                self._rthr_next_wait = None
-                log.debug('no scheduled wake-up time')
-                return
+        due_handles = self._rthr_pop_due_handles()
+        if not due_handles:
+            return
 
-            next = self._rthr_retryTimes[0]
-            now = Clock()
+        # We have some work to do, but only for the handles that are due.
+        self._rthr_pop_handles(due_handles)
+
+        # Immediately respin since the actions may have scheduled more times.
+        self._rthr_next_wait = 0
+        return
+
+    @staticmethod
+    def _rthr_weak_run_timers(weak_self, wakeup):
+        """Wait for each retry time and pass the handles that are due to the
+        FD thread.
+        """
+        thr_name = threading.current_thread().name
+        condition = wakeup.condition
+        while True:
+            self = weak_self()
+            if self is None:
+                break
+            with condition:
+                if wakeup.stopped:
+                    break
+                due_handles = self._rthr_pop_due_handles_locked()
+                wait = self._rthr_next_wait
+                generation = wakeup.generation
+
+            if due_handles:
+                self._rthr_firedHandles.extend(due_handles)
+                self._rthr_triggerSpin()
+                del self
+                continue
+
+            # Don't keep the thread alive while waiting.
+            del self
+            with condition:
+                if wakeup.generation == generation and not wakeup.stopped:
+                    log.debug("thread %s timer wait %r.", thr_name, wait)
+                    condition.wait(wait)
+        log.info('STOP thread "%s"', thr_name)
 
-            if next > now:
-                self._rthr_next_wait = next - now
-                log.debug(
-                    "%s next try in %r seconds", self, self._rthr_next_wait)
+    @staticmethod
+    def _rthr_loop_weak_fd_ready(weak_self, fdsrc):
+        self = weak_self()
+        if self is None:
+            return
+        try:
+            self._rthr_processSelectedFDs([fdsrc])
+        except Exception:
+            log.exception(
+                '%s too many exceptions from %r, removing it', self, fdsrc)
+            self._mark_input_fd_dead(int(fdsrc))
+
+    @staticmethod
+    def _rthr_loop_weak_timer_pop(weak_self):
+        self = weak_self()
+        if self is None:
+            return
+        self._rthr_loopTimer = None
+        self._rthr_loopTimerTime = None
+        self._rthr_pop_handles(self._rthr_pop_due_handles())
+        self._rthr_loop_schedule()
+
+    @staticmethod
+    def _rthr_loop_weak_schedule(weak_self):
+        self = weak_self()
+        if self is not None:
+            self._rthr_loop_schedule()
+
+    def _rthr_loop_schedule(self):
+        """Make sure there is a timer on the event loop for the earliest
+        retry time. Must be called on the event loop's thread.
+        """
+        with self._rthr_nextTimesLock:
+            rts = self._rthr_retryTimes
+            head = rts[0][0] if rts else None
+
+        timer = self._rthr_loopTimer
+        if timer is not None:
+            if head is not None and self._rthr_loopTimerTime <= head:
                 return
+            timer.cancel()
+            self._rthr_loopTimer = None
+            self._rthr_loopTimerTime = None
 
-            del self._rthr_retryTimes[0]
+        if head is None:
+            return
 
-        # We have some work to do.
-        log.debug("%s retrying as next %r <= now %r", self, next, now)
-        for action in self.__actions:
+        loop = self._rthr_loop
+        log.debug("%s next event loop pop at %r", self, head)
+        self._rthr_loopTimerTime = head
+        self._rthr_loopTimer = loop.call_at(
+            loop.time() + head + self.timer_slack - Clock(),
+            RetryThread._rthr_loop_weak_timer_pop, ref(self))
+
+    def _rthr_pop_handles(self, due_handles):
+        log.debug("%s popping %d handles", self, len(due_handles))
+        now = Clock()
+        for handle in due_handles:
+            lateness = now - handle.time
+            self.timer_pops += 1
+            self.timer_lateness_total += lateness
+            if lateness > self.timer_lateness_max:
+                self.timer_lateness_max = lateness
+
+        run_generic_actions = False
+        for handle in due_handles:
+            if handle.is_generic:
+                run_generic_actions = True
+                continue
             try:
-                action()
+                handle.pop()
             except Exception:
                 log.exception(
-                    "%s exception doing action %r:", self, action)
+                    "%s exception popping handle %r:", self, handle)
 
-        # Immediately respin since we haven't checked the next timer yet.
-        self._rthr_next_wait = 0
-        return
+        if run_generic_actions:
+            for action in self.__actions:
+                try:
+                    action()
+                except Exception:
+                    log.exception(
+                        "%s exception doing action %r:", self, action)
+
+    def _rthr_pop_due_handles(self):
+        """Remove and return the handles that are due, updating the next
+        wait time.
+        """
+        with self._rthr_nextTimesLock:
+            return self._rthr_pop_due_handles_locked()
+
+    def _rthr_pop_due_handles_locked(self):
+        "Should only be called with the next times lock."
+        due_handles = []
+        rts = self._rthr_retryTimes
+        now = Clock()
+        while rts:
+            ctime, _, handle = rts[0]
+            if not handle.active:
+                # Lazily drop cancelled handles as they reach the front.
+                heappop(rts)
+                self._rthr_forget_handle(handle)
+                continue
+
+            if ctime > now:
+                break
+
+            heappop(rts)
+            self._rthr_forget_handle(handle)
+            due_handles.append(handle)
+
+        if not rts:
+            self._rthr_next_wait = None
+            log.debug('no scheduled wake-up time')
+        else:
+            # Waking up to the slack late lets the times that follow
+            # closely pop on the same wake-up.
+            self._rthr_next_wait = rts[0][0] + self.timer_slack - now
+            log.debug(
+                "%s next try in %r seconds", self, self._rthr_next_wait)
+
+        return due_handles
+
+    def _rthr_pop_fired_handles(self):
+        """Pop the handles that the timer thread has passed over."""
+        fired = self._rthr_firedHandles
+        if not fired:
+            return
+        due_handles = []
+        while fired:
+            due_handles.append(fired.popleft())
+        self._rthr_pop_handles(due_handles)
+
+    def _rthr_forget_handle(self, handle):
+        "Should only be called with the next times lock."
+        handle._rh_scheduled = False
+        if handle._rh_counted:
+            handle._rh_counted = False
+            self._rthr_cancelledCount -= 1
+        if handle.is_generic:
+            if self._rthr_genericHandles.get(handle.time) is handle:
+                del self._rthr_genericHandles[handle.time]
+
+    def _rthr_weakCancelCallback(self):
+        weak_self = ref(self)
+
+        def handle_cancelled(handle):
+            self = weak_self()
+            if self is not None:
+                self._rthr_handle_cancelled(handle)
+
+        return handle_cancelled
+
+    def _rthr_handle_cancelled(self, handle):
+        """Account for a cancelled handle, and compact the retry times if
+        there are now too many cancelled handles in them.
+        """
+        with self._rthr_nextTimesLock:
+            if not handle._rh_scheduled:
+                # Already out of the retry times.
+                return
+            handle._rh_counted = True
+            self._rthr_cancelledCount += 1
+            rts = self._rthr_retryTimes
+            if (self._rthr_cancelledCount <=
+                    len(rts) * self.max_cancelled_fraction):
+                return
+
+            log.debug(
+                'Compact %d retry times with %d cancelled', len(rts),
+                self._rthr_cancelledCount)
+            live_rts = []
+            for entry in rts:
+                if entry[2].active:
+                    live_rts.append(entry)
+                else:
+                    self._rthr_forget_handle(entry[2])
+            heapify(live_rts)
+            self._rthr_retryTimes = live_rts
 
     @OnlyWhenLocked
     def _mark_input_fd_dead(self, fd):
         was_still_in_sources = self._rthr_fdSources.pop(fd, None)
+        self._rthr_poller.unregister(fd)
+        if self._rthr_outputFDSources.pop(fd, None) is not None:
+            self._rthr_poller.unregister_output(fd)
         if was_still_in_sources:
             self._rthr_dead_fds.add(fd)
 
     # The following maybes should only be called with the lock.
     def _rthr_maybe_create(self):
+        if self._rthr_loop is not None:
+            # The event loop does the work.
+            return
+
         if self._rthr_cancelled_thread is not None:
             log.info('JOIN thread "%s"', self._rthr_cancelled_thread.name)
             self._rthr_cancelled_thread.join()
@@ -389,16 +1063,23 @@ class RetryThread(Singleton):
 
     @property
     def _rthr_outstanding_work(self):
-        return len(self._rthr_fdSources) > 1 or len(self._rthr_retryTimes) > 0
+        return (
+            len(self._rthr_fdSources) > 1 or
+            len(self._rthr_outputFDSources) > 0 or
+            len(self._rthr_retryTimes) > self._rthr_cancelledCount)
 
     def _rthr_maybe_cancel(self):
-        if self._rthr_outstanding_work:
+        if self._rthr_loop is not None or self._rthr_outstanding_work:
             # outstanding work, no need to cancel
             return
 
         log.info('CANCEL worker of RetryThread "%s"', self.name)
         self._rthr_cancelled = True
         self._rthr_thread = None
+        wakeup = self._rthr_timerWakeup
+        if wakeup is not None:
+            self._rthr_timerWakeup = None
+            wakeup.wake(stop=True)
 
     def _rthr_begin_thread(self):
         self._rthr_thread = threading.Thread(
@@ -409,9 +1090,28 @@ class RetryThread(Singleton):
         log.info('START thread')
         self._rthr_thread.start()
 
-    def _rthr_processSelectedReadFDs(self, rfds, rsrcs):
-        for rfd in rfds:
-            fdsrc = rsrcs[rfd]
+        if self._rthr_separateTimers:
+            wakeup = _TimerWakeup(self._rthr_nextTimesLock)
+            self._rthr_timerWakeup = wakeup
+            timer_thread = threading.Thread(
+                name='timers for %s' % (self.name,),
+                target=self._rthr_weak_run_timers,
+                args=(ref(self), wakeup))
+            timer_thread.daemon = True
+            log.info('START timer thread')
+            timer_thread.start()
+
+    def _rthr_processSelectedFDs(self, fdsrcs):
+        fired = self._rthr_firedHandles
+        for fdsrc in fdsrcs:
+            if fired:
+                # Don't make due handles wait for the rest of the sources.
+                self._rthr_pop_fired_handles()
+            fd = int(fdsrc)
+            if (self._rthr_fdSources.get(fd) is not fdsrc and
+                    self._rthr_outputFDSources.get(fd) is not fdsrc):
+                # Removed since the poll.
+                continue
             fdsrc.newDataAvailable()
 
     def _rthr_triggerSpin(self):
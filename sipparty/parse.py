@@ -23,6 +23,7 @@ import re
 import logging
 from six import (binary_type as bytes, iteritems, PY2)
 from timeit import default_timer
+from . import util
 from .classmaker import classbuilder
 from .util import abytes, append_to_exception_message, profile
 
@@ -74,6 +75,116 @@ class ParsedProperty(object):
         setattr(obj, atr, val)
 
 
+def _CompileMappings(mappings):
+    """:returns:
+        A tuple of `(group number, attribute, converter)` for each of the
+        `Parser.Mappings` that is not `None`, where the converter is `None` if
+        the group's text is used as it is.
+    """
+    compiled = []
+    for gpnum, mapping in enumerate(mappings, 1):
+        if mapping is None:
+            continue
+
+        max_mapping_len = 2
+        if len(mapping) > max_mapping_len:
+            raise ValueError(
+                'Parser mapping %r has unexpected entries (expected '
+                'length was %d)' % (mapping, max_mapping_len))
+
+        gen = mapping[1] if len(mapping) > 1 else None
+        if hasattr(gen, 'Parse'):
+            gen = gen.Parse
+        compiled.append((gpnum, mapping[0], gen))
+    return tuple(compiled)
+
+
+def _ApplyMappings(mo, mappings):
+    attr_vals = {}
+    group = mo.group
+    for gpnum, attr, gen in mappings:
+        data = group(gpnum)
+        if not data:
+            # No data in this group so nothing to parse. If a group can
+            # have no data then that implies this mapping is optional.
+            continue
+        attr_vals[attr] = data if gen is None else gen(data)
+    return attr_vals
+
+
+def _CompileParsePlan(cls):
+    """Compile the `parseinfo` of `cls`.
+
+    :returns:
+        The compiled mappings and a function that parses a string into an
+        instance, or list of instances, of `cls`, which is `None` if `cls`
+        can't be parsed.
+    """
+    pi = getattr(cls, 'parseinfo', None)
+    if pi is None:
+        return (), None
+
+    mappings = _CompileMappings(pi.get(Parser.Mappings, ()))
+    pattern_re = pi.get(Parser.RE)
+    if pattern_re is None:
+        return mappings, None
+
+    def match(string):
+        if not cls.PROFILE:
+            mo = pattern_re.match(string)
+            if mo is not None and mo.end() == len(string):
+                return mo
+        # SimpleParse does the profiling and raises the errors.
+        return cls.SimpleParse(string)
+
+    constructor = pi.get(Parser.Constructor)
+    if constructor is not None:
+        constructor_gp, constructor_func = constructor
+
+        def build(string, mo):
+            obj = constructor_func(mo.group(constructor_gp))
+            if obj is None:
+                cls.ParseFail(
+                    string, "Could not construct the object from the data.")
+            obj.parse(string, mo)
+            return obj
+
+    elif pi.get(Parser.PassMappingsToInit, False):
+        parsecust = getattr(cls, 'parsecust', None)
+
+        def build(string, mo):
+            obj = cls(**_ApplyMappings(mo, mappings))
+            if parsecust is not None:
+                obj.parsecust(string, mo)
+            return obj
+
+    else:
+        def build(string, mo):
+            obj = cls()
+            obj.parse(string, mo)
+            return obj
+
+    if pi.get(Parser.Repeats, False):
+        def plan(string):
+            if util.enable_debug_logs:
+                log.debug("%r Parse repeated %r", cls.__name__, string)
+            result = []
+            while len(string) > 0:
+                mo = match(string)
+                result.append(build(string, mo))
+                string = string[mo.end():]
+            return result
+    else:
+        def plan(string):
+            if util.enable_debug_logs:
+                log.debug("%r Parse %r", cls.__name__, string)
+            if len(string) == 0:
+                cls.ParseFail(string, "Nothing to parse.")
+            return build(string, match(string))
+
+    return mappings, plan
+
+
 def ParsedPropertyOfClass(cls):
 
     class _ParsedPropertyOfClass(ParsedProperty):
@@ -107,6 +218,12 @@ class ParserType(type):
                 raise
         super(ParserType, self).__init__(name, bases, dict_)
 
+        # Work out how to parse the class now rather than on every parse.
+        self._prs_mappings = ()
+        self._prs_plan = None
+        if 'Parser' in globals():
+            self._prs_mappings, self._prs_plan = _CompileParsePlan(self)
+
 
 @classbuilder(mc=ParserType)
 class Parser:
@@ -287,129 +404,42 @@ class Parser:
         may wish to override this method to do custom parsing (perhaps they
         don't want to return instances of themselves).
         """
-        pi = cls.parseinfo
-
-        log.debug("%r Parse.", cls.__name__)
-
         if not isinstance(string, bytes):
             raise TypeError(
                 'String to parse of type %r is not a bytes-like type.' %
                 type(string))
 
-        if Parser.Repeats in pi and pi[Parser.Repeats]:
-            log.debug("  repeats")
-            result = []
-            repeats = True
-        else:
-            log.debug("  does not repeat")
-            repeats = False
-
-        while len(string) > 0:
-            log.debug("  %r", string)
-            mo = cls.SimpleParse(string)
-
-            if Parser.Constructor in pi:
-                constructor_tuple = pi[Parser.Constructor]
-                log.debug("  constructor: %r.", constructor_tuple)
-
-                constructor_gp = constructor_tuple[0]
-                constructor_func = constructor_tuple[1]
-                constructor_data = mo.group(constructor_gp)
-                obj = constructor_func(constructor_data)
-                if obj is None:
-                    cls.ParseFail(
-                        string,
-                        "Could not construct the object from the data.")
-                obj.parse(string, mo)
-            elif pi.get(Parser.PassMappingsToInit, False):
-                log.debug("  initialize class.")
-                attrs = cls.parsemappings(mo, pi[Parser.Mappings])
-                obj = cls(**attrs)
-                getattr(obj, 'parsecust', lambda str_, mo_: None)(string, mo)
-            else:
-                obj = cls()
-                obj.parse(string, mo)
-
-            if not repeats:
-                log.debug("  finished.")
-                result = obj
-                break
-
-            result.append(obj)
-            assert mo is not None, (
-                "A repeating parser failed a match that didn't cause an "
-                "exception.")
-            string = string[len(mo.group(0)):]
-
-        log.debug("Parse result %r", result)
-        return result
+        plan = cls._prs_plan
+        if plan is None:
+            raise TypeError(
+                "{cls.__name__!r} does not support parsing (has no "
+                "'parseinfo' field)."
+                "".format(**locals()))
+        return plan(string)
 
     @profile
     def parse(self, string, mo=None):
 
-        log.debug("%r parse:", self.__class__.__name__)
-        log.debug("  %r", string)
+        if util.enable_debug_logs:
+            log.debug("%r parse: %r", self.__class__.__name__, string)
 
         if mo is None:
             mo = self.SimpleParse(string)
 
-        if Parser.Mappings in self.parseinfo:
-            mappings = self.parseinfo[Parser.Mappings]
-            avs = self.parsemappings(mo, mappings)
-            for attr, val in iteritems(avs):
-                setattr(self, attr, val)
+        for attr, val in iteritems(
+                _ApplyMappings(mo, type(self)._prs_mappings)):
+            setattr(self, attr, val)
 
         # Finally do parsecust, if specified.
-        if hasattr(self, "parsecust"):
-            log.debug(
-                "Parse to parsecust of %r instance", self.__class__.__name__)
-            self.parsecust(string=string, mo=mo)
+        parsecust = getattr(self, 'parsecust', None)
+        if parsecust is not None:
+            parsecust(string=string, mo=mo)
 
     @classmethod
     @profile
     def parsemappings(cls, mo, mappings):
         """Return dictionary of mappings of attribute to value to set."""
-        attr_vals = {}
-        for mapping, gpnum in zip(mappings, range(1, len(mappings) + 1)):
-            if mapping is None:
-                continue
-
-            log.debug("  group %d mapping %r", gpnum, mapping)
-            data = mo.group(gpnum)
-            if not data:
-                # No data in this group so nothing to parse. If a group can
-                # have no data then that implies this mapping is optional.
-                log.debug("  no data")
-                continue
-
-            def gen(x):
-                return x
-            attr = mapping[0]
-            log.debug("  attribute %r", attr)
-
-            mapping_len = len(mapping)
-            if mapping_len > 1:
-                max_mapping_len = 2
-                if mapping_len > max_mapping_len:
-                    raise ValueError(
-                        'Parser mapping %r has unexpected entries (expected '
-                        'length was %d)' % (mapping, max_mapping_len))
-
-                new_gen = mapping[1]
-                if new_gen is not None:
-                    log.detail('Use generator %r of type %r', gen, type(gen))
-                    gen = new_gen
-
-            if hasattr(gen, 'Parse'):
-                log.detail('Generator is actually a Parser.')
-                gen = gen.Parse
-
-            log.debug("  raw text %r", data)
-            tdata = gen(data)
-            log.debug("  generated data %r", tdata)
-            attr_vals[attr] = tdata
-
-        return attr_vals
+        return _ApplyMappings(mo, _CompileMappings(mappings))
 
     @classmethod
     def stats_summary(self, top_stats=None):
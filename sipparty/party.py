@@ -30,6 +30,10 @@ from .transport import (
 )
 from .util import abytes, astr
 from .vb import ValueBinder
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
 
 log = logging.getLogger(__name__)
 
@@ -54,6 +58,7 @@ class Timeout(PartyException):
     bases=(
         DeepClass("_pt_", {
             'dialog_delegate': {},
+            'delegate_executor': {},
             "display_name_uri": {
                 dck.descriptor: ParsedPropertyOfClass(DNameURI),
                 dck.gen: DNameURI},
@@ -178,6 +183,42 @@ class Party:
         invD.initiate(remote_name=remote_name, remote_port=remote_port)
         return invD
 
+    def ainvite(self, target, proxy=None, loop=None):
+        """Start a dialog with someone without blocking a thread waiting for
+        it to be established.
+
+        :param target: As for :py:meth:`invite`.
+        :param loop:
+            The asyncio event loop to resolve the future on, by default the
+            current one.
+        :returns:
+            A future whose result is the :py:class:`.Dialog` once it is in
+            dialog, or which raises :py:class:`UnexpectedState` if the dialog
+            terminates first.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        invD = self.invite(target, proxy=proxy)
+        States = invD.States
+        established = invD.wait_for_state(
+            lambda st: st in (States.InDialog, States.Terminated), loop=loop)
+        result = loop.create_future()
+
+        def dialog_state_reached(established):
+            if result.done():
+                return
+            if established.cancelled():
+                result.cancel()
+            elif established.result() == States.InDialog:
+                result.set_result(invD)
+            else:
+                result.set_exception(UnexpectedState(
+                    'Dialog terminated before it was established: %s' % (
+                        invD.termination_reason,)))
+
+        established.add_done_callback(dialog_state_reached)
+        return result
+
     def newSession(self):
         MS = self.MediaSession
         if MS is None:
@@ -240,6 +281,8 @@ class Party:
             ids[to_uri].append(invD)
 
         invD.delegate = self.dialog_delegate
+        if self.delegate_executor is not None:
+            invD.delegate_executor = self.delegate_executor
 
         return invD
 
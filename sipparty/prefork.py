@@ -0,0 +1,399 @@
+"""Run SIP in several worker processes sharing the same port.
+
+Copyright 2016 David Park
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+
+from errno import EAGAIN, ECHILD, EINTR, EWOULDBLOCK
+import json
+import logging
+import multiprocessing
+import os
+from select import error as select_error, select
+import signal
+from six import iteritems
+from socket import (
+    AF_UNIX, error as socket_error, SOCK_DGRAM, socket as socket_class,
+    socketpair)
+import sys
+from zlib import crc32
+from .fsm import RetryThread
+from .sip.siptransport import CallIDFromData
+from .transport import (
+    IPAddressFamilyFromName, ListenDescription, SocketProxy, Transport)
+from .util import Clock, WeakMethod
+
+log = logging.getLogger(__name__)
+
+# With kernel steering each worker binds the SIP port itself with
+# SO_REUSEPORT and the system shares packets between them by source address.
+STEERING_KERNEL = 'kernel'
+
+# With Call-ID steering the supervisor receives the datagrams and forwards
+# each one to the worker chosen by its Call-ID, so that all the messages of
+# a dialog are handled by the same worker.
+STEERING_CALL_ID = 'call-id'
+
+
+def WorkerIndexForCallID(call_id, worker_count):
+    """:returns:
+        The index of the worker to handle messages with `call_id`, which is
+        the same in every process.
+    """
+    return (crc32(call_id) & 0xffffffff) % worker_count
+
+
+class WorkerContext(object):
+    """Passed to the worker function in each worker process."""
+
+    # Datagrams read from the steering socket each time it is selected.
+    max_datagrams_per_select = 64
+
+    def __init__(self, index, counters_fd, steering_socket=None,
+                 steering_address=None):
+        super(WorkerContext, self).__init__()
+        self.index = index
+        self.steering_socket = steering_socket
+        self.steering_address = steering_address
+        self._wc_countersFD = counters_fd
+        self._wc_owner = None
+        self._wc_proxy = None
+        self._wc_retryThread = None
+
+    def report_counters(self, counters):
+        """Report `counters`, a dictionary of names to numbers, to the
+        supervisor, replacing those reported before.
+        """
+        os.write(
+            self._wc_countersFD,
+            json.dumps(counters).encode('ascii') + b'\n')
+
+    def consume_steered_datagrams(self, owner):
+        """Pass the datagrams the supervisor steers to this worker to
+        `owner`, a `SocketOwner` such as a `SIPTransport`, as if they had
+        been received on a UDP socket on the steering address.
+        """
+        if self.steering_socket is None:
+            raise ValueError('Worker %d has no steering socket.' % self.index)
+
+        name, port = self.steering_address[:2]
+        transport = owner if isinstance(owner, Transport) else None
+        self._wc_owner = owner
+        self._wc_proxy = SocketProxy(
+            local_address=ListenDescription(
+                sock_family=IPAddressFamilyFromName(name),
+                sock_type=SOCK_DGRAM, name=name, port=port),
+            owner=owner, transport=transport)
+        self.steering_socket.setblocking(False)
+        self._wc_retryThread = RetryThread()
+        self._wc_retryThread.addInputFD(
+            self.steering_socket,
+            WeakMethod(self, '_wc_steering_socket_selected'))
+
+    def _wc_steering_socket_selected(self, sck):
+        for _ in range(self.max_datagrams_per_select):
+            try:
+                data = sck.recv(0x10000)
+            except socket_error as exc:
+                if exc.args and exc.args[0] in (EAGAIN, EWOULDBLOCK):
+                    return
+                raise
+
+            header, data = data.split(b'\n', 1)
+            name, port = header.rsplit(b' ', 1)
+            try:
+                self._wc_owner.consume_data(
+                    self._wc_proxy, (name.decode('ascii'), int(port)), data)
+            except Exception:
+                log.exception('Exception consuming steered datagram')
+
+
+class PreforkSupervisor(object):
+    """Runs a function in several forked worker processes.
+
+    Each worker calls `worker_main` with a `WorkerContext`, and should create
+    its own `SIPTransport` (so the supervisor must be started before any are
+    created in the supervisor process). With `STEERING_KERNEL` each worker
+    listens on the SIP port passing `reuse_port=True` to `listen_for_me`.
+    With `STEERING_CALL_ID` the supervisor listens on `steering_address`,
+    and workers call `WorkerContext.consume_steered_datagrams`.
+
+    Workers that exit are restarted, and the counters they report are
+    summed in `counters`.
+    """
+
+    # Minimum seconds between starts of the same worker, so that one that
+    # fails at once doesn't spin.
+    restart_delay = 1
+
+    # How long `run` waits for counters or datagrams each time round.
+    poll_interval = 0.5
+
+    def __init__(self, worker_main, worker_count=None,
+                 steering=STEERING_KERNEL, steering_address=None):
+        super(PreforkSupervisor, self).__init__()
+        if steering not in (STEERING_KERNEL, STEERING_CALL_ID):
+            raise ValueError('Unknown steering mode %r' % (steering,))
+        if steering == STEERING_CALL_ID and steering_address is None:
+            raise ValueError('Call-ID steering needs a steering_address.')
+
+        if worker_count is None:
+            worker_count = multiprocessing.cpu_count()
+        self.worker_count = worker_count
+        self.steering = steering
+        self.restarts = 0
+        self.dropped_datagrams = 0
+
+        self._ps_workerMain = worker_main
+        self._ps_steeringAddress = steering_address
+        self._ps_dispatchSocket = None
+        self._ps_pids = [None] * worker_count
+        self._ps_startTimes = [None] * worker_count
+        self._ps_counterFDs = [None] * worker_count
+        self._ps_counterBuffers = [b''] * worker_count
+        self._ps_counters = [{} for _ in range(worker_count)]
+        self._ps_steeringSockets = [None] * worker_count
+        self._ps_stopping = False
+
+    @property
+    def worker_pids(self):
+        return list(self._ps_pids)
+
+    @property
+    def worker_counters(self):
+        """The counters last reported by each worker."""
+        return [dict(counters) for counters in self._ps_counters]
+
+    @property
+    def counters(self):
+        """The sum of the counters last reported by each worker."""
+        totals = {}
+        for counters in self._ps_counters:
+            for name, value in iteritems(counters):
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    @property
+    def steering_address(self):
+        if self._ps_dispatchSocket is not None:
+            return self._ps_dispatchSocket.getsockname()
+        return self._ps_steeringAddress
+
+    def start(self):
+        if self.steering == STEERING_CALL_ID:
+            name, port = self._ps_steeringAddress[:2]
+            dsck = socket_class(IPAddressFamilyFromName(name), SOCK_DGRAM)
+            dsck.bind(self._ps_steeringAddress)
+            dsck.setblocking(False)
+            self._ps_dispatchSocket = dsck
+            for index in range(self.worker_count):
+                self._ps_steeringSockets[index] = socketpair(
+                    AF_UNIX, SOCK_DGRAM)
+                self._ps_steeringSockets[index][0].setblocking(False)
+
+        for index in range(self.worker_count):
+            self._ps_start_worker(index)
+
+    def run(self, duration=None):
+        """Supervise the workers until `stop` is called (e.g. from a signal
+        handler), or for `duration` seconds.
+        """
+        end_time = None if duration is None else Clock() + duration
+        while not self._ps_stopping:
+            timeout = self.poll_interval
+            if end_time is not None:
+                timeout = min(timeout, end_time - Clock())
+                if timeout < 0:
+                    return
+            self.poll(timeout)
+
+    def poll(self, timeout=0):
+        """Read counters, steer datagrams and restart exited workers, waiting
+        up to `timeout` seconds for something to do.
+        """
+        fds = [fd for fd in self._ps_counterFDs if fd is not None]
+        dsck = self._ps_dispatchSocket
+        if dsck is not None:
+            fds.append(dsck)
+        try:
+            readable = select(fds, [], [], timeout)[0]
+        except select_error as exc:
+            if exc.args[0] != EINTR:
+                raise
+            readable = []
+
+        for fd in readable:
+            if fd is dsck:
+                self._ps_steer_datagrams()
+            else:
+                self._ps_read_counters(self._ps_counterFDs.index(fd))
+
+        self._ps_reap_workers()
+
+    def stop(self):
+        """Stop the workers and close the supervisor's sockets."""
+        self._ps_stopping = True
+        for pid in self._ps_pids:
+            if pid is None:
+                continue
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for index, pid in enumerate(self._ps_pids):
+            if pid is None:
+                continue
+            try:
+                os.waitpid(pid, 0)
+            except OSError as exc:
+                if exc.errno != ECHILD:
+                    raise
+            self._ps_pids[index] = None
+
+        for index in range(self.worker_count):
+            self._ps_close_worker_fds(index)
+            pair = self._ps_steeringSockets[index]
+            if pair is not None:
+                for sck in pair:
+                    sck.close()
+                self._ps_steeringSockets[index] = None
+        if self._ps_dispatchSocket is not None:
+            self._ps_dispatchSocket.close()
+            self._ps_dispatchSocket = None
+
+    #
+    # =================== INTERNAL METHODS ====================================
+    #
+    def _ps_start_worker(self, index):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            self._ps_run_worker(index, wfd)
+
+        os.close(wfd)
+        log.info('Started worker %d, pid %d', index, pid)
+        self._ps_pids[index] = pid
+        self._ps_startTimes[index] = Clock()
+        self._ps_counterFDs[index] = rfd
+        self._ps_counterBuffers[index] = b''
+        self._ps_counters[index] = {}
+
+    def _ps_run_worker(self, index, counters_fd):
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            for fd in self._ps_counterFDs:
+                if fd is not None:
+                    os.close(fd)
+
+            steering_socket = None
+            for other_index, pair in enumerate(self._ps_steeringSockets):
+                if pair is None:
+                    continue
+                pair[0].close()
+                if other_index == index:
+                    steering_socket = pair[1]
+                else:
+                    pair[1].close()
+            if self._ps_dispatchSocket is not None:
+                steering_address = self._ps_dispatchSocket.getsockname()
+                self._ps_dispatchSocket.close()
+            else:
+                steering_address = self._ps_steeringAddress
+
+            self._ps_workerMain(WorkerContext(
+                index, counters_fd, steering_socket=steering_socket,
+                steering_address=steering_address))
+        except Exception:
+            log.exception('Exception in worker %d', index)
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def _ps_close_worker_fds(self, index):
+        fd = self._ps_counterFDs[index]
+        if fd is not None:
+            os.close(fd)
+            self._ps_counterFDs[index] = None
+
+    def _ps_read_counters(self, index):
+        data = os.read(self._ps_counterFDs[index], 0x10000)
+        if not data:
+            self._ps_close_worker_fds(index)
+            return
+
+        lines = (self._ps_counterBuffers[index] + data).split(b'\n')
+        self._ps_counterBuffers[index] = lines.pop()
+        if lines:
+            self._ps_counters[index] = json.loads(lines[-1].decode('ascii'))
+
+    def _ps_steer_datagrams(self):
+        dsck = self._ps_dispatchSocket
+        for _ in range(WorkerContext.max_datagrams_per_select):
+            try:
+                data, addr = dsck.recvfrom(0x10000)
+            except socket_error as exc:
+                if exc.args and exc.args[0] in (EAGAIN, EWOULDBLOCK):
+                    return
+                raise
+
+            call_id = CallIDFromData(data)
+            index = WorkerIndexForCallID(
+                b'' if call_id is None else call_id, self.worker_count)
+            header = ('%s %d\n' % addr[:2]).encode('ascii')
+            try:
+                self._ps_steeringSockets[index][0].send(header + data)
+            except socket_error as exc:
+                log.warning(
+                    'Dropped datagram for worker %d: %s', index, exc)
+                self.dropped_datagrams += 1
+
+    def _ps_reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            if pid not in self._ps_pids:
+                continue
+
+            index = self._ps_pids.index(pid)
+            log.warning('Worker %d, pid %d, exited: %d', index, pid, status)
+            self._ps_pids[index] = None
+            if self._ps_counterFDs[index] is not None:
+                # Pick up anything reported just before it exited.
+                while self._ps_counterFDs[index] is not None:
+                    self._ps_read_counters(index)
+
+        if self._ps_stopping:
+            return
+
+        now = Clock()
+        for index, pid in enumerate(self._ps_pids):
+            if pid is not None:
+                continue
+            if now < self._ps_startTimes[index] + self.restart_delay:
+                continue
+            self.restarts += 1
+            self._ps_start_worker(index)
@@ -46,6 +46,11 @@ States = Enum((
     "Terminated"))
 Inputs = Enum(("initiate", "receiveRequest", "terminate"))
 
+
+def TerminatedState(state):
+    return state == States.Terminated
+
+
 tfk = TransformKeys
 
 AckTransforms = {
@@ -104,6 +109,13 @@ class Dialog:
         (States.Terminated, 'record_termination_reason'),
     ]
 
+    @classmethod
+    def PrecomputeClassTables(cls):
+        # Work out which input each response code is for now, rather than
+        # for each response.
+        cls._dlg_responseInputTable = prot.ResponseCodeTable.ForInputs(
+            cls.Inputs, 'response_')
+
     #
     # =================== INSTANCE INTERFACE ==================================
     #
@@ -140,6 +152,14 @@ class Dialog:
     def terminate(self, *args, **kwargs):
         self.hit(Inputs.terminate, *args, **kwargs)
 
+    def events(self, until=None, loop=None):
+        """Override of `AsyncFSM.events` that stops iterating once the
+        dialog has terminated, unless told otherwise.
+        """
+        if until is None:
+            until = TerminatedState
+        return super(Dialog, self).events(until=until, loop=loop)
+
     #
     # =========================== FSM ACTIONS =================================
     #
@@ -353,16 +373,14 @@ class Dialog:
             msg.addBody(Body(type=sdpsyntax.SIPBodyType, content=sdpBody))
 
     def _fix_response_input(self, mtype):
-        orig_mtype = mtype
-        while mtype >= 1:
-            attr = "response_%d" % mtype
-            if attr in self.Inputs:
-                log.debug("Response input found: %d", mtype)
-                return attr
-
-            mtype /= 10
-
-        # Didn't find one, perhaps there is an xxx response.
-        if 'response_xxx' in self.Inputs:
-            return 'response_xxx'
-        self.raise_unexpected_input('response_%d' % (orig_mtype,))
+        if 'Inputs' in self.__dict__:
+            # We have our own inputs so can't use the class's table.
+            table = prot.ResponseCodeTable.ForInputs(self.Inputs, 'response_')
+        else:
+            table = self._dlg_responseInputTable
+
+        attr = table.lookup(mtype)
+        if attr is None:
+            self.raise_unexpected_input('response_%d' % (mtype,))
+        log.debug("Response input found: %s", attr)
+        return attr
@@ -20,7 +20,7 @@ from collections import OrderedDict
 import logging
 from numbers import (Integral)
 import re
-from six import (add_metaclass, binary_type as bytes, iteritems, next)
+from six import (add_metaclass, binary_type as bytes, iteritems)
 from six.moves import reduce
 from .. import (util,)
 from ..classmaker import classbuilder
@@ -36,6 +36,7 @@ from .param import Param
 from .prot import bdict
 from .request import Request
 from .response import Response
+from .scanner import ScanMessage
 
 log = logging.getLogger(__name__)
 ContentLengthBinding = (
@@ -128,8 +129,6 @@ class Message:
 
     MethodRE = re.compile(b"%(Method)s" % bdict)
     ResponseRE = re.compile(b"%(SIP_Version)s" % bdict)
-    HeaderSeparatorRE = re.compile(
-        b"(%(CRLF)s(?:(%(token)s)%(COLON)s|%(CRLF)s))" % bdict)
 
     body = util.FirstListItemProxy("bodies")
 
@@ -141,11 +140,9 @@ class Message:
     @classmethod
     def Parse(cls, string):
 
-        lines = cls.HeaderSeparatorRE.split(string)
-        log.detail("Header split: %r", lines)
-        line_iter = iter(lines)
-        startline = next(line_iter)
-        used_bytes = len(startline)
+        scan = ScanMessage(string)
+        log.detail("Message scan: %r", scan)
+        startline = scan.startline
         if cls.ResponseRE.match(startline):
             log.debug("Attempt Message Parse of %r as a response.", startline)
             reqline = Response.Parse(startline)
@@ -165,36 +162,37 @@ class Message:
             raise ParseError(
                 "Startline is not a SIP startline: %r." % (startline,))
 
-        def HNameContentsGen(hcit):
+        # Build the header list directly rather than with addHeader, which
+        # rebuilds the list for each header.
+        headers = []
+        htypes = Header.types
+        for index in range(len(scan.header_spans)):
+            hname = astr(scan.header_name(index))
             try:
-                while True:
-                    hnamebytes = len(next(hcit))
-                    hname = next(hcit)
-                    if hname is None:
-                        return
-                    hcontents = next(hcit)
-                    nbytes = hnamebytes + len(hcontents)
-                    yield (hname, hcontents, nbytes)
-            except StopIteration:
-                assert 0, "Bug: Unexpected end of lines in message."
-
-        for hname, hcontents, bytes_used in HNameContentsGen(line_iter):
-            message.addHeader(UnparsedHeader(astr(hname), hcontents))
-            used_bytes += bytes_used
-
-        # We haven't yet counted the eol eol at the end of the headers.
-        used_bytes += 4
+                htype = getattr(htypes, hname)
+            except AttributeError:
+                raise ParseError("Unsupported header type %r." % (hname,))
+            headers.append(UnparsedHeader(htype, scan.header_value(index)))
+        message.headers = headers
+
+        used_bytes = scan.body_offset
         clen = 0
-        if hasattr(message, "content_lengthheader"):
-            clen = message.content_lengthheader.number
+        clen_index = scan.find_header(b'content-length')
+        if clen_index != -1:
+            try:
+                clen = int(scan.header_value(clen_index))
+            except ValueError:
+                raise ParseError(
+                    "Bad Content-Length %r." % (
+                        scan.header_value(clen_index),))
         else:
             assert (message.viaheader.transport == SOCK_TYPE_IP_NAMES.UDP)
 
+        has_ctype = scan.find_header(b'content-type') != -1
         log.debug("Expecting %d bytes of body", clen)
-        if clen:
-            if not hasattr(message, "content_typeheader"):
-                raise ParseError(
-                    "Message with non-empty body has no content type.")
+        if clen and not has_ctype:
+            raise ParseError(
+                "Message with non-empty body has no content type.")
 
         rest = string[used_bytes:]
 
@@ -203,11 +201,12 @@ class Message:
                 "Body is shorter than specified: got %d expected %d" % (
                     len(rest), clen))
 
-        if hasattr(message, "content_typeheader"):
+        if has_ctype:
             ctype = message.content_typeheader.content_type
             if ctype != sdpsyntax.SIPBodyType:
                 raise ParseError("Unsupported Content-type: %r", ctype)
-            message.addBody(Body(type=ctype, content=rest[:clen]))
+            # string may be a memoryview of a receive buffer, so copy.
+            message.addBody(Body(type=ctype, content=bytes(rest[:clen])))
             used_bytes += clen
 
         message.parsedBytes = used_bytes
@@ -380,4 +380,63 @@ def TransactionID(ttype, branch, cseq_method):
     return (ttype, branch, cseq_method)
 
 
+MinResponseCode = 100
+MaxResponseCode = 699
+
+
+class ResponseCodeTable(object):
+    """Maps response codes to values, which are keyed by the codes or their
+    leading digits, so that for keys ``(200, 4)`` 200 finds the value for
+    200, and 404 the value for 4.
+
+    The most specific value for every code in the standard range is worked
+    out up front, so that lookups are just an index.
+    """
+
+    @classmethod
+    def ForInputs(cls, inputs, prefix):
+        """:returns:
+            A table mapping response codes to the most specific of the FSM
+            `inputs` named `prefix` followed by a code, such as
+            ``'response_18'``, or to ``prefix + 'xxx'`` if there is one.
+        """
+        mapping = {}
+        for inp in inputs:
+            if not isinstance(inp, str) or not inp.startswith(prefix):
+                continue
+            code = inp[len(prefix):]
+            if code.isdigit():
+                mapping[int(code)] = inp
+
+        default = prefix + 'xxx'
+        if default not in inputs:
+            default = None
+        return cls(mapping, default=default)
+
+    def __init__(self, mapping, default=None):
+        super(ResponseCodeTable, self).__init__()
+        self._rct_mapping = dict(mapping)
+        self._rct_default = default
+        self._rct_table = [
+            self._rct_search(code)
+            for code in range(MinResponseCode, MaxResponseCode + 1)]
+
+    def lookup(self, code):
+        """:returns:
+            The most specific value for `code`, or the default if there is
+            none.
+        """
+        if MinResponseCode <= code <= MaxResponseCode:
+            return self._rct_table[code - MinResponseCode]
+        return self._rct_search(code)
+
+    def _rct_search(self, code):
+        mapping = self._rct_mapping
+        while code > 0:
+            if code in mapping:
+                return mapping[code]
+            code //= 10
+        return self._rct_default
+
+
 bdict = bglobals()
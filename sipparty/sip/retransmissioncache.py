@@ -0,0 +1,142 @@
+"""retransmissioncache.py
+
+Cache of the responses to requests received over unreliable transports, so
+that retransmissions of the requests can be answered by resending the
+response without parsing them again.
+
+Copyright 2016 David Park
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import OrderedDict
+from hashlib import sha1
+import logging
+from six import iteritems
+import threading
+from ..util import Clock
+
+log = logging.getLogger(__name__)
+
+
+class _RetransmissionEntry(object):
+    __slots__ = ['transaction_id', 'expiry', 'socket_proxy', 'data']
+
+    def __init__(self, transaction_id, expiry):
+        self.transaction_id = transaction_id
+        self.expiry = expiry
+        self.socket_proxy = None
+        self.data = None
+
+
+class RetransmissionCache(object):
+    """Maps digests of request datagrams to the id of their server
+    transaction, and the last response that was sent for it.
+
+    Entries are dropped `ttl` seconds after the request was first received,
+    and the oldest are dropped when there are more than `size`.
+    """
+
+    @staticmethod
+    def Digest(data):
+        return sha1(data).digest()
+
+    def __init__(self, size, ttl):
+        super(RetransmissionCache, self).__init__()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rc_lock = threading.Lock()
+        self._rc_byDigest = OrderedDict()
+        self._rc_byTransaction = {}
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __len__(self):
+        return len(self._rc_byDigest)
+
+    def lookup(self, digest, is_current=None):
+        """:param is_current:
+            If not `None`, called with the transaction id of any entry found
+            to check that the transaction still needs its response resent.
+            If it returns `False` the entry is dropped.
+        :returns:
+            `(transaction_id, socket_proxy, data)` for the last response sent
+            for the request with `digest`, or `None`.
+        """
+        now = Clock()
+        with self._rc_lock:
+            entry = self._rc_byDigest.get(digest)
+            if entry is not None and entry.expiry <= now:
+                self._rc_remove(digest, entry)
+                entry = None
+
+        result = None
+        if entry is not None and entry.data is not None:
+            tid = entry.transaction_id
+            if is_current is None or is_current(tid):
+                result = tid, entry.socket_proxy, entry.data
+            else:
+                self.forget(tid)
+
+        with self._rc_lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def add_request(self, digest, transaction_id):
+        now = Clock()
+        with self._rc_lock:
+            by_digest = self._rc_byDigest
+            if digest in by_digest:
+                return
+
+            # Entries all have the same TTL so the oldest expire first.
+            while by_digest:
+                old_digest, old_entry = next(iteritems(by_digest))
+                if len(by_digest) < self.size and old_entry.expiry > now:
+                    break
+                self._rc_remove(old_digest, old_entry)
+
+            entry = _RetransmissionEntry(transaction_id, now + self.ttl)
+            by_digest[digest] = entry
+            self._rc_byTransaction[transaction_id] = (digest, entry)
+
+    def add_response(self, transaction_id, socket_proxy, data):
+        "Record the response to resend for the transaction's request."
+        with self._rc_lock:
+            record = self._rc_byTransaction.get(transaction_id)
+            if record is None:
+                return
+            entry = record[1]
+            entry.socket_proxy = socket_proxy
+            entry.data = data
+
+    def forget(self, transaction_id):
+        with self._rc_lock:
+            record = self._rc_byTransaction.get(transaction_id)
+            if record is not None:
+                self._rc_remove(*record)
+
+    def _rc_remove(self, digest, entry):
+        self._rc_byDigest.pop(digest, None)
+        record = self._rc_byTransaction.get(entry.transaction_id)
+        if record is not None and record[1] is entry:
+            del self._rc_byTransaction[entry.transaction_id]
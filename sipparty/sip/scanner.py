@@ -0,0 +1,113 @@
+"""scanner.py
+
+A single pass scanner for SIP messages, which finds the start line, the
+header names and values and the start of the body without creating any
+header objects, so that they can be parsed lazily.
+
+Copyright 2016 David Park
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import re
+from ..parse import ParseError
+from .prot import bdict
+
+log = logging.getLogger(__name__)
+
+StartlineRE = re.compile(b"([^\r\n]*)%(CRLF)s" % bdict)
+
+# A whole header line, including any folded continuation lines (RFC 3261
+# section 7.3.1), which are left in the value as the header parsers cope with
+# linear whitespace.
+HeaderLineRE = re.compile(
+    b"(%(token)s)%(HCOLON)s([^\r\n]*(?:%(CRLF)s%(WS)s+[^\r\n]*)*)%(CRLF)s" %
+    bdict)
+
+
+class MessageScan(object):
+    """The layout of a SIP message.
+
+    `header_spans` is a list of `(name_start, name_end, value_start,
+    value_end)` offsets into `data`, in the order the headers appear.
+    """
+    __slots__ = ['data', 'startline_end', 'header_spans', 'body_offset']
+
+    def __init__(self, data, startline_end, header_spans, body_offset):
+        self.data = data
+        self.startline_end = startline_end
+        self.header_spans = header_spans
+        self.body_offset = body_offset
+
+    @property
+    def startline(self):
+        return bytes(self.data[:self.startline_end])
+
+    def header_name(self, index):
+        span = self.header_spans[index]
+        return bytes(self.data[span[0]:span[1]])
+
+    def header_value(self, index):
+        span = self.header_spans[index]
+        return bytes(self.data[span[2]:span[3]])
+
+    def find_header(self, name):
+        """Find the first header called `name`, ignoring case.
+
+        :returns: The index of the header, or -1 if there is none.
+        """
+        name = name.lower()
+        nlen = len(name)
+        data = self.data
+        for index, span in enumerate(self.header_spans):
+            if (span[1] - span[0] == nlen and
+                    bytes(data[span[0]:span[1]]).lower() == name):
+                return index
+        return -1
+
+    def __repr__(self):
+        return '%s(startline_end=%d, %d headers, body_offset=%d)' % (
+            type(self).__name__, self.startline_end, len(self.header_spans),
+            self.body_offset)
+
+
+def ScanMessage(data):
+    """Scan the message in `data`, which may be any bytes-like object.
+
+    :returns: A `MessageScan`.
+    :raises ParseError: If the start line or headers are malformed or the
+        headers are not terminated by an empty line.
+    """
+    mo = StartlineRE.match(data)
+    if mo is None:
+        raise ParseError('No start line in message %r.' % (bytes(data),))
+    startline_end = mo.end(1)
+    pos = mo.end()
+
+    header_spans = []
+    header_match = HeaderLineRE.match
+    end = len(data)
+    while True:
+        if data[pos:pos + 2] == b'\r\n':
+            break
+        mo = header_match(data, pos)
+        if mo is None:
+            if pos >= end:
+                raise ParseError('Message headers are not terminated.')
+            raise ParseError(
+                'Bad header line in message at offset %d: %r.' % (
+                    pos, bytes(data[pos:pos + 80])))
+        header_spans.append(mo.span(1) + mo.span(2))
+        pos = mo.end()
+
+    return MessageScan(data, startline_end, header_spans, pos + 2)
@@ -15,23 +15,122 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 import logging
+import re
 from six import (add_metaclass, binary_type as bytes)
-from socket import SOCK_DGRAM
+from socket import (error as socket_error, SOCK_DGRAM, SOCK_STREAM)
+import threading
+from weakref import WeakValueDictionary
 from ..classmaker import classbuilder
 from ..parse import ParseError
 from ..transport import (
-    IsValidTransportName, Transport, SocketOwner, SockTypeFromName,
-    UnregisteredPortGenerator)
-from ..util import (abytes, DerivedProperty)
+    IsValidTransportName, SOCK_TYPE_IP_NAMES, Transport, SocketOwner,
+    SockTypeFromName, UnregisteredPortGenerator)
+from ..fsm import UnexpectedInput
+from ..util import (
+    abytes, astr, DerivedProperty, ShardedWorkerPool, StripedDict,
+    WeakMethod)
 from . import prot
 from .components import AOR
 from .message import Message
+from .request import Request
+from .retransmissioncache import RetransmissionCache
 from .transaction import TransactionManager, TransactionTransport
 from . import Incomplete
 
 log = logging.getLogger(__name__)
 
+CallIDRE = re.compile(
+    b'^(?:call-id|i)[ \t]*:[ \t]*([^\r\n]*?)[ \t]*\r?$',
+    re.IGNORECASE | re.MULTILINE)
+
+
+def CallIDFromData(data):
+    """:returns:
+        The Call-ID of the SIP message in `data`, or `None`, without parsing
+        the message.
+    """
+    mo = CallIDRE.search(data)
+    if mo is None:
+        return None
+    return mo.group(1)
+
+
+# Routing key searches, which only look at the top of each header line so
+# may miss values that have been folded onto a continuation line, in which
+# case the message is routed by parsing it in full.
+RequestLineRE = re.compile(b'([A-Za-z]+) [^ \r\n]+ SIP/2\\.0\r\n')
+StatusLineRE = re.compile(b'SIP/2\\.0 ([1-6][0-9][0-9]) ')
+TopViaRE = re.compile(
+    b'^(?:via|v)[ \t]*:([^\r\n,]*)', re.IGNORECASE | re.MULTILINE)
+BranchParamRE = re.compile(
+    b';[ \t]*branch[ \t]*=[ \t]*([^ \t;,\r\n]+)', re.IGNORECASE)
+CSeqMethodRE = re.compile(
+    b'^cseq[ \t]*:[ \t]*[0-9]+[ \t]+([A-Za-z]+)',
+    re.IGNORECASE | re.MULTILINE)
+
+
+class RoutingKeys(object):
+    """The parts of a SIP message needed to find its transaction."""
+    __slots__ = ['method', 'code', 'branch', 'cseq_method']
+
+    def __init__(self, method, code, branch, cseq_method):
+        self.method = method
+        self.code = code
+        self.branch = branch
+        self.cseq_method = cseq_method
+
+    def isrequest(self):
+        return self.method is not None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (attr, getattr(self, attr)) for attr in self.__slots__))
+
+
+def RoutingKeysFromData(data):
+    """Find the routing keys of the SIP message in `data` without parsing
+    it.
+
+    :returns:
+        A `RoutingKeys` instance, or `None` if the start line, top Via branch
+        or CSeq method can't be found.
+    """
+    mo = SIPTransport.EOLEOLRE.search(data)
+    if mo is None:
+        return None
+    end = mo.start() + 2
+
+    method = code = None
+    mo = RequestLineRE.match(data)
+    if mo is not None:
+        method = getattr(Request.types, astr(mo.group(1)), None)
+        if method is None:
+            return None
+    else:
+        mo = StatusLineRE.match(data)
+        if mo is None:
+            return None
+        code = int(mo.group(1))
+
+    mo = TopViaRE.search(data, 0, end)
+    if mo is None:
+        return None
+    mo = BranchParamRE.search(data, mo.start(1), mo.end(1))
+    if mo is None:
+        return None
+    branch = mo.group(1)
+
+    mo = CSeqMethodRE.search(data, 0, end)
+    if mo is None:
+        return None
+    cseq_method = getattr(Request.types, astr(mo.group(1)), None)
+    if cseq_method is None:
+        return None
+
+    return RoutingKeys(method, code, branch, cseq_method)
+
 
 @add_metaclass(ABCMeta)
 class AORHandler(object):
@@ -56,6 +155,40 @@ class SIPTransport:
     #
     DefaultPort = 5060
     DefaultType = SOCK_DGRAM
+    EOLEOLRE = re.compile(b'\r\n\r\n')
+    LeadingEOLsRE = re.compile(b'(?:\r\n)+')
+    ContentLengthRE = re.compile(
+        b'\r\n(?:content-length|l)[ \t]*:[ \t]*([0-9]+)', re.IGNORECASE)
+
+    # RFC 3261 18.1.1: requests larger than this (or within 200 bytes of the
+    # path MTU, which we don't know) must be sent over a congestion
+    # controlled transport, so are sent over TCP instead of UDP. Set to None
+    # to always use the transport in the Via header.
+    MaxUDPRequestSize = 1300
+
+    # How many requests received over UDP to remember the responses to, and
+    # for how long in seconds, so that retransmissions of them are answered
+    # without being parsed. The TTL is timer J, the longest a non-INVITE
+    # server transaction resends its final response for. Set the size to 0
+    # to disable.
+    RetransmissionCacheSize = 1024
+    RetransmissionCacheTTL = 32
+
+    # RFC 5626 4.4.1 CRLF keepalives on outbound connections. The interval
+    # is slightly under the recommended 120 seconds since they aren't
+    # jittered.
+    ConnectionKeepaliveInterval = 110
+    ConnectionKeepaliveData = b'\r\n\r\n'
+    KeepalivePong = b'\r\n'
+
+    # If not 0, received messages are parsed and consumed on this many
+    # worker threads instead of the thread they were received on. Messages
+    # with the same Call-ID are handled by the same worker, so in order.
+    MessageWorkerCount = 0
+
+    # The most messages queued for each worker. Further datagrams are
+    # dropped (they will be retransmitted), and streams wait.
+    MessageQueueSize = 1000
 
     @classmethod
     def port_generator(cls):
@@ -66,8 +199,8 @@ class SIPTransport:
     #
     # =================== INSTANCE INTERFACE ==================================
     #
-    # Do not iterate over these dictionaries, as they are weak value
-    # dictionaries whose values may disappear at any time.
+    # These are StripedDicts keyed by dialog ID, so they can be changed from
+    # several threads; iterating over them iterates over a snapshot.
     provisionalDialogs = DerivedProperty("_sptr_provisionalDialogs")
     establishedDialogs = DerivedProperty("_sptr_establishedDialogs")
 
@@ -76,9 +209,27 @@ class SIPTransport:
 
         self.messages_sent = 0
         self.messages_received = 0
+        # Messages handled from their routing keys without being parsed.
+        self.messages_absorbed = 0
+        # Messages may be received on several message worker threads.
+        self._sptr_receivedLock = threading.Lock()
         self._sptr_messages = []
-        self._sptr_provisionalDialogs = {}
-        self._sptr_establishedDialogs = {}
+        self.retransmission_cache = None
+        if self.RetransmissionCacheSize:
+            self.retransmission_cache = RetransmissionCache(
+                self.RetransmissionCacheSize, self.RetransmissionCacheTTL)
+        self._sptr_provisionalDialogs = StripedDict(self.LockStripeCount)
+        self._sptr_establishedDialogs = StripedDict(self.LockStripeCount)
+
+        # Socket proxies for the streams requests were received on, by Via
+        # branch, so that responses can be sent back on them.
+        self._sptr_inboundStreams = WeakValueDictionary()
+
+        # Requests that were too large for UDP and queued on TCP connections
+        # that are still connecting, as lists of (UDP socket proxy, data)
+        # keyed by id() of the TCP socket proxy, to send using UDP if the
+        # connect fails.
+        self._sptr_udpFallbacks = {}
 
         # Dialog handler is keyed by AOR. This can't be a WeakValueDictionary
         # because generally methods are transient objects which will get
@@ -87,6 +238,18 @@ class SIPTransport:
         self._sptr_dialogHandlers = {}
         self.transaction_manager = TransactionManager(self)
 
+        # If not None, the `CallbackExecutor` that AOR handlers are called
+        # with. If it calls them asynchronously, the dialog is started when
+        # the handler has returned it.
+        self.aor_handler_executor = None
+        self._sptr_pendingHandlerCalls = {}
+
+        self.message_workers = None
+        if self.MessageWorkerCount:
+            self.message_workers = ShardedWorkerPool(
+                self.MessageWorkerCount, max_queue_size=self.MessageQueueSize,
+                name='SIP message worker')
+
     def listen_for_me(self, **kwargs):
 
         for val, default in (
@@ -140,32 +303,28 @@ class SIPTransport:
         if hasattr(dlg, "dialogID"):
             log.debug("Dialog is established.")
             did = dlg.dialogID
-            if pdid in pds:
+            with eds.lock_for(did):
+                if did not in eds:
+                    log.debug("  Dialog was not yet established.")
+                    eds[did] = dlg
+            if pds.pop(pdid, None) is not None:
                 log.debug("  Dialog was provisional.")
-                del pds[pdid]
-            if did not in eds:
-                log.debug("  Dialog was not yet established.")
-                eds[did] = dlg
 
         else:
             log.debug("Dialog is not established.")
-            if pdid not in pds:
-                log.debug("  Dialog is new.")
-                pds[pdid] = dlg
+            with pds.lock_for(pdid):
+                if pdid not in pds:
+                    log.debug("  Dialog is new.")
+                    pds[pdid] = dlg
 
     def removeDialog(self, dlg):
-        pdid = dlg.provisionalDialogID
-        pdids = self.provisionalDialogs
-        if pdid in pdids:
-            del pdids[pdid]
+        self.provisionalDialogs.pop(dlg.provisionalDialogID, None)
 
         try:
             did = dlg.dialogID
-            eds = self.establishedDialogs
-            if did in eds:
-                del eds[did]
         except AttributeError:
-            pass
+            return
+        self.establishedDialogs.pop(did, None)
 
     def send_message_with_transaction(self, msg, transaction_user,
                                       remote_port=None, **kwargs):
@@ -200,66 +359,104 @@ class SIPTransport:
     #
     def send_message(self, msg, name, port):
         log.debug("Send message -> %r type %s", (name, port), msg.type)
-
-        if not IsValidTransportName(name):
-            raise TypeError(
-                'remote_name %r is not a valid transport name (special name '
-                'or string)' % name)
-
-        sock_type = SockTypeFromName(msg.viaheader.transport)
-
-        sprxy = super(SIPTransport, self).get_send_from_address(
-            sock_type=sock_type, remote_name=name,
-            remote_port=port, owner=self)
-
-        ch = msg.contactheader
-        if not ch.address:
-            ch.address = abytes(sprxy.local_address.name)
-
-        if not ch.port:
-            ch.port = sprxy.local_address.port
-
-        try:
-            sprxy.send(bytes(msg))
-        except Incomplete:
-            super(SIPTransport, self).release_listen_address(
-                sprxy.local_address)
-            raise
-
+        sprxy, data = self._sptr_prepare_message(msg, name, port)
+        self._sptr_cache_response(msg, sprxy, data)
+        sprxy.send(data)
         self.messages_sent += 1
         return sprxy.local_address
 
-    def consume_data(self, local_addr, remote_addr, data):
+    def send_messages(self, messages):
+        """Send several messages at once.
+
+        :param messages:
+            An iterable of `(msg, name, port)` tuples, each as would be passed
+            to `send_message`.
+        :returns: A list of the local addresses the messages were sent from.
+
+        Messages for the same socket are queued on it together, so they are
+        sent in one go rather than one at a time.
+        """
+        by_proxy = OrderedDict()
+        laddrs = []
+        for msg, name, port in messages:
+            sprxy, data = self._sptr_prepare_message(msg, name, port)
+            self._sptr_cache_response(msg, sprxy, data)
+            by_proxy.setdefault(id(sprxy), (sprxy, []))[1].append(data)
+            laddrs.append(sprxy.local_address)
+
+        exceptions = []
+        for sprxy, datas in by_proxy.values():
+            try:
+                sprxy.send_many(datas)
+            except Exception as exc:
+                exceptions.append(exc)
+            self.messages_sent += len(datas)
+
+        if exceptions:
+            raise exceptions[0]
+        return laddrs
+
+    def consume_data(self, socket_proxy, remote_addr, data):
+        """Parse and consume the message at the start of `data`.
+
+        :returns:
+            The number of bytes used, which is 0 if `data` doesn't yet hold a
+            complete message. Messages are framed by the end of the headers
+            and the Content-Length, so several may be received on a stream in
+            one go.
+        """
         log.debug(
             "SIPTransport attempting to consume %d bytes.", len(data))
 
-        # SIP messages always have \r\n\r\n after the headers and before any
-        # bodies.
-        eoleol = b'\r\n\r\n'
+        # CRLFs between messages on a stream are keepalives (RFC 5626). A
+        # double CRLF "ping" is answered with a single CRLF "pong".
+        mo = self.LeadingEOLsRE.match(data)
+        if mo is not None:
+            if (mo.end() >= 4 and
+                    socket_proxy.local_address.sock_type == SOCK_STREAM):
+                log.debug('Keepalive ping from %s', remote_addr)
+                try:
+                    socket_proxy.send_keepalive(self.KeepalivePong)
+                except socket_error as exc:
+                    log.warning('Exception sending keepalive pong: %s', exc)
+            return mo.end()
 
-        eoleol_index = data.find(eoleol)
-        if eoleol_index == -1:
+        # SIP messages always have \r\n\r\n after the headers and before any
+        # bodies. data may be a memoryview, which has no find(), hence re.
+        is_stream = socket_proxy.local_address.sock_type == SOCK_STREAM
+        mo = self.EOLEOLRE.search(data)
+        if mo is None:
             # No possibility of a full message yet.
-            log.warning("Data not a full SIP message.")
+            if not is_stream:
+                log.warning("Data not a full SIP message.")
             return 0
 
-        # We've probably got a full message, so parse it.
+        headers_end = mo.end()
+        mo = self.ContentLengthRE.search(data, 0, headers_end)
+        msg_len = headers_end + (0 if mo is None else int(mo.group(1)))
+        if is_stream:
+            if len(data) < msg_len:
+                log.debug(
+                    "Have %d bytes of a %d byte message", len(data), msg_len)
+                return 0
+            data = data[:msg_len]
+        elif self._sptr_resend_cached_response(data):
+            return msg_len
+
+        # We've probably got a full message.
         log.debug("Full message")
-        try:
-            msg = Message.Parse(data)
-            log.debug("Message parsed.")
-        except ParseError as pe:
-            log.error("Parse errror %s parsing message.", pe)
-            return 0
-
-        self.messages_received += 1
-        try:
-            self.consumeMessage(msg)
-        except Exception:
-            log.exception(
-                "Consuming %s message raised exception.", msg.type)
-
-        return msg.parsedBytes
+        workers = self.message_workers
+        if workers is None:
+            self._sptr_consume_message_data(socket_proxy, data)
+            return msg_len
+
+        # data is only valid during this call.
+        data = bytes(data)
+        workers.submit(
+            CallIDFromData(data),
+            WeakMethod(self, '_sptr_consume_message_data'),
+            (socket_proxy, data), block=is_stream)
+        return msg_len
 
     def consumeMessage(self, msg):
         self._sptr_messages.append(msg)
@@ -305,16 +502,29 @@ class SIPTransport:
 
         hdlr = hdlrs[to_aor_bytes]
 
-        dlg = hdlr.new_dialog_from_request(msg)
-        if dlg is None:
-            log.warning(
-                'Dropped dialog creating %s message as not wanted by AOR '
-                'handler', msg.type)
+        executor = self.aor_handler_executor
+        if executor is None:
+            dlg = hdlr.new_dialog_from_request(msg)
+        elif executor.is_inline:
+            dlg = executor.call(
+                'new_dialog_from_request', hdlr.new_dialog_from_request, msg)
+        else:
+            # Retransmissions of the request while the handler is working
+            # are for the same transaction, and so are on the same thread.
+            pending = self._sptr_pendingHandlerCalls
+            if id(trns) in pending:
+                log.debug(
+                    'Drop retransmitted %s while AOR handler is busy',
+                    msg.type)
+                return
+            pending[id(trns)] = trns
+            future = executor.call(
+                'new_dialog_from_request', hdlr.new_dialog_from_request, msg)
+            future.add_done_callback(WeakMethod(
+                self, '_sptr_aor_handler_done', static_args=(msg, trns)))
             return
 
-        trns.transaction_user = dlg
-        trns.consume_message(msg)
-        self.updateDialogGrouping(dlg)
+        self._sptr_start_dialog(msg, trns, dlg)
 
     def consumeInDialogMessage(self, msg, trns):
         estDs = self.establishedDialogs
@@ -355,11 +565,275 @@ class SIPTransport:
             'provisional dialogs: %r, established dialogs: %r' % (
                 did, provDs.keys(), estDs.keys()))
 
+    #
+    # =================== SOCKET OWNER INTERFACE ==============================
+    #
+    def handle_connect_failure(self, socket_proxy, exception, unsent_data):
+        fallbacks = self._sptr_udpFallbacks.pop(id(socket_proxy), ())
+        if not fallbacks:
+            return super(SIPTransport, self).handle_connect_failure(
+                socket_proxy, exception, unsent_data)
+
+        # RFC 3261 18.1.1 allows falling back to UDP if TCP fails.
+        log.warning(
+            'Failed to connect %s, send %d requests using UDP: %s',
+            socket_proxy.local_address, len(fallbacks), exception)
+        for udp_sprxy, data in fallbacks:
+            try:
+                udp_sprxy.send(data)
+            except socket_error as exc:
+                log.warning('Exception sending request using UDP: %s', exc)
+
+    def handle_closed_socket(self, socket_proxy):
+        self._sptr_udpFallbacks.pop(id(socket_proxy), None)
+        super(SIPTransport, self).handle_closed_socket(socket_proxy)
+
+    def handle_terminal_socket_exception(self, socket_proxy, exception):
+        self._sptr_udpFallbacks.pop(id(socket_proxy), None)
+        super(SIPTransport, self).handle_terminal_socket_exception(
+            socket_proxy, exception)
+
     #
     # =================== MAGIC METHODS =======================================
     #
     def __del__(self):
+        if self.message_workers is not None:
+            self.message_workers.stop(wait=False)
         log.info(
             'DELETE %s instance, messages received: %d, messages sent: %d',
             type(self).__name__, self.messages_received, self.messages_sent)
         super(SIPTransport, self).__del__()
+
+    #
+    # =================== INTERNAL METHODS ====================================
+    #
+    def _sptr_count_received(self, absorbed=False):
+        with self._sptr_receivedLock:
+            self.messages_received += 1
+            if absorbed:
+                self.messages_absorbed += 1
+
+    def _sptr_prepare_message(self, msg, name, port):
+        """Find the socket proxy to send `msg` from, fill in the contact
+        address from it and serialize `msg`.
+
+        :returns: The socket proxy and the message data.
+        """
+        if not IsValidTransportName(name):
+            raise TypeError(
+                'remote_name %r is not a valid transport name (special name '
+                'or string)' % name)
+
+        sock_type = SockTypeFromName(msg.viaheader.transport)
+        if sock_type == SOCK_STREAM and msg.isresponse():
+            # RFC 3261 18.2.2: send the response on the connection the
+            # request came in on if it's still there.
+            branch = self._sptr_via_branch(msg)
+            streams = self._sptr_inboundStreams
+            sprxy = streams.get(branch)
+            if sprxy is not None:
+                if msg.type >= 200:
+                    streams.pop(branch, None)
+                return sprxy, self._sptr_serialize_message(msg, sprxy)
+
+        sprxy = super(SIPTransport, self).get_send_from_address(
+            sock_type=sock_type, remote_name=name,
+            remote_port=port, owner=self)
+        data = self._sptr_serialize_message(msg, sprxy)
+
+        max_udp = self.MaxUDPRequestSize
+        if (max_udp is None or sock_type != SOCK_DGRAM or
+                len(data) <= max_udp or not msg.isrequest()):
+            return sprxy, data
+
+        log.debug(
+            '%d byte %s request is too large for UDP, use TCP', len(data),
+            msg.type)
+        udp_via_transport = msg.viaheader.transport
+        msg.viaheader.transport = SOCK_TYPE_IP_NAMES.TCP
+        try:
+            tcp_sprxy = super(SIPTransport, self).get_send_from_address(
+                sock_type=SOCK_STREAM, remote_name=name,
+                remote_port=port, owner=self)
+        except socket_error as exc:
+            # RFC 3261 18.1.1 allows falling back to UDP if TCP fails.
+            log.warning(
+                'Failed to send %s request using TCP, use UDP: %s', msg.type,
+                exc)
+            msg.viaheader.transport = udp_via_transport
+            return sprxy, bytes(msg)
+
+        tcp_data = self._sptr_serialize_message(msg, tcp_sprxy)
+        if tcp_sprxy.is_connecting:
+            msg.viaheader.transport = udp_via_transport
+            self._sptr_udpFallbacks.setdefault(id(tcp_sprxy), []).append(
+                (sprxy, bytes(msg)))
+            msg.viaheader.transport = SOCK_TYPE_IP_NAMES.TCP
+        return tcp_sprxy, tcp_data
+
+    def _sptr_aor_handler_done(self, msg, trns, future):
+        self._sptr_pendingHandlerCalls.pop(id(trns), None)
+        try:
+            dlg = future.result()
+        except Exception:
+            # The executor has logged it.
+            return
+
+        try:
+            self._sptr_start_dialog(msg, trns, dlg)
+        except Exception:
+            log.exception(
+                "Starting dialog for %s message raised exception.", msg.type)
+
+    def _sptr_start_dialog(self, msg, trns, dlg):
+        if dlg is None:
+            log.warning(
+                'Dropped dialog creating %s message as not wanted by AOR '
+                'handler', msg.type)
+            return
+
+        trns.transaction_user = dlg
+        trns.consume_message(msg)
+        self.updateDialogGrouping(dlg)
+
+    def _sptr_consume_message_data(self, socket_proxy, data):
+        keys = RoutingKeysFromData(data)
+        if keys is not None and self._sptr_absorb_message(
+                socket_proxy, keys):
+            return
+
+        try:
+            msg = Message.Parse(data)
+            log.debug("Message parsed.")
+        except ParseError as pe:
+            log.error("Parse errror %s parsing message.", pe)
+            return
+
+        self._sptr_count_received()
+        if msg.isrequest():
+            if socket_proxy.local_address.sock_type == SOCK_STREAM:
+                branch = self._sptr_via_branch(msg)
+                if branch is not None:
+                    self._sptr_inboundStreams[branch] = socket_proxy
+            else:
+                self._sptr_cache_request(msg, data)
+
+        try:
+            self.consumeMessage(msg)
+        except Exception:
+            log.exception(
+                "Consuming %s message raised exception.", msg.type)
+
+    def _sptr_absorb_message(self, socket_proxy, keys):
+        """Handle messages that don't need parsing, which are retransmitted
+        requests, whose transaction doesn't need the message once it has
+        started, and responses for which there is no transaction.
+
+        :returns: Whether the message was absorbed.
+        """
+        tm = self.transaction_manager
+        if keys.isrequest():
+            trns = tm.lookup_transaction_for_routing_keys('server', keys)
+            if trns is None or trns.state == trns.States.Initial:
+                return False
+        elif tm.lookup_transaction_for_routing_keys(
+                'client', keys) is not None:
+            return False
+        else:
+            trns = None
+
+        self._sptr_count_received(absorbed=True)
+        if trns is None:
+            log.warning(
+                'Discarding %d response to %s with no transaction.',
+                keys.code, keys.cseq_method)
+            return True
+
+        log.debug(
+            'Absorb retransmitted %s request for transaction in state %s',
+            keys.method, trns.state)
+        if socket_proxy.local_address.sock_type == SOCK_STREAM:
+            self._sptr_inboundStreams[keys.branch] = socket_proxy
+        try:
+            trns.consume_retransmitted_request(keys.method)
+        except UnexpectedInput as exc:
+            log.debug('Retransmission ignored: %s', exc)
+        return True
+
+    def _sptr_cache_request(self, msg, data):
+        cache = self.retransmission_cache
+        if cache is None or msg.type == msg.types.ACK:
+            return
+        try:
+            tid = self.transaction_manager.transaction_key_for_message(
+                'server', msg)
+        except (AttributeError, ValueError):
+            return
+        cache.add_request(cache.Digest(data), tid)
+
+    def _sptr_cache_response(self, msg, sprxy, data):
+        cache = self.retransmission_cache
+        if (cache is None or not msg.isresponse() or
+                sprxy.local_address.sock_type != SOCK_DGRAM):
+            return
+        try:
+            tid = self.transaction_manager.transaction_key_for_message(
+                'server', msg)
+        except (AttributeError, ValueError):
+            return
+        cache.add_response(tid, sprxy, data)
+
+    def _sptr_resend_cached_response(self, data):
+        """Resend the response to `data` if it is a retransmission of a
+        request we've answered.
+
+        :returns: Whether the response was resent.
+        """
+        cache = self.retransmission_cache
+        if cache is None:
+            return False
+
+        record = cache.lookup(
+            cache.Digest(data), self._sptr_transaction_resends_response)
+        if record is None:
+            return False
+
+        tid, sprxy, response_data = record
+        log.debug('Resend cached response for transaction %s', tid)
+        self._sptr_count_received(absorbed=True)
+        try:
+            sprxy.send(response_data)
+        except socket_error as exc:
+            log.warning('Exception resending cached response: %s', exc)
+            return True
+        self.messages_sent += 1
+        return True
+
+    def _sptr_transaction_resends_response(self, tid):
+        trns = self.transaction_manager.transactions.get(tid)
+        if trns is None:
+            return False
+        states = trns.States
+        return trns.state in (states.proceeding, states.completed)
+
+    def _sptr_serialize_message(self, msg, sprxy):
+        ch = msg.contactheader
+        if not ch.address:
+            ch.address = abytes(sprxy.local_address.name)
+
+        if not ch.port:
+            ch.port = sprxy.local_address.port
+
+        try:
+            return bytes(msg)
+        except Incomplete:
+            super(SIPTransport, self).release_listen_address(
+                sprxy.local_address)
+            raise
+
+    @staticmethod
+    def _sptr_via_branch(msg):
+        try:
+            return msg.ViaHeader.parameters.branch.value
+        except AttributeError:
+            return None
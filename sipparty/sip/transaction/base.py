@@ -17,12 +17,13 @@ limitations under the License.
 from abc import ABCMeta, abstractmethod
 import logging
 
-from six import add_metaclass
+from six import (add_metaclass, iteritems)
 
 from ...deepclass import (dck, DeepClass)
 from ...transport import IsValidPortNum
 from ...util import Enum, WeakProperty
 from ...fsm import AsyncFSM, UnexpectedInput
+from ..prot import ResponseCodeTable
 from ..standardtimers import StandardTimers
 from .errors import NoTransport
 
@@ -100,10 +101,23 @@ class Transaction(
 
     types = Enum(('client', 'server'))
 
+    # The prefixes of response inputs, which are followed by the response
+    # code or its leading digits, e.g. 'response_18'.
+    ResponseInputPrefixes = ('response_', 'respond_')
+
     # States common to all transactions.
     Inputs = Enum(('request', 'transport_error'))
     States = Enum(('proceeding', 'completed', 'terminated'))
 
+    @classmethod
+    def PrecomputeClassTables(cls):
+        # Work out which input each response code is for in each state now,
+        # rather than for each response.
+        cls._trns_responseInputTables = dict(
+            ((state, prefix), ResponseCodeTable.ForInputs(trans, prefix))
+            for state, trans in iteritems(cls._fsm_transitions)
+            for prefix in cls.ResponseInputPrefixes)
+
     @property
     def type(self):
         raise NotImplemented
@@ -227,16 +241,16 @@ class Transaction(
         `'response', 200` will find input `'response_200'`, `404` will find
         input `'response_4'`.
         """
-        next_rtype = int(rtype)
-        while next_rtype > 0:
-            inp = prepend + str(next_rtype)
-            if inp in self._fsm_transitions[self._fsm_state]:
-                return inp
-            next_rtype = int(next_rtype / 10)
-
-        # Try catch all.
-        inp = prepend + 'xxx'
-        if inp in self._fsm_transitions[self._fsm_state]:
+        state = self._fsm_state
+        if '_fsm_transitions' in self.__dict__:
+            # We have our own transitions so can't use the class's tables.
+            table = ResponseCodeTable.ForInputs(
+                self._fsm_transitions.get(state, ()), prepend)
+        else:
+            table = self._trns_responseInputTables.get((state, prepend))
+
+        inp = None if table is None else table.lookup(int(rtype))
+        if inp is not None:
             return inp
 
         # Couldn't find one. Raise.
@@ -16,7 +16,7 @@ limitations under the License.
 """
 import logging
 
-from ...util import WeakMethod, WeakProperty
+from ...util import StripedDict, WeakMethod, WeakProperty
 from ..prot import TransactionID
 from .base import Transaction
 from .client import (
@@ -32,6 +32,12 @@ log = logging.getLogger(__name__)
 class TransactionManager(object):
 
     lookup_sentinel = type('TransactionManagerLookupSentinel', (), {})()
+
+    # The number of independently locked partitions of the transaction
+    # table, so that messages for different transactions can be handled on
+    # different threads without contending.
+    LockStripeCount = 16
+
     transport = WeakProperty('transport')
 
     @classmethod
@@ -64,19 +70,13 @@ class TransactionManager(object):
         :param args:
         """
         self.transport = transport
-        self.transactions = {}
+        self.transactions = StripedDict(self.LockStripeCount)
         self.terminated_transactions = {}
 
     def transaction_for_inbound_message(self, msg, **kwargs):
         if msg.isrequest():
             log.debug('Gt inbound server transaction for request %s', msg.type)
-            trans = self.lookup_transaction(
-                'server', msg, raise_on_missing=False)
-            if trans is not None:
-                log.debug('Got existing transaction')
-                return trans
-
-            return self._new_transaction('server', msg, **kwargs)
+            return self._lookup_or_new_transaction('server', msg, **kwargs)
 
         log.debug('Get inbound client trans for response %d', msg.type)
         return self.lookup_transaction('client', msg)
@@ -84,21 +84,10 @@ class TransactionManager(object):
     def transaction_for_outbound_message(self, msg, **kwargs):
         if msg.isrequest():
             log.debug('Get outbound client trans for request %s', msg.type)
-            trans = self.lookup_transaction(
-                'client', msg, raise_on_missing=False)
-            if trans is not None:
-                log.debug('Got existing transaction')
-                return trans
-
-            return self._new_transaction('client', msg, **kwargs)
+            return self._lookup_or_new_transaction('client', msg, **kwargs)
 
         log.debug('Get outbound server trans for response %d', msg.type)
-        trans = self.lookup_transaction('server', msg, raise_on_missing=False)
-        if trans is not None:
-            log.debug('Return existing server transaction for outbound msg')
-            return trans
-
-        return self._new_transaction('server', msg, **kwargs)
+        return self._lookup_or_new_transaction('server', msg, **kwargs)
 
     def __del__(self):
         log.info('DELETE TransactionManager')
@@ -131,9 +120,31 @@ class TransactionManager(object):
                     ttype, tk, message.type))
         return trans
 
+    def lookup_transaction_for_routing_keys(self, ttype, keys):
+        """Lookup a transaction for a message that hasn't been parsed.
+
+        :param keys: The message's `RoutingKeys`.
+        :returns: The transaction, or `None` if there isn't one.
+        """
+        assert ttype in Transaction.types
+        return self.transactions.get(
+            TransactionID(ttype, keys.branch, keys.cseq_method))
+
     def transaction_terminated(self, key, *args, **kwargs):
         log.info('Dropping terminated transaction %s', key)
-        del self.transactions[key]
+        self.transactions.pop(key, None)
+
+    def _lookup_or_new_transaction(self, ttype, msg, **kwargs):
+        # Hold the key's stripe lock so that two threads handling the same
+        # message can't both create a transaction for it.
+        tk = self.transaction_key_for_message(ttype, msg)
+        with self.transactions.lock_for(tk):
+            trans = self.transactions.get(tk)
+            if trans is not None:
+                log.debug('Got existing %s transaction', ttype)
+                return trans
+
+            return self._new_transaction(ttype, msg, **kwargs)
 
     def _new_transaction(self, ttype, msg, **kwargs):
         assert ttype in Transaction.types
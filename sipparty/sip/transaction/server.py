@@ -30,6 +30,15 @@ class ServerTransaction(Transaction):
 
     type = Transaction.types.server
 
+    def consume_retransmitted_request(self, method):
+        """Consume a retransmission of the request, or ACK, that the
+        transaction is for. Once the transaction has started it doesn't need
+        the message itself, so it need not have been parsed.
+        """
+        if method == 'ACK':
+            return self.hit('ack')
+        return self.hit(self.Inputs.request)
+
 
 class InviteServerTransaction(ServerTransaction):
     """Server Transaction for an INVITE request."""
@@ -18,13 +18,20 @@ limitations under the License.
 """
 import logging
 from numbers import Integral
+from six import iteritems
 from ..util import Enum
+from .prot import ResponseCodeTable
 
 log = logging.getLogger(__name__)
 
 TransformKeys = Enum(("Copy", "Add", "CopyFrom"))
 Tfk = TransformKeys
 
+# Response code tables for the transform dictionaries, by dictionary id. The
+# dictionaries are kept here too, so the ids aren't reused, and must not be
+# changed once they have been used.
+_ResponseCodeTables = {}
+
 
 def raiseActTupleError(tp, msg):
     raise ValueError(
@@ -83,18 +90,25 @@ def LookupTransform(transforms, qutype, anstype):
     return answer_tform
 
 
+def _ResponseCodeTable(dicts):
+    entry = _ResponseCodeTables.get(id(dicts))
+    if entry is None or entry[0] is not dicts:
+        entry = (dicts, ResponseCodeTable(dict(
+            (code, rdict) for code, rdict in iteritems(dicts)
+            if isinstance(code, Integral))))
+        _ResponseCodeTables[id(dicts)] = entry
+    return entry[1]
+
+
 def _FindTypeDict(dicts, typ):
 
     if isinstance(typ, Integral):
-        while typ > 0:
-            if typ in dicts:
-                rdict = dicts[typ]
-                return rdict
-            typ /= 10
-        else:
+        rdict = _ResponseCodeTable(dicts).lookup(typ)
+        if rdict is None:
             raise KeyError(
                 "Transform dictionary %r does not contain type %r" % (
                     dicts, typ))
+        return rdict
 
     if typ not in dicts:
         raise KeyError(
@@ -32,7 +32,9 @@ from ..transport.mocksock import SocketMock
 from ..util import Timeout, WaitFor
 if PY2:
     from mock import (ANY, MagicMock, Mock, patch)  # noqa
+    asyncio = None
 else:
+    import asyncio
     from unittest.mock import (ANY, MagicMock, Mock, patch)  # noqa
 
 log = logging.getLogger(__name__)
@@ -86,6 +88,9 @@ class SIPPartyTestCase(TestCaseREMixin, unittest.TestCase):
         pp = patch.object(retrythread, 'Clock', new=self.Clock)
         pp.start()
         self.addCleanup(pp.stop)
+        pp = patch.object(transport_base, 'Clock', new=self.Clock)
+        pp.start()
+        self.addCleanup(pp.stop)
         self.clock_time = 0
         self.addCleanup(setattr, self, 'clock_time', 0)
 
@@ -100,6 +105,35 @@ class SIPPartyTestCase(TestCaseREMixin, unittest.TestCase):
             retrythread, 'select', new=retry_thread_select)
         select_patch.start()
         self.addCleanup(select_patch.stop)
+        self.patch_retrythread_poller()
+
+    def patch_retrythread_poller(self):
+        """Make RetryThreads use select, so that patching it works."""
+        poller_patch = patch.object(
+            RetryThread, 'poller_type', new=retrythread._SelectPoller)
+        poller_patch.start()
+        self.addCleanup(poller_patch.stop)
+
+    def patch_event_loop(self):
+        """Make new RetryThreads run on a new asyncio event loop.
+
+        :returns: The event loop.
+        """
+        if asyncio is None:
+            self.skipTest('asyncio is not available.')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop_patch = patch.object(RetryThread, 'event_loop', new=loop)
+        loop_patch.start()
+        self.addCleanup(loop_patch.stop)
+        return loop
+
+    def run_event_loop_until(self, loop, condition, timeout_s=1):
+        for _ in range(int(timeout_s * 100)):
+            if condition():
+                return
+            loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+        self.assertTrue(condition(), "Condition did not become true.")
 
     def patch_socket(self):
         SocketMock.test_case = self
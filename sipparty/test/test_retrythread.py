@@ -26,6 +26,8 @@ import threading
 from weakref import ref
 
 from six import PY2
+if not PY2:
+    import asyncio
 
 from ..fsm import retrythread
 from ..fsm.retrythread import RetryThread
@@ -62,6 +64,42 @@ class TestRetryThread(SIPPartyTestCase):
         WaitFor(lambda: rt._rthr_thread is None)
         log.info('Test done')
 
+    def test_retry_thread_output_fd(self):
+        self.sub_test_output_fd()
+
+    def test_retry_thread_output_fd_select(self):
+        self.patch_retrythread_poller()
+        self.sub_test_output_fd()
+
+    def sub_test_output_fd(self):
+        rt = RetryThread()
+        rr, ww = os.pipe()
+        self.addCleanup(os.close, rr)
+        self.addCleanup(os.close, ww)
+        writable = []
+
+        rt.addInputFD(rr, self.read_data)
+        rt.addOutputFD(ww, writable.append)
+        WaitFor(lambda: len(writable) > 0)
+        self.assertEqual(writable[0], ww)
+        self.assertRaises(KeyError, rt.addOutputFD, ww, writable.append)
+
+        rt.rmOutputFD(ww)
+        self.assertRaises(KeyError, rt.rmOutputFD, ww)
+
+        # Reading still works, and we're no longer told about writes (once
+        # any pass that was in progress has finished).
+        for data in (b'hello', b'again'):
+            writes = len(writable)
+            os.write(ww, data)
+            WaitFor(lambda: self.data_read is not None)
+            self.assertEqual(self.data_read, data)
+            self.data_read = None
+        self.assertEqual(len(writable), writes)
+
+        rt.rmInputFD(rr)
+        WaitFor(lambda: rt._rthr_thread is None)
+
     def test_retry_thread_tidy_up(self):
 
         rthr = RetryThread()
@@ -104,9 +142,7 @@ class TestRetryThread(SIPPartyTestCase):
         WaitFor(lambda: self.wrthr() is None)
         WaitFor(lambda: not self.wthr.is_alive())
 
-    def test_max_select_wait(self):
-
-        self.assertLess(RetryThread.max_select_wait, 20)
+    def test_select_wait(self):
 
         cvar = threading.Condition()
         self.do_cvar = True
@@ -124,13 +160,218 @@ class TestRetryThread(SIPPartyTestCase):
             retrythread, 'select', new=sel_patch)
         select_patch.start()
         self.addCleanup(select_patch.stop)
+        self.patch_retrythread_poller()
 
+        # With only FDs to wait for, the thread waits indefinitely.
+        self.assertIsNone(RetryThread.max_select_wait)
         rthr = RetryThread()
-        rthr.addRetryTime(20)
+        rr, ww = os.pipe()
+        self.addCleanup(os.close, ww)
+        self.addCleanup(os.close, rr)
+        rthr.addInputFD(rr, self.read_data)
         self.wait_for(lambda: sel_mock.call_count == 1)
+        sel_mock.assert_called_with(ANY, [], ANY, None)
+
+        # With a retry time, it waits just until that time.
+        rthr.addRetryTime(20)
+        with cvar:
+            cvar.notify()
+        self.wait_for(lambda: sel_mock.call_count == 2)
+        sel_mock.assert_called_with(ANY, [], ANY, 20)
+
+        # A later retry time doesn't need to wake the thread, but an earlier
+        # one does.
+        with patch.object(rthr, '_rthr_triggerSpin') as trigger_spin:
+            rthr.addRetryTime(40)
+            self.assertEqual(trigger_spin.call_count, 0)
+            rthr.addRetryTime(10)
+            self.assertEqual(trigger_spin.call_count, 1)
+
         del rthr
         self.do_cvar = False
         with cvar:
             cvar.notify()
 
-        sel_mock.assert_called_with(ANY, [], ANY, RetryThread.max_select_wait)
+    def test_targeted_handles(self):
+        self.patch_retrythread_select()
+
+        class Owner(object):
+            pass
+
+        generic_pops = []
+        popped = []
+        owner1, owner2 = Owner(), Owner()
+
+        rthr = RetryThread()
+        rthr.add_action(lambda: generic_pops.append(True))
+        rthr.addRetryTime(1, action=popped.append, owner=owner1)
+        handle2 = rthr.addRetryTime(1, action=popped.append, owner=owner2)
+        cancelled = rthr.addRetryTime(1, action=popped.append, owner=owner1)
+        cancelled.cancel()
+        self.assertFalse(cancelled.active)
+        rthr.addRetryTime(2, action=popped.append, owner=Owner())
+
+        # The last handle's owner has been freed, so it is dropped.
+        self.clock_time = 2
+        self.wait_for(lambda: len(rthr._rthr_retryTimes) == 0)
+        self.wait_for(lambda: len(popped) == 2)
+        self.assertEqual(popped, [owner1, owner2])
+        self.assertFalse(handle2.active)
+
+        # No generic retry times were added, so the generic actions should
+        # never have been called.
+        self.assertEqual(generic_pops, [])
+        rthr.addRetryTime(2)
+        self.wait_for(lambda: len(generic_pops) == 1)
+
+    def test_cancel_and_compact(self):
+        self.patch_retrythread_select()
+        rthr = RetryThread()
+        popped = []
+        handles = [
+            rthr.addRetryTime(10 + ii, action=lambda ii=ii: popped.append(ii))
+            for ii in range(10)]
+
+        for handle in handles[:5]:
+            handle.cancel()
+        self.assertEqual(rthr._rthr_cancelledCount, 5)
+        self.assertEqual(len(rthr._rthr_retryTimes), 10)
+
+        # One more cancelled handle takes us over the limit and the heap is
+        # compacted.
+        handles[5].cancel()
+        self.assertEqual(rthr._rthr_cancelledCount, 0)
+        self.assertEqual(len(rthr._rthr_retryTimes), 4)
+
+        self.clock_time = 20
+        self.wait_for(lambda: len(popped) == 4)
+        self.assertEqual(popped, [6, 7, 8, 9])
+        self.wait_for(lambda: len(rthr._rthr_retryTimes) == 0)
+
+    def test_cancel_while_popping(self):
+        rthr = RetryThread()
+        rthr._rthr_maybe_create = lambda: None
+        handle = rthr.addRetryTime(10, action=lambda: None)
+
+        log.info('Handle popped after being marked cancelled but before the '
+                 'thread is told.')
+        on_cancel = handle._rh_onCancel
+        handle._rh_onCancel = None
+        handle.cancel()
+        self.assertEqual(rthr._rthr_pop_due_handles(), [])
+        self.assertEqual(rthr._rthr_cancelledCount, 0)
+        on_cancel(handle)
+        self.assertEqual(rthr._rthr_cancelledCount, 0)
+        self.assertEqual(len(rthr._rthr_retryTimes), 0)
+        self.assertFalse(rthr._rthr_outstanding_work)
+
+        log.info('Handle cancelled normally and then dropped.')
+        handle = rthr.addRetryTime(10, action=lambda: None)
+        rthr.addRetryTime(20, action=lambda: None)
+        handle.cancel()
+        self.assertEqual(rthr._rthr_cancelledCount, 1)
+        rthr._rthr_pop_due_handles()
+        self.assertEqual(rthr._rthr_cancelledCount, 0)
+        self.assertEqual(len(rthr._rthr_retryTimes), 1)
+
+    def test_timer_slack(self):
+        rthr = RetryThread()
+        rthr.timer_slack = 0.5
+
+        # Don't start the thread so we can pop the handles ourselves.
+        rthr._rthr_maybe_create = lambda: None
+        for ii in range(3):
+            rthr.addRetryTime(1 + ii * 0.1, action=lambda: None)
+
+        self.clock_time = 0.5
+        self.assertEqual(rthr._rthr_pop_due_handles(), [])
+        self.assertEqual(rthr._rthr_next_wait, 1.0)
+
+        self.clock_time = 1.5
+        self.assertEqual(len(rthr._rthr_pop_due_handles()), 3)
+        self.assertIsNone(rthr._rthr_next_wait)
+
+    def test_event_loop(self):
+        loop = self.patch_event_loop()
+        rthr = RetryThread()
+        self.assertTrue(rthr.uses_event_loop)
+        rr, ww = os.pipe()
+        self.addCleanup(os.close, rr)
+        self.addCleanup(os.close, ww)
+        threads = []
+
+        def read_data(fd):
+            threads.append(threading.current_thread())
+            self.read_data(fd)
+
+        def pop(name):
+            threads.append(threading.current_thread())
+            popped.append(name)
+
+        log.info('FD sources and retry times are run by the event loop.')
+        popped = []
+        rthr.addInputFD(rr, read_data)
+        rthr.addRetryTime(0.02, action=lambda: pop('second'))
+        rthr.addRetryTime(0.01, action=lambda: pop('first'))
+        rthr.addRetryTime(0.03, action=lambda: pop('cancelled')).cancel()
+        os.write(ww, b'hello')
+        self.clock_time = 1
+        self.run_event_loop_until(
+            loop, lambda: self.data_read is not None and len(popped) == 2)
+        self.assertEqual(self.data_read, b'hello')
+        self.assertEqual(popped, ['first', 'second'])
+        self.assertEqual(set(threads), set([threading.current_thread()]))
+        self.assertIsNone(rthr._rthr_thread)
+
+        log.info('Handles added by popping handles are scheduled.')
+        rthr.addRetryTime(
+            0, action=lambda: rthr.addRetryTime(0, action=lambda: pop('3')))
+        self.run_event_loop_until(loop, lambda: len(popped) == 3)
+
+        rthr.rmInputFD(rr)
+        os.write(ww, b'again')
+        self.data_read = None
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+        self.assertIsNone(self.data_read)
+
+    def test_separate_timer_thread(self):
+        pp = patch.object(RetryThread, 'separate_timer_thread', new=True)
+        pp.start()
+        self.addCleanup(pp.stop)
+        rthr = RetryThread()
+        self.assertTrue(rthr.uses_separate_timer_thread)
+        rr, ww = os.pipe()
+        self.addCleanup(os.close, rr)
+        self.addCleanup(os.close, ww)
+        threads = []
+        popped = []
+
+        def read_data(fd):
+            threads.append(threading.current_thread())
+            self.read_data(fd)
+
+        def pop(name):
+            threads.append(threading.current_thread())
+            popped.append(name)
+
+        log.info('Retry times are waited for by the timer thread.')
+        rthr.addInputFD(rr, read_data)
+        self.clock_time = 1
+        rthr.addRetryTime(0.75, action=lambda: pop('second'))
+        rthr.addRetryTime(0.5, action=lambda: pop('first'))
+        rthr.addRetryTime(5, action=lambda: pop('later'))
+        os.write(ww, b'hello')
+        self.wait_for(lambda: self.data_read is not None and len(popped) == 2)
+        self.assertEqual(popped, ['first', 'second'])
+
+        log.info('But all the actions are run by the FD thread.')
+        self.assertEqual(set(threads), set([rthr._rthr_thread]))
+        self.assertEqual(rthr.timer_pops, 2)
+        self.assertAlmostEqual(rthr.timer_lateness_max, 0.5)
+        self.assertAlmostEqual(rthr.timer_lateness_mean, 0.375)
+
+        log.info('An earlier retry time wakes the timer thread.')
+        rthr.addRetryTime(1, action=lambda: pop('third'))
+        self.wait_for(lambda: len(popped) == 3)
+        self.assertEqual(popped[-1], 'third')
+        rthr.rmInputFD(rr)
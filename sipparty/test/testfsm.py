@@ -24,8 +24,8 @@ import threading
 from time import sleep
 from weakref import ref
 from ..fsm import (
-    AsyncFSM, FSM, FSMTimeout, InitialStateKey, LockedFSM, Timer,
-    TransitionKeys, UnexpectedInput)
+    AsyncFSM, CallbackExecutor, FSM, FSMTimeout, InitialStateKey, LockedFSM,
+    ThreadPoolCallbackExecutor, Timer, TransitionKeys, UnexpectedInput)
 from ..util import (Enum, WaitFor)
 from .base import (MagicMock, SIPPartyTestCase)
 
@@ -503,6 +503,110 @@ class TestFSM(TestFSMBase):
 
         WaitFor(lambda: thr_res[0] == 8 * 2)
 
+    def test_thread_pool(self):
+        release = threading.Event()
+        runs = []
+
+        class PoolFSM(FSM):
+            ThreadPoolSize = 1
+
+            @classmethod
+            def AddClassTransitions(cls):
+                cls.addTransition(
+                    "not_running", "start", "running",
+                    start_threads=["block"])
+                cls.addTransition(
+                    "not_running", "retry", "running",
+                    start_threads=["retry_forever"])
+                cls._fsm_state = "not_running"
+
+            def block(self):
+                runs.append(threading.current_thread())
+                release.wait()
+
+            def retry_forever(self):
+                runs.append(self)
+                return 0.01
+
+        pool = PoolFSM.thread_pool()
+        self.assertIs(PoolFSM.thread_pool(), pool)
+        self.assertEqual(pool.max_workers, 1)
+
+        log.info('Thread actions queue for the one worker.')
+        fsms = [PoolFSM() for _ in range(3)]
+        for fsm in fsms:
+            fsm.hit('start')
+        WaitFor(lambda: pool.active_workers == 1 and pool.queue_depth == 2)
+        self.assertEqual(pool.submitted, 3)
+        release.set()
+        WaitFor(lambda: pool.completed == 3)
+        self.assertEqual(pool.active_workers, 0)
+        self.assertEqual(len(set(runs)), 1)
+
+        log.info('Retrying thread actions only hold a worker while they '
+                 'run, so they all get to run.')
+        del runs[:]
+        retry_fsms = [PoolFSM() for _ in range(3)]
+        for fsm in retry_fsms:
+            fsm.hit('retry')
+
+        def all_retried():
+            self.clock_time += 0.01
+            return all(runs.count(fsm) >= 2 for fsm in retry_fsms)
+
+        WaitFor(all_retried)
+
+        log.info('Cancelling stops thread actions waiting to retry.')
+        for fsm in retry_fsms:
+            fsm.cancel_threads()
+        WaitFor(lambda: pool.active_workers == 0 and pool.queue_depth == 0)
+        run_count = len(runs)
+        for fsm in retry_fsms:
+            self.assertFalse(any(
+                handle.active
+                for handle in fsm._fsm_threadActionRetries.values()))
+        self.assertEqual(len(runs), run_count)
+
+    def test_shared_class_tables(self):
+
+        class SharedFSM(FSM):
+            FSMDefinitions = {
+                InitialStateKey: {
+                    'start': {
+                        TransitionKeys.NewState: 'running',
+                        TransitionKeys.StartTimers: ['running_timer']
+                    }
+                },
+                'running': {}
+            }
+            FSMTimers = {
+                'running_timer': (lambda: None, lambda: iter((1,)))
+            }
+
+        fsm1 = SharedFSM()
+        fsm2 = SharedFSM()
+        log.info('Instances share the class\'s tables and make no timers.')
+        self.assertIs(fsm1._fsm_transitions, SharedFSM._fsm_transitions)
+        self.assertIs(fsm1.Inputs, SharedFSM.Inputs)
+        self.assertNotIn('_fsm_timerInstances', fsm1.__dict__)
+
+        log.info('An instance that adds a transition gets its own copy.')
+        fsm1.addTransition('running', 'stop', InitialStateKey)
+        self.assertIsNot(fsm1._fsm_transitions, SharedFSM._fsm_transitions)
+        self.assertIn('stop', fsm1.Inputs)
+        self.assertNotIn('stop', fsm2.Inputs)
+        self.assertNotIn('running', SharedFSM._fsm_transitions)
+
+        log.info('Timers are created per instance when first used.')
+        fsm1.hit('start')
+        fsm2.hit('start')
+        self.assertIsNot(
+            fsm1._fsm_timer('running_timer'),
+            fsm2._fsm_timer('running_timer'))
+        fsm1.hit('stop')
+        self.assertEqual(fsm1.state, InitialStateKey)
+        self.assertRaises(UnexpectedInput, fsm2.hit, 'stop')
+
     def testWaitFor(self):
         fsm = AsyncFSM()
         self.assertRaises(
@@ -830,6 +934,41 @@ class TestFSMDelegate(TestFSMBase):
         tfsm.hit('start')
         self.assertEqual(self.dele_action_called, 1)
 
+    def test_delegate_executor(self):
+
+        def new_fsm(executor):
+            tfsm = LockedFSM()
+            tfsm.delegate = self
+            tfsm.delegate_executor = executor
+            tfsm.addTransition(
+                tfsm.States.Initial, 'start', 'Running', action='action')
+            tfsm.addTransition('Running', 'done', 'Finished')
+            return tfsm
+
+        log.info('The inline executor records latencies.')
+        tfsm = new_fsm(CallbackExecutor())
+        tfsm.hit('start')
+        self.assertEqual(self.dele_action_called, 1)
+        latency = tfsm.delegate_executor.latencies()['fsm_dele_action']
+        self.assertEqual(latency.count, 1)
+
+        log.info('A pooled delegate hits the FSM when it is done.')
+        executor = ThreadPoolCallbackExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        tfsm = new_fsm(executor)
+        caller_thread = threading.current_thread()
+        threads = []
+
+        def fsm_dele_action(fsm):
+            threads.append(threading.current_thread())
+            fsm.hit('done')
+
+        self.fsm_dele_action = fsm_dele_action
+        tfsm.hit('start')
+        WaitFor(lambda: tfsm.state == 'Finished')
+        self.assertNotEqual(threads, [caller_thread])
+        self.assertEqual(executor.latencies()['fsm_dele_action'].count, 1)
+
 
 class TestFSMActionsOnEntryToState(TestFSMBase):
 
@@ -21,16 +21,18 @@ from __future__ import absolute_import
 import gc
 import logging
 from socket import AF_INET, socket, SOCK_STREAM, SOCK_DGRAM
+import threading
 from weakref import ref
+from ..fsm.callbackexecutor import ThreadPoolCallbackExecutor
 from ..media.sessions import SingleRTPSession
-from ..party import (Party)
+from ..party import (Party, UnexpectedState)
 from ..parties import (NoMediaSimpleCallsParty)
 from ..sip.dialogs import SimpleClientDialog, SimpleServerDialog
 from ..sip.prot import Incomplete
 from ..sip.siptransport import SIPTransport
 from ..transport import (IsValidPortNum, NameLoopbackAddress)
 from ..util import (abytes, WaitFor)
-from .base import SIPPartyTestCase
+from .base import asyncio, SIPPartyTestCase
 
 log = logging.getLogger(__name__)
 
@@ -268,6 +270,97 @@ class TestParty(SIPPartyTestCase):
         server_dialog_delegate.dialog.waitForStateCondition(
             lambda st: st == server_dialog_delegate.dialog.States.Terminated)
 
+    def test_delegate_executor(self):
+
+        class DialogDelegate:
+            def fsm_dele_handle_invite(self, dialog, invite):
+                self.thread = threading.current_thread()
+                self.dialog = dialog
+
+        server_dialog_delegate = DialogDelegate()
+        executor = ThreadPoolCallbackExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        party = NoMediaSimpleCallsParty(
+            display_name_uri='sip:alice@atlanta.com',
+            dialog_delegate=server_dialog_delegate,
+            delegate_executor=executor)
+        party.listen(port=0)
+
+        party2 = NoMediaSimpleCallsParty('sip:bob@biloxi.com')
+        party2.invite(party)
+        WaitFor(lambda: hasattr(server_dialog_delegate, 'dialog'))
+
+        log.info('The dialog delegate is called through the executor.')
+        self.assertIs(
+            server_dialog_delegate.dialog.delegate_executor, executor)
+        self.assertIsNot(
+            server_dialog_delegate.thread, threading.current_thread())
+        WaitFor(lambda: 'fsm_dele_handle_invite' in executor.latencies())
+
+        dialog = server_dialog_delegate.dialog
+        dialog.hit('accept')
+        dialog.waitForStateCondition(lambda st: st == dialog.States.InDialog)
+        dialog.terminate()
+        dialog.waitForStateCondition(
+            lambda st: st == dialog.States.Terminated)
+
+    def test_awaitable_invite(self):
+        if asyncio is None:
+            self.skipTest('asyncio is not available.')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.sub_test_awaitable_invite(loop)
+
+    def test_awaitable_invite_event_loop(self):
+        self.sub_test_awaitable_invite(self.patch_event_loop())
+
+    def sub_test_awaitable_invite(self, loop):
+
+        def run(awaitable):
+            return loop.run_until_complete(
+                asyncio.wait_for(awaitable, 2, loop=loop))
+
+        p1 = NoMediaSimpleCallsParty('sip:alice@atlanta.com')
+        p1.listen(port=0)
+        p2 = NoMediaSimpleCallsParty('sip:bob@biloxi.com')
+
+        log.info('Await the invite.')
+        dlg = run(p2.ainvite(p1, loop=loop))
+        States = dlg.States
+        self.assertEqual(dlg.state, States.InDialog)
+        self.assertEqual(
+            run(dlg.wait_for_state(States.InDialog, loop=loop)),
+            States.InDialog)
+
+        log.info('Iterate the states until the dialog terminates.')
+        events = dlg.events(loop=loop)
+        terminated = dlg.wait_for_state(
+            lambda st: st == States.Terminated, loop=loop)
+        dlg.terminate()
+        states = []
+        while True:
+            try:
+                states.append(run(events.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(states[-1], States.Terminated)
+        self.assertEqual(run(terminated), States.Terminated)
+
+        log.info('A dialog terminated before it is established raises.')
+        dlg_future = p2.ainvite('sip:carol@127.0.0.1:%d' % (
+            self.unused_udp_port(),), loop=loop)
+        self.assertFalse(dlg_future.done())
+        p2.dialogs[-1].terminate('Gave up waiting')
+        self.assertRaises(UnexpectedState, run, dlg_future)
+
+    def unused_udp_port(self):
+        sck = socket(AF_INET, SOCK_DGRAM)
+        sck.bind(('127.0.0.1', 0))
+        port = sck.getsockname()[1]
+        sck.close()
+        return port
+
     def test_default_port(self):
 
         p1 = NoMediaSimpleCallsParty('sip:alice@atlanta.com')
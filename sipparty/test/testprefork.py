@@ -0,0 +1,144 @@
+"""testprefork.py
+
+Unit tests for running SIP in several worker processes.
+
+Copyright 2016 David Park
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import signal
+import socket as socket_module
+from socket import AF_INET, SOCK_DGRAM, socket
+import time
+from ..prefork import (
+    CallIDFromData, PreforkSupervisor, STEERING_CALL_ID, WorkerIndexForCallID)
+from ..transport import ListenDescription, SocketOwner, Transport
+from ..util import WaitFor
+from .base import SIPPartyTestCase
+
+log = logging.getLogger(__name__)
+
+
+def SleepForever():
+    while True:
+        time.sleep(0.1)
+
+
+class TestPrefork(SIPPartyTestCase):
+
+    def start_supervisor(self, *args, **kwargs):
+        if not hasattr(os, 'fork'):
+            self.skipTest('Prefork needs os.fork.')
+        sup = PreforkSupervisor(*args, **kwargs)
+        sup.restart_delay = 0
+        sup.start()
+        self.addCleanup(sup.stop)
+        return sup
+
+    def wait_for_supervisor(self, sup, condition):
+        WaitFor(lambda: sup.poll(0.05) or condition(), 5)
+
+    def test_call_id_steering(self):
+        msg = (
+            b'INVITE sip:bob@biloxi.com SIP/2.0\r\n'
+            b'CALL-ID : a84b4c76e66710@pc33.atlanta.com \r\n'
+            b'Content-Length: 0\r\n\r\n')
+        self.assertEqual(
+            CallIDFromData(msg), b'a84b4c76e66710@pc33.atlanta.com')
+        self.assertEqual(CallIDFromData(b'i:abc\r\n\r\n'), b'abc')
+        self.assertIsNone(CallIDFromData(b'To: <sip:bob@biloxi.com>\r\n'))
+
+        indexes = set(
+            WorkerIndexForCallID(b'call-%d' % ii, 4) for ii in range(100))
+        self.assertEqual(indexes, set(range(4)))
+        self.assertEqual(
+            WorkerIndexForCallID(b'call-1', 4),
+            WorkerIndexForCallID(b'call-1', 4))
+
+    def test_reuse_port(self):
+        if not hasattr(socket_module, 'SO_REUSEPORT'):
+            self.skipTest('SO_REUSEPORT is not supported.')
+
+        tp = Transport()
+        lprxs = []
+        for _ in range(2):
+            lprx = ListenDescription(
+                sock_family=AF_INET, sock_type=SOCK_DGRAM, name='127.0.0.1',
+                port=lprxs[0].local_address.port if lprxs else 0,
+                reuse_port=True).listen(tp, None)
+            self.addCleanup(lprx.close)
+            lprxs.append(lprx)
+
+        self.assertTrue(lprxs[1].local_address.reuse_port)
+        self.assertEqual(
+            lprxs[1].local_address.port, lprxs[0].local_address.port)
+
+    def test_supervisor(self):
+
+        def worker_main(ctx):
+            ctx.report_counters({'started': 1, 'index': ctx.index})
+            SleepForever()
+
+        sup = self.start_supervisor(worker_main, worker_count=3)
+        self.wait_for_supervisor(
+            sup, lambda: sup.counters.get('started') == 3)
+        self.assertEqual(sup.counters['index'], 0 + 1 + 2)
+
+        log.info('Workers that die are restarted.')
+        pid = sup.worker_pids[1]
+        os.kill(pid, signal.SIGKILL)
+        self.wait_for_supervisor(
+            sup, lambda: sup.restarts == 1 and
+            sup.counters.get('started') == 3)
+        self.assertNotIn(pid, sup.worker_pids)
+        self.assertNotIn(None, sup.worker_pids)
+
+    def test_call_id_dispatch(self):
+
+        class CountingOwner(SocketOwner):
+            def __init__(self, ctx):
+                self.ctx = ctx
+                self.received = 0
+
+            def consume_data(self, proxy, remote_address, data):
+                assert data.startswith(b'OPTIONS')
+                self.received += 1
+                self.ctx.report_counters({'received': self.received})
+
+        def worker_main(ctx):
+            owner = CountingOwner(ctx)
+            ctx.consume_steered_datagrams(owner)
+            SleepForever()
+
+        sup = self.start_supervisor(
+            worker_main, worker_count=2, steering=STEERING_CALL_ID,
+            steering_address=('127.0.0.1', 0))
+
+        sck = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(sck.close)
+        expected = [0, 0]
+        for call_id in (b'one', b'two', b'one', b'three', b'one'):
+            sck.sendto(
+                b'OPTIONS sip:a@b SIP/2.0\r\nCall-ID: ' + call_id +
+                b'\r\n\r\n', sup.steering_address)
+            expected[WorkerIndexForCallID(call_id, 2)] += 1
+
+        self.wait_for_supervisor(
+            sup, lambda: sup.counters.get('received') == 5)
+        self.assertEqual(
+            [counters.get('received', 0)
+             for counters in sup.worker_counters], expected)
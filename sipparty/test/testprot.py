@@ -21,7 +21,7 @@ from __future__ import absolute_import
 import logging
 import re
 from six import (binary_type as bytes, iteritems, PY2)
-from ..parse import ParseError
+from ..parse import (ParseError, Parser)
 from ..sdp import sdpsyntax
 from ..sip import (prot, components, Message, Header)
 from ..sip.body import Body
@@ -30,6 +30,7 @@ from ..sip.header import ContactHeader
 from ..sip.param import Parameters
 from ..sip.prot import (Incomplete)
 from ..sip.request import Request
+from ..sip.scanner import ScanMessage
 from ..util import (bglobals_g)
 from .base import SIPPartyTestCase
 
@@ -61,6 +62,44 @@ class TestProtocol(SIPPartyTestCase):
         u1 = URI(aor=a1)
         self.assertRaises(Incomplete, bytes, u1)
 
+    def test_parser_plans(self):
+
+        class KeyValue(Parser):
+            parseinfo = {
+                Parser.Pattern: b"([a-z]+):([0-9]+)?",
+                Parser.Mappings: [("key",), ("value", int)],
+                Parser.Repeats: True,
+            }
+
+        kvs = KeyValue.Parse(b'a:1')
+        self.assertEqual(
+            [(kv.key, kv.value) for kv in kvs], [(b'a', 1)])
+        self.assertFalse(hasattr(KeyValue.Parse(b'b:')[0], 'value'))
+        self.assertEqual(KeyValue.Parse(b''), [])
+        self.assertRaises(ParseError, KeyValue.Parse, b'a:1;')
+
+        log.info('Subclasses parse to themselves.')
+
+        class SubKeyValue(KeyValue):
+            pass
+
+        self.assertIsInstance(SubKeyValue.Parse(b'a:1')[0], SubKeyValue)
+
+        log.info('Bad parseinfo is found when the class is created.')
+
+        def make_bad_parser():
+            class BadMapping(Parser):
+                parseinfo = {
+                    Parser.Pattern: b"(a)",
+                    Parser.Mappings: [("a", None, None)],
+                }
+        self.assertRaises(ValueError, make_bad_parser)
+
+        class NoParseInfo(Parser):
+            pass
+
+        self.assertRaises(TypeError, NoParseInfo.Parse, b'a')
+
     def testGeneral(self):
         aliceAOR = components.AOR(b"alice", b"atlanta.com")
         self.assertEqual(bytes(aliceAOR), b"alice@atlanta.com")
@@ -266,3 +305,65 @@ class TestProtocol(SIPPartyTestCase):
 
         pms2 = Parameters.Parse(b';tag=abcdefg;branch=somebranch')
         self.assertEqual(pms, pms2)
+
+    def test_response_code_table(self):
+        table = prot.ResponseCodeTable.ForInputs(
+            ('request', 'response_18', 'response_2', 'response_xxx',
+             'response_200'), 'response_')
+        self.assertEqual(table.lookup(180), 'response_18')
+        self.assertEqual(table.lookup(183), 'response_18')
+        self.assertEqual(table.lookup(100), 'response_xxx')
+        self.assertEqual(table.lookup(200), 'response_200')
+        self.assertEqual(table.lookup(202), 'response_2')
+        self.assertEqual(table.lookup(486), 'response_xxx')
+
+        log.info('Codes outside the usual range are still looked up.')
+        self.assertEqual(table.lookup(2000), 'response_200')
+        self.assertEqual(table.lookup(99), 'response_xxx')
+
+        table = prot.ResponseCodeTable({4: 'client error'})
+        self.assertEqual(table.lookup(404), 'client error')
+        self.assertIsNone(table.lookup(500))
+
+    def test_message_scanner(self):
+        data = (
+            b'BYE sip:bob@biloxi.com SIP/2.0\r\n'
+            b'Via: SIP/2.0/UDP a.com;branch=z9hG4bK1\r\n'
+            b'Via : SIP/2.0/UDP b.com\r\n'
+            b'  ;branch=z9hG4bK2\r\n'
+            b'To: <sip:bob@biloxi.com>;tag=2\r\n'
+            b'From: <sip:alice@atlanta.com>;tag=1\r\n'
+            b'CALL-ID:abc\r\n'
+            b'CSeq: 2 BYE\r\n'
+            b'Max-Forwards: 70\r\n'
+            b'Content-Length: 0\r\n'
+            b'\r\n')
+        scan = ScanMessage(memoryview(data))
+        self.assertEqual(scan.startline, b'BYE sip:bob@biloxi.com SIP/2.0')
+        self.assertEqual(len(scan.header_spans), 8)
+        self.assertEqual(scan.header_name(1), b'Via')
+        self.assertEqual(
+            scan.header_value(1), b'SIP/2.0/UDP b.com\r\n  ;branch=z9hG4bK2')
+        self.assertEqual(scan.find_header(b'call-id'), 4)
+        self.assertEqual(scan.header_value(4), b'abc')
+        self.assertEqual(scan.find_header(b'Contact'), -1)
+        self.assertEqual(scan.body_offset, len(data))
+
+        log.info('Headers are kept in the order they were received.')
+        msg = Message.Parse(data)
+        self.assertEqual(
+            [hdr.type for hdr in msg.headers],
+            ['Via', 'Via', 'To', 'From', 'Call-ID', 'CSeq', 'Max-Forwards',
+             'Content-Length'])
+        self.assertEqual(msg.viaheader.host.address, b'a.com')
+        self.assertEqual(msg.call_idheader.value, b'abc')
+        self.assertEqual(msg.parsedBytes, len(data))
+
+        for bad_data in (
+                b'BYE sip:bob@biloxi.com SIP/2.0',
+                b'BYE sip:bob@biloxi.com SIP/2.0\r\nVia: a\r\n',
+                b'BYE sip:bob@biloxi.com SIP/2.0\r\nVia a\r\n\r\n'):
+            self.assertRaises(ParseError, ScanMessage, bad_data)
+        self.assertRaises(
+            ParseError, Message.Parse,
+            b'BYE sip:bob@biloxi.com SIP/2.0\r\nX-Foo: a\r\n\r\n')
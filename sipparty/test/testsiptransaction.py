@@ -19,6 +19,7 @@ limitations under the License.
 from __future__ import absolute_import
 
 import logging
+import threading
 
 from ..sip.header import CseqHeader, ViaHeader
 from ..sip.message import Message, MessageResponse
@@ -158,6 +159,40 @@ class TestTransactionManager(TransactionTest):
         self.assertTrue(
             isinstance(trans, OneShotServerTransaction), type(trans).__name__)
 
+    def test_concurrent_lookup(self):
+        tm = TransactionManager(self)
+        invites = []
+        for ii in range(8):
+            invite = Message.invite()
+            invite.ViaHeader.parameters.branch = b'branch%d' % ii
+            invites.append(invite)
+
+        go = threading.Event()
+        results = []
+
+        def lookup():
+            go.wait()
+            results.append([
+                tm.transaction_for_inbound_message(invite)
+                for invite in invites])
+
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thr in threads:
+            thr.start()
+        go.set()
+        for thr in threads:
+            thr.join()
+
+        log.info('Each thread got the same transaction for each message.')
+        self.assertEqual(len(results), 4)
+        for transactions in results[1:]:
+            for trans, first_trans in zip(transactions, results[0]):
+                self.assertIs(trans, first_trans)
+        self.assertEqual(len(tm.transactions), 8)
+        self.assertEqual(
+            set(id(trans) for trans in tm.transactions.values()),
+            set(id(trans) for trans in results[0]))
+
 
 class TestServerTransaction(TransactionTest):
 
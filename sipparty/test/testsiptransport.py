@@ -19,15 +19,33 @@ limitations under the License.
 from __future__ import absolute_import
 
 import logging
-from socket import (AF_INET, SOCK_DGRAM)
+import threading
+from socket import (AF_INET, socket, SOCK_DGRAM, SOCK_STREAM)
 from .. import (sip, transport)
-from ..sip.siptransport import AORHandler, SIPTransport
+from ..fsm import retrythread
+from ..fsm.callbackexecutor import (
+    EventLoopCallbackExecutor, ThreadPoolCallbackExecutor)
+from ..sip.components import AOR
+from ..sip import retransmissioncache
+from ..sip.message import Message
+from ..sip.siptransport import (
+    AORHandler, RoutingKeysFromData, SIPTransport)
 from ..sip.transaction import TransactionUser
 from ..util import WaitFor
-from .base import (MagicMock, Mock, patch, SIPPartyTestCase)
+from .base import (asyncio, MagicMock, Mock, patch, SIPPartyTestCase)
 
 log = logging.getLogger(__name__)
 
+OptionsRequest = (
+    b'OPTIONS sip:alice@atlanta.com SIP/2.0\r\n'
+    b'Via: SIP/2.0/UDP pc33.biloxi.com;branch=z9hG4bK%(branch)s\r\n'
+    b'To: <sip:alice@atlanta.com>\r\n'
+    b'From: <sip:bob@biloxi.com>;tag=1928\r\n'
+    b'Call-ID: %(branch)s\r\n'
+    b'CSeq: 1 OPTIONS\r\n'
+    b'Max-Forwards: 70\r\n'
+    b'Content-Length: 0\r\n\r\n')
+
 
 class TestSIPTransport(AORHandler, SIPPartyTestCase):
 
@@ -88,5 +106,371 @@ class TestSIPTransport(AORHandler, SIPPartyTestCase):
         rmsg = self.rcvd_messages.pop()
         self.assertEqual(msg.type, rmsg.type, rmsg)
 
+    def test_send_messages(self):
+        self.rcvd_messages = []
+        tp = SIPTransport()
+        l_desc = tp.listen_for_me(
+            sock_type=SOCK_DGRAM, sock_family=AF_INET, port=0)
+
+        msgs = []
+        for ii in range(3):
+            msg = sip.Message.invite()
+            msg.ToHeader.aor = b"alice@atlanta.com"
+            msg.FromHeader.aor = b"bob@biloxi.com"
+            msgs.append(msg)
+        tp.addDialogHandlerForAOR(msgs[0].ToHeader.aor, self)
+
+        laddrs = tp.send_messages(
+            (msg, '127.0.0.1', l_desc.port) for msg in msgs)
+        self.assertEqual(len(laddrs), 3)
+        self.assertEqual(len(set(id(laddr) for laddr in laddrs)), 1)
+        self.assertEqual(tp.messages_sent, 3)
+
+        WaitFor(lambda: len(self.rcvd_messages) == 3, 1)
+        self.assertEqual(
+            [bytes(rmsg.Call_IdHeader) for rmsg in self.rcvd_messages],
+            [bytes(msg.Call_IdHeader) for msg in msgs])
+
+    def test_message_workers(self):
+        self.rcvd_messages = []
+        with patch.object(SIPTransport, 'MessageWorkerCount', 2):
+            tp = SIPTransport()
+        self.assertEqual(tp.message_workers.worker_count, 2)
+        l_desc = tp.listen_for_me(
+            sock_type=SOCK_DGRAM, sock_family=AF_INET, port=0)
+
+        msgs = []
+        for ii in range(6):
+            msg = sip.Message.invite()
+            msg.ToHeader.aor = b"alice@atlanta.com"
+            msg.FromHeader.aor = b"bob@biloxi.com"
+            msgs.append(msg)
+        tp.addDialogHandlerForAOR(msgs[0].ToHeader.aor, self)
+        tp.send_messages((msg, '127.0.0.1', l_desc.port) for msg in msgs)
+
+        WaitFor(lambda: len(self.rcvd_messages) == 6, 1)
+        self.assertEqual(
+            set(bytes(rmsg.Call_IdHeader) for rmsg in self.rcvd_messages),
+            set(bytes(msg.Call_IdHeader) for msg in msgs))
+        self.assertEqual(
+            sum(stats['submitted'] for stats in tp.message_workers.stats), 6)
+        self.assertEqual(tp.messages_received, 6)
+
+    def test_event_loop(self):
+        loop = self.patch_event_loop()
+        self.rcvd_messages = []
+        threads = []
+
+        def new_dialog_from_request(msg):
+            threads.append(threading.current_thread())
+            self.rcvd_messages.append(msg)
+
+        self.new_dialog_from_request = new_dialog_from_request
+
+        threads_before = set(threading.enumerate())
+        with patch.object(retrythread, '_watch_main_thread') as watch_mock:
+            tp = SIPTransport()
+        self.assertEqual(watch_mock.call_count, 0)
+        self.assertTrue(tp._tp_retryThread.uses_event_loop)
+        l_desc = tp.listen_for_me(
+            sock_type=SOCK_DGRAM, sock_family=AF_INET, port=0)
+
+        msg = sip.Message.invite()
+        msg.ToHeader.aor = b"alice@atlanta.com"
+        msg.FromHeader.aor = b"bob@biloxi.com"
+        tp.addDialogHandlerForAOR(msg.ToHeader.aor, self)
+        tp.send_message_with_transaction(
+            msg, self, remote_name='127.0.0.1', remote_port=l_desc.port)
+
+        log.info('The message is received and handled on the loop thread.')
+        self.run_event_loop_until(loop, lambda: len(self.rcvd_messages) == 1)
+        self.assertEqual(self.rcvd_messages[0].type, msg.type)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertIsNone(tp._tp_retryThread._rthr_thread)
+
+        log.info('No extra threads have been started.')
+        self.assertEqual(set(threading.enumerate()) - threads_before, set())
+
+    def test_aor_handler_executor(self):
+        data = OptionsRequest
+        executor = ThreadPoolCallbackExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        tp = SIPTransport()
+        tp.aor_handler_executor = executor
+        tp.addDialogHandlerForAOR(AOR.Parse(b'alice@atlanta.com'), self)
+        sprxy = Mock()
+        sprxy.local_address.sock_type = SOCK_DGRAM
+        pending = tp._sptr_pendingHandlerCalls
+
+        threads = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+        results = []
+
+        def new_dialog_from_request(msg):
+            threads.append(threading.current_thread())
+            release.wait(1)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.new_dialog_from_request = new_dialog_from_request
+
+        log.info('The handler runs on the executor and retransmissions are '
+                 'dropped while it does.')
+        dlg = HandlerDialog(b'pdid')
+        results.append(dlg)
+        rdata = data % {b'branch': b'dialog'}
+        tp.consume_data(sprxy, ('127.0.0.1', 5060), rdata)
+        self.assertEqual(len(pending), 1)
+        tp.consume_data(sprxy, ('127.0.0.1', 5060), rdata)
+        release.set()
+        WaitFor(lambda: len(dlg.requests) == 1)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertEqual(len(pending), 0)
+        self.assertIs(tp.provisionalDialogs[b'pdid'], dlg)
+        self.assertEqual(
+            executor.latencies()['new_dialog_from_request'].count, 1)
+
+        log.info('No dialog is started if the handler returns None or '
+                 'raises.')
+        for branch, result in (
+                (b'none', None), (b'raises', ValueError('handler failed'))):
+            results.append(result)
+            tp.consume_data(
+                sprxy, ('127.0.0.1', 5060), data % {b'branch': branch})
+            WaitFor(lambda: not results and not pending)
+            trns = tp.transaction_manager.transactions.get(
+                ('server', b'z9hG4bK' + branch, 'OPTIONS'))
+            self.assertIsNone(trns.transaction_user)
+        self.assertEqual(len(tp.provisionalDialogs), 1)
+
+    def test_aor_handler_event_loop(self):
+        loop = self.patch_event_loop()
+        tp = SIPTransport()
+        tp.aor_handler_executor = EventLoopCallbackExecutor(loop)
+        tp.addDialogHandlerForAOR(AOR.Parse(b'alice@atlanta.com'), self)
+        sprxy = Mock()
+        sprxy.local_address.sock_type = SOCK_DGRAM
+
+        log.info('A coroutine handler is run to completion on the loop.')
+        dlg = HandlerDialog(b'pdid')
+        threads = []
+
+        def new_dialog_from_request(msg):
+            threads.append(threading.current_thread())
+            return asyncio.sleep(0, result=dlg, loop=loop)
+
+        self.new_dialog_from_request = new_dialog_from_request
+        tp.consume_data(
+            sprxy, ('127.0.0.1', 5060), OptionsRequest % {b'branch': b'1'})
+        self.assertEqual(threads, [])
+        self.assertEqual(len(tp._sptr_pendingHandlerCalls), 1)
+
+        self.run_event_loop_until(loop, lambda: len(dlg.requests) == 1)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(len(tp._sptr_pendingHandlerCalls), 0)
+        self.assertIs(tp.provisionalDialogs[b'pdid'], dlg)
+
+    def test_tcp(self):
+        self.rcvd_messages = []
+        tp = SIPTransport()
+        l_desc = tp.listen_for_me(
+            sock_type=SOCK_STREAM, sock_family=AF_INET, port=0)
+
+        msg = sip.Message.invite()
+        msg.ToHeader.aor = b"alice@atlanta.com"
+        msg.FromHeader.aor = b"bob@biloxi.com"
+        msg.viaheader.transport = transport.SOCK_TYPE_IP_NAMES.TCP
+        tp.addDialogHandlerForAOR(msg.ToHeader.aor, self)
+
+        tp.send_message(msg, '127.0.0.1', l_desc.port)
+        WaitFor(lambda: len(self.rcvd_messages) == 1, 1)
+        self.assertEqual(
+            self.rcvd_messages[0].viaheader.transport,
+            transport.SOCK_TYPE_IP_NAMES.TCP)
+
+        log.info('Keepalives and several messages in one go are consumed.')
+        csck = socket(AF_INET, SOCK_STREAM)
+        self.addCleanup(csck.close)
+        csck.connect(('127.0.0.1', l_desc.port))
+        msgs = []
+        for ii in range(2):
+            msg = sip.Message.invite()
+            msg.ToHeader.aor = b"alice@atlanta.com"
+            msg.FromHeader.aor = b"bob@biloxi.com"
+            msg.viaheader.transport = transport.SOCK_TYPE_IP_NAMES.TCP
+            msg.ContactHeader.field.value.uri.aor.host.address = b'127.0.0.1'
+            msg.ContactHeader.field.value.uri.aor.host.port = l_desc.port
+            msgs.append(msg)
+        data = b'\r\n\r\n' + b''.join(bytes(msg) for msg in msgs)
+        csck.sendall(data[:-10])
+        csck.sendall(data[-10:])
+        WaitFor(lambda: len(self.rcvd_messages) == 3, 1)
+        self.assertEqual(
+            [bytes(rmsg.Call_IdHeader) for rmsg in self.rcvd_messages[1:]],
+            [bytes(msg.Call_IdHeader) for msg in msgs])
+
+        log.info('A double CRLF keepalive ping gets a single CRLF pong.')
+        csck.settimeout(5)
+        self.assertEqual(csck.recv(2), b'\r\n')
+
+    def test_large_request_uses_tcp(self):
+        self.rcvd_messages = []
+        tp = SIPTransport()
+        tp.MaxUDPRequestSize = 100
+        tcp_desc = tp.listen_for_me(
+            sock_type=SOCK_STREAM, sock_family=AF_INET, port=0)
+        tp.listen_for_me(
+            sock_type=SOCK_DGRAM, sock_family=AF_INET, port=tcp_desc.port)
+
+        # Find a port with nothing listening for TCP on it.
+        sck = socket(AF_INET, SOCK_DGRAM)
+        sck.bind(('127.0.0.1', 0))
+        udp_port = sck.getsockname()[1]
+        sck.close()
+        tp.listen_for_me(
+            sock_type=SOCK_DGRAM, sock_family=AF_INET, port=udp_port)
+        tp.addDialogHandlerForAOR(AOR.Parse(b"alice@atlanta.com"), self)
+
+        def send_invite(port):
+            msg = sip.Message.invite()
+            msg.ToHeader.aor = b"alice@atlanta.com"
+            msg.FromHeader.aor = b"bob@biloxi.com"
+            tp.send_message(msg, '127.0.0.1', port)
+            WaitFor(lambda: len(self.rcvd_messages) == 1, 1)
+            return self.rcvd_messages.pop().viaheader.transport
+
+        log.info('Large UDP request is sent using TCP.')
+        self.assertEqual(
+            send_invite(tcp_desc.port), transport.SOCK_TYPE_IP_NAMES.TCP)
+
+        log.info('But falls back to UDP if TCP fails.')
+        self.assertEqual(
+            send_invite(udp_port), transport.SOCK_TYPE_IP_NAMES.UDP)
+
+    def test_routing_keys(self):
+        self.rcvd_messages = []
+        data = (
+            b'INVITE sip:alice@atlanta.com SIP/2.0\r\n'
+            b'Via: SIP/2.0/UDP pc33.biloxi.com;branch=z9hG4bK776\r\n'
+            b'Via: SIP/2.0/UDP a.com;branch=z9hG4bKother\r\n'
+            b'To: <sip:alice@atlanta.com>\r\n'
+            b'From: <sip:bob@biloxi.com;tag=uri>;tag=1928\r\n'
+            b'Call-ID: a84b4c76e66710\r\n'
+            b'CSeq: 314159 INVITE\r\n'
+            b'Max-Forwards: 70\r\n'
+            b'Contact: <sip:bob@127.0.0.1>\r\n'
+            b'Content-Length: 0\r\n\r\n')
+        keys = RoutingKeysFromData(memoryview(data))
+        self.assertEqual(keys.method, 'INVITE')
+        self.assertIsNone(keys.code)
+        self.assertEqual(keys.branch, b'z9hG4bK776')
+        self.assertEqual(keys.cseq_method, 'INVITE')
+
+        tp = SIPTransport()
+        tm = tp.transaction_manager
+        msg = Message.Parse(data)
+        self.assertEqual(
+            tm.transaction_key_for_message('server', msg),
+            ('server', keys.branch, keys.cseq_method))
+        self.assertIsNone(RoutingKeysFromData(
+            data.replace(b'Via: SIP/2.0/UDP pc33.biloxi.com;', b'Via: ')))
+
+        log.info('Retransmitted requests are absorbed without parsing.')
+        sprxy = Mock()
+        sprxy.local_address.sock_type = SOCK_DGRAM
+        tp.addDialogHandlerForAOR(AOR.Parse(b'alice@atlanta.com'), self)
+        tp.consume_data(sprxy, ('127.0.0.1', 5060), data)
+        self.assertEqual(len(self.rcvd_messages), 1)
+        trns = tm.lookup_transaction_for_routing_keys('server', keys)
+        trns.hit('request', msg)
+        self.assertEqual(trns.state, trns.States.proceeding)
+
+        with patch.object(Message, 'Parse') as parse_mock:
+            tp.consume_data(sprxy, ('127.0.0.1', 5060), data)
+
+            log.info('So are responses with no transaction.')
+            tp.consume_data(sprxy, ('127.0.0.1', 5060), data.replace(
+                b'INVITE sip:alice@atlanta.com SIP/2.0', b'SIP/2.0 200 OK'))
+        self.assertEqual(parse_mock.call_count, 0)
+        self.assertEqual(tp.messages_absorbed, 2)
+        self.assertEqual(len(self.rcvd_messages), 1)
+
+    def test_retransmission_cache(self):
+        self.rcvd_messages = []
+        clock = [0]
+        pp = patch.object(retransmissioncache, 'Clock', lambda: clock[0])
+        pp.start()
+        self.addCleanup(pp.stop)
+        data = (
+            b'OPTIONS sip:alice@atlanta.com SIP/2.0\r\n'
+            b'Via: SIP/2.0/UDP pc33.biloxi.com;branch=z9hG4bK776\r\n'
+            b'To: <sip:alice@atlanta.com>\r\n'
+            b'From: <sip:bob@biloxi.com>;tag=1928\r\n'
+            b'Call-ID: a84b4c76e66710\r\n'
+            b'CSeq: 1 OPTIONS\r\n'
+            b'Max-Forwards: 70\r\n'
+            b'Content-Length: 0\r\n\r\n')
+        tp = SIPTransport()
+        cache = tp.retransmission_cache
+        sprxy = Mock()
+        sprxy.local_address.sock_type = SOCK_DGRAM
+        tp.addDialogHandlerForAOR(AOR.Parse(b'alice@atlanta.com'), self)
+        tp.consume_data(sprxy, ('127.0.0.1', 5060), data)
+        self.assertEqual(len(self.rcvd_messages), 1)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        log.info('Once there is a response retransmissions get it resent.')
+        tid = ('server', b'z9hG4bK776', 'OPTIONS')
+        trns = tp.transaction_manager.transactions.get(tid)
+        trns.hit('request', self.rcvd_messages[0])
+        trns.remote_name = '127.0.0.1'
+        trns.remote_port = 5060
+        trying = Message.Parse(data.replace(
+            b'OPTIONS sip:alice@atlanta.com SIP/2.0',
+            b'SIP/2.0 100 Trying').replace(
+            b'Max-Forwards: 70', b'Contact: <sip:alice@127.0.0.1>'))
+        trns.respond(trying)
+        self.assertEqual(tp.messages_sent, 1)
+        with patch.object(Message, 'Parse') as parse_mock:
+            tp.consume_data(sprxy, ('127.0.0.1', 5060), data)
+        self.assertEqual(parse_mock.call_count, 0)
+        self.assertEqual(tp.messages_sent, 2)
+        self.assertEqual(trns.retransmit_count, 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+        log.info('But not once the entry has expired.')
+        clock[0] = tp.RetransmissionCacheTTL
+        self.assertIsNone(cache.lookup(cache.Digest(data)))
+        self.assertEqual(len(cache), 0)
+
+        log.info('The oldest entries are dropped when the cache is full.')
+        cache.size = 2
+        for ii in range(3):
+            cache.add_request(b'digest%d' % ii, ('server', b'%d' % ii, 'BYE'))
+            cache.add_response(('server', b'%d' % ii, 'BYE'), sprxy, b'200')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.lookup(b'digest0'))
+        self.assertIsNotNone(cache.lookup(b'digest2'))
+        self.assertIsNone(cache.lookup(b'digest2', lambda tid: False))
+        self.assertEqual(len(cache), 1)
+
+
+class HandlerDialog(object):
+    """Stands in for a dialog created by an AOR handler."""
+
+    def __init__(self, provisional_dialog_id):
+        super(HandlerDialog, self).__init__()
+        self.provisionalDialogID = provisional_dialog_id
+        self.requests = []
+
+    def consume_request(self, msg):
+        self.requests.append(msg)
+
 
 TransactionUser.register(TestSIPTransport)
+TransactionUser.register(HandlerDialog)
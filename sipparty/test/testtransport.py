@@ -22,15 +22,16 @@ import logging
 from select import error as select_error
 from six.moves.queue import Queue
 from socket import (
-    error as sock_error, SOCK_DGRAM, SOCK_STREAM, AF_INET, AF_INET6)
+    error as sock_error, socket, socketpair, SOCK_DGRAM, SOCK_STREAM, AF_INET,
+    AF_INET6)
 from .. import transport
 from ..fsm import retrythread
 from ..fsm.retrythread import RetryThread
 from ..transport import (
     address_as_tuple, ConnectedAddressDescription,
-    is_null_address, ListenDescription,
+    is_null_address, ListenDescription, LocalAddressCache,
     NameAll, SendFromAddressNameAny, SocketOwner,
-    SocketProxy, Transport, IPv6address_re,
+    SocketProxy, SocketProxyIndex, Transport, IPv6address_re,
     IPv6address_only_re)
 from ..transport.mocksock import SocketMock
 from ..util import WaitFor
@@ -42,11 +43,17 @@ log = logging.getLogger(__name__)
 class TestTransport(SocketOwner, SIPPartyTestCase):
 
     def consume_data(self, proxy, remote_address, data):
-        self.data_call_back_call_args.append((proxy, remote_address, data))
+        self.data_call_back_call_args.append(
+            (proxy, remote_address, bytes(data)))
+
+    def consume_datagrams(self, datagrams):
+        self.datagram_batch_sizes.append(len(datagrams))
+        super(TestTransport, self).consume_datagrams(datagrams)
 
     def setUp(self):
         super(TestTransport, self).setUp()
         self.data_call_back_call_args = []
+        self.datagram_batch_sizes = []
 
     def new_connection(self, local_address, remote_address):
         return True
@@ -110,6 +117,74 @@ class TestTransport(SocketOwner, SIPPartyTestCase):
         self.assertEqual(ld.flowinfo, 0)
         self.assertEqual(ld.scopeid, 0)
 
+    def test_socket_proxy_index(self):
+        index = SocketProxyIndex()
+
+        def add_proxy(**kwargs):
+            desc_class = (
+                ConnectedAddressDescription if 'remote_name' in kwargs else
+                ListenDescription)
+            sp = SocketProxy(local_address=desc_class(
+                sock_family=AF_INET, sock_type=SOCK_DGRAM, **kwargs))
+            index.add(sp)
+            return sp
+
+        lsp = add_proxy(name='0.0.0.0', port=5060)
+        csp1 = add_proxy(
+            name='127.0.0.1', port=5061, remote_name='127.0.0.1',
+            remote_port=5070)
+        csp2 = add_proxy(
+            name='127.0.0.1', port=5062, remote_name='127.0.0.1',
+            remote_port=5070)
+        self.assertEqual(len(index), 3)
+
+        log.info('Exact and wildcard lookups.')
+        self.assertIs(index.find(lsp.local_address), lsp)
+        self.assertIs(index.find(ListenDescription(
+            name=NameAll, sock_type=SOCK_DGRAM, port=0)), lsp)
+        self.assertIsNone(index.find(ListenDescription(
+            name=NameAll, sock_type=SOCK_STREAM, port=0)))
+        self.assertIs(index.find(ConnectedAddressDescription(
+            name=SendFromAddressNameAny, sock_family=AF_INET,
+            sock_type=SOCK_DGRAM, port=5062, remote_name='127.0.0.1',
+            remote_port=5070)), csp2)
+        self.assertIs(index.find(ConnectedAddressDescription(
+            name='127.0.0.1', sock_family=AF_INET, sock_type=SOCK_DGRAM,
+            port=0, port_filter=lambda port: port % 2 == 0,
+            remote_name='127.0.0.1', remote_port=5070)), csp2)
+        self.assertIn(
+            index.find_any((AF_INET, SOCK_DGRAM, '127.0.0.1', 5070)),
+            (csp1, csp2))
+
+        log.info('Removal updates the secondary indexes.')
+        self.assertTrue(index.remove(csp1))
+        self.assertFalse(index.remove(csp1))
+        self.assertIs(
+            index.find_any((AF_INET, SOCK_DGRAM, '127.0.0.1', 5070)), csp2)
+        self.assertTrue(index.remove(csp2))
+        self.assertIsNone(
+            index.find_any((AF_INET, SOCK_DGRAM, '127.0.0.1', 5070)))
+        self.assertEqual(len(index), 1)
+
+    def test_send_from_address_fast_path(self):
+        tp = Transport()
+        lsck = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(lsck.close)
+        lsck.bind(('127.0.0.1', 0))
+
+        def get_proxy():
+            return tp.get_send_from_address(
+                sock_type=SOCK_DGRAM, remote_name='127.0.0.1',
+                remote_port=lsck.getsockname()[1], owner=self)
+
+        sp = get_proxy()
+        with patch.object(
+                transport.base, 'ConnectedAddressDescription',
+                side_effect=AssertionError('description created')):
+            self.assertIs(get_proxy(), sp)
+        self.assertEqual(tp.connected_socket_count, 1)
+        tp.close_socket_proxy(sp)
+
     def test_listen_address_create(self):
         log.info('ListenDescription requires a port argument')
 
@@ -221,6 +296,126 @@ class TestTransport(SocketOwner, SIPPartyTestCase):
         fromaddr, toaddr, data = self.data_call_back_call_args.pop()
         self.assertEqual(data, b'hello other')
 
+    def test_send_queue(self):
+        tp = Transport()
+        ssck, rsck = socketpair()
+        self.addCleanup(ssck.close)
+        self.addCleanup(rsck.close)
+        ssck.setblocking(False)
+        sprx = SocketProxy(socket=ssck, owner=self, transport=tp)
+
+        log.info('Send more than the socket buffer can hold.')
+        datas = [bytes(bytearray([ii % 256])) * 0x4000 for ii in range(64)]
+        sprx.send_many(datas)
+        self.assertGreater(sprx.send_queue_length, 0)
+
+        log.info('The rest is sent as the receiver reads.')
+        expected = b''.join(datas)
+        received = bytearray()
+        rsck.settimeout(5)
+        while len(received) < len(expected):
+            received.extend(rsck.recv(0x10000))
+        self.assertEqual(bytes(received), expected)
+        WaitFor(lambda: sprx.send_queue_length == 0)
+
+        log.info('Once drained, data is sent immediately again.')
+        WaitFor(lambda: not sprx._sck_waitingForWritable)
+        sprx.send(b'more')
+        self.assertEqual(sprx.send_queue_length, 0)
+        self.assertEqual(rsck.recv(4), b'more')
+
+    def test_stream_framing(self):
+        records = []
+
+        class LineOwner(SocketOwner):
+            def consume_data(self, proxy, remote_address, data):
+                data = bytes(data)
+                end = data.find(b'\n')
+                if end == -1:
+                    return 0
+                records.append(data[:end])
+                return end + 1
+
+        owner = LineOwner()
+        tp = Transport()
+        laddr = tp.listen_for_me(
+            owner, sock_family=AF_INET, sock_type=SOCK_STREAM,
+            name='127.0.0.1', port=0)
+
+        log.info('Connect to the listen socket.')
+        csck = socket(AF_INET, SOCK_STREAM)
+        self.addCleanup(csck.close)
+        csck.connect(('127.0.0.1', laddr.port))
+        WaitFor(lambda: tp.connected_socket_count == 1)
+
+        log.info('Pipelined and partial records are framed by the owner.')
+        csck.sendall(b'one\ntwo\nthr')
+        WaitFor(lambda: len(records) == 2)
+        csck.sendall(b'ee\n')
+        WaitFor(lambda: len(records) == 3)
+        self.assertEqual(records, [b'one', b'two', b'three'])
+
+        log.info('Closing the connection releases it from the transport.')
+        csck.close()
+        WaitFor(lambda: tp.connected_socket_count == 0)
+        tp.release_listen_address(laddr)
+
+    def test_connection_pool(self):
+        self.patch_clock()
+
+        # Socket events are delivered by hand so that connects complete when
+        # the test says.
+        self.patch_retrythread_select()
+        server = socket(AF_INET, SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        server.settimeout(5)
+
+        tp = Transport()
+        tp.MaxConnectionsPerDestination = 2
+        tp.ConnectionIdleTimeout = 25
+        tp.ConnectionKeepaliveInterval = 10
+        tp.ConnectionKeepaliveData = b'ping'
+
+        def get_connection():
+            return tp.get_send_from_address(
+                sock_type=SOCK_STREAM, remote_name='127.0.0.1',
+                remote_port=server.getsockname()[1], owner=self)
+
+        log.info('New connections are opened while the others are busy.')
+        conn1 = get_connection()
+        conn2 = get_connection()
+        self.assertIsNot(conn1, conn2)
+        self.assertIs(get_connection(), conn1)
+        self.assertEqual(tp.connected_socket_count, 2)
+        ssck1, _ = server.accept()
+        self.addCleanup(ssck1.close)
+        ssck2, _ = server.accept()
+        self.addCleanup(ssck2.close)
+        for conn in (conn1, conn2):
+            self.assertTrue(conn.is_connecting)
+            conn.socket_writable(conn.socket)
+            self.assertFalse(conn.is_connecting)
+
+        log.info('Idle connections are reused.')
+        self.assertIs(get_connection(), conn1)
+        conn1.send(b'hello')
+        self.assertEqual(tp.connected_socket_count, 2)
+
+        log.info('Keepalives are sent on quiet connections.')
+        self.clock_time = 10
+        for ssck in (ssck1, ssck2):
+            ssck.settimeout(5)
+            received = b''
+            while not received.endswith(b'ping'):
+                received += ssck.recv(0x100)
+
+        log.info('Idle connections are closed.')
+        self.clock_time = 30
+        WaitFor(lambda: tp.connected_socket_count == 0)
+        self.assertIsNone(conn1.socket)
+
     def test_parsing_ip_addresses(self):
 
         for bad_name in ('not-an-ip', 'fe80::1::1'):
@@ -271,6 +466,101 @@ class TestTransport(SocketOwner, SIPPartyTestCase):
         cprx2 = tp.find_or_create_send_from_socket(cad, None)
         self.assertIs(cprx, cprx2)
 
+    def test_local_address_cache(self):
+        self.patch_clock()
+        cache = LocalAddressCache()
+        cache.max_entries = 2
+        cache.ttl = 10
+
+        log.info('Addresses in the same subnet share an entry.')
+        self.assertEqual(
+            cache.local_address(AF_INET, ('127.0.0.1', 5060)), '127.0.0.1')
+        self.assertEqual(
+            cache.local_address(AF_INET, ('127.0.0.2', 5060)), '127.0.0.1')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        log.info('Entries expire.')
+        self.clock_time = 10
+        cache.local_address(AF_INET, ('127.0.0.1', 5060))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        log.info('The least recently used entry is evicted.')
+        cache.local_address(AF_INET, ('127.0.1.1', 5060))
+        cache.local_address(AF_INET, ('127.0.0.1', 5060))
+        cache.local_address(AF_INET, ('127.0.2.1', 5060))
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        cache.local_address(AF_INET, ('127.0.0.1', 5060))
+        cache.local_address(AF_INET, ('127.0.1.1', 5060))
+        self.assertEqual((cache.hits, cache.misses), (3, 5))
+
+    def unregistered_dgram_proxy(self, tp, **kwargs):
+        lad = ListenDescription(
+            name='127.0.0.1', sock_family=AF_INET, sock_type=SOCK_DGRAM,
+            port=0, **kwargs)
+        lsck = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(lsck.close)
+        lsck.bind(('127.0.0.1', 0))
+        lsck.setblocking(False)
+        lad.port = lsck.getsockname()[1]
+
+        # Not added to the transport so that the RetryThread doesn't read
+        # from it too.
+        return SocketProxy(
+            local_address=lad, socket=lsck, owner=self, transport=tp)
+
+    def test_dgram_batched_receive(self):
+        tp = Transport()
+        lprx = self.unregistered_dgram_proxy(tp)
+        lsck = lprx.socket
+        lprx.max_datagrams_per_select = 3
+
+        ssck = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(ssck.close)
+        for ii in range(5):
+            ssck.sendto(b'datagram %d' % ii, lsck.getsockname())
+
+        log.info('First select reads up to the budget.')
+        lprx.socket_selected(lsck)
+        self.assertEqual(self.datagram_batch_sizes, [3])
+        self.assertEqual(
+            [data for _, _, data in self.data_call_back_call_args],
+            [b'datagram 0', b'datagram 1', b'datagram 2'])
+
+        log.info('Second select reads the rest without blocking.')
+        lprx.socket_selected(lsck)
+        self.assertEqual(self.datagram_batch_sizes, [3, 2])
+        self.assertEqual(len(self.data_call_back_call_args), 5)
+
+        log.info('All datagrams came from the same connected proxy.')
+        csps = set(csp for csp, _, _ in self.data_call_back_call_args)
+        self.assertEqual(len(csps), 1)
+        self.assertIs(csps.pop().socket, lprx)
+
+        lprx.socket_selected(lsck)
+        self.assertEqual(self.datagram_batch_sizes, [3, 2])
+
+    def test_dgram_max_size(self):
+        self.assertRaises(
+            ValueError, ListenDescription, max_datagram_size=0x10000)
+        self.assertEqual(ListenDescription().max_datagram_size, 0xffff)
+
+        tp = Transport()
+        lprx = self.unregistered_dgram_proxy(tp, max_datagram_size=5000)
+        lsck = lprx.socket
+
+        ssck = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(ssck.close)
+        big_data = b'x' * 4999 + b'y'
+        for data in (big_data, big_data + b'z', b'small'):
+            ssck.sendto(data, lsck.getsockname())
+
+        log.info('Datagrams over 4096 bytes are not truncated, and ones '
+                 'over the maximum are discarded.')
+        lprx.socket_selected(lsck)
+        self.assertEqual(
+            [data for _, _, data in self.data_call_back_call_args],
+            [big_data, b'small'])
+
 
 class TestTransportErrors(SIPPartyTestCase):
 
@@ -317,6 +607,7 @@ class TestTransportErrors(SIPPartyTestCase):
             retrythread, 'select', new=self.retry_thread_select)
         select_patch.start()
         self.addCleanup(select_patch.stop)
+        self.patch_retrythread_poller()
 
         self.socket_exception = None
         SocketMock.test_case = self
@@ -363,7 +654,9 @@ class TestTransportErrors(SIPPartyTestCase):
         self.sockname = ('mock-sock', 55555)
 
         ds = Mock(spec=SocketOwner)
-        ds.consume_data = Mock()
+        received = []
+        ds.consume_data = Mock(
+            side_effect=lambda sp, addr, data: received.append(bytes(data)))
         ds.handle_terminal_socket_exception = Mock()
 
         sprxy = tp.get_send_from_address(
@@ -380,7 +673,9 @@ class TestTransportErrors(SIPPartyTestCase):
 
         WaitFor(lambda: ds.consume_data.call_count > 0, timeout_s=0.2)
         self.assertEqual(ds.consume_data.call_count, 1)
-        ds.consume_data.assert_called_with(sprxy, self.peer_name, b'some data')
+        self.assertEqual(ds.consume_data.call_args[0][:2], (
+            sprxy, self.peer_name))
+        self.assertEqual(received, [b'some data'])
 
         log.info('Cause an exception on the socket when reading')
         exc = type('SocketException', (sock_error,), {})(
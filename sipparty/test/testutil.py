@@ -18,12 +18,15 @@ limitations under the License.
 """
 from __future__ import absolute_import
 
+from copy import copy
 import logging
 from six import (add_metaclass, exec_, next, PY2)
+import threading
 from weakref import ref
 from ..util import (
     AsciiBytesEnum, bglobals_g, CCPropsFor, class_or_instance_method, Enum,
-    FirstListItemProxy, Singleton, SingletonType, WeakMethod, WeakProperty)
+    FirstListItemProxy, ShardedWorkerPool, Singleton, SingletonType,
+    StripedDict, WaitFor, WeakMethod, WeakProperty)
 from .base import SIPPartyTestCase
 
 log = logging.getLogger(__name__)
@@ -53,6 +56,11 @@ class TestUtil(SIPPartyTestCase):
 
         self.assertEqual(en[1:3], ["dog", "aardvark"])
 
+        en_copy = copy(en)
+        en_copy.add("horse")
+        self.assertEqual(list(en), ["cat", "dog", "aardvark", "mouse"])
+        self.assertEqual(en_copy[-1], "horse")
+
     def testBytesEnum(self):
 
         if not PY2:
@@ -278,3 +286,96 @@ class SingletonSubclass1(Singleton, metaclass=SingletonType):
         self.assertIsNone(wc())
         wmth()
         self.assertEqual(results, [1])
+
+    def test_sharded_worker_pool(self):
+        pool = ShardedWorkerPool(3, max_queue_size=2, name='test worker')
+        self.addCleanup(pool.stop)
+
+        log.info('Work with the same key runs in order on one thread.')
+        results = {}
+
+        def record(key, value):
+            results.setdefault(key, []).append(
+                (value, threading.current_thread().name))
+
+        for value in range(20):
+            for key in (b'a', b'b', b'c'):
+                pool.submit(key, record, (key, value), block=True)
+        WaitFor(lambda: sum(
+            stats['processed'] for stats in pool.stats) == 60)
+        for key, values in results.items():
+            self.assertEqual([val for val, _ in values], list(range(20)))
+            self.assertEqual(len(set(name for _, name in values)), 1)
+            self.assertEqual(
+                values[0][1], 'test worker %d' % pool.shard_index(key))
+
+        log.info('Work is dropped when the queue is full.')
+        release = threading.Event()
+        index = pool.shard_index(b'a')
+        processed = pool.stats[index]['processed']
+        self.assertTrue(pool.submit(b'a', release.wait))
+        WaitFor(lambda: pool.queue_depths[index] == 0)
+        self.assertTrue(pool.submit(b'a', record, (b'a', 20)))
+        self.assertTrue(pool.submit(b'a', record, (b'a', 21)))
+        self.assertEqual(pool.queue_depths[index], 2)
+        self.assertFalse(pool.submit(b'a', record, (b'a', 22)))
+        release.set()
+        WaitFor(lambda: pool.stats[index]['processed'] == processed + 3)
+        stats = pool.stats[index]
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['max_depth'], 2)
+        self.assertEqual(
+            [val for val, _ in results[b'a']][-2:], [20, 21])
+
+        log.info('Stopping without waiting does not block on full queues.')
+        pool = ShardedWorkerPool(1, max_queue_size=1, name='stop worker')
+        release = threading.Event()
+        self.addCleanup(release.set)
+        done = []
+        self.assertTrue(pool.submit(None, release.wait))
+        WaitFor(lambda: pool.queue_depths[0] == 0)
+        self.assertTrue(pool.submit(None, done.append, (1,)))
+        pool.stop(wait=False)
+        release.set()
+        pool._swp_threads[0].join(1)
+        self.assertFalse(pool._swp_threads[0].is_alive())
+        self.assertEqual(done, [])
+
+    def test_striped_dict(self):
+        sd = StripedDict(4)
+        self.assertEqual(sd.stripe_count, 4)
+        self.assertRaises(ValueError, StripedDict, 0)
+
+        for ii in range(20):
+            sd[('key', ii)] = ii
+        self.assertEqual(len(sd), 20)
+        self.assertIn(('key', 3), sd)
+        self.assertEqual(sd[('key', 3)], 3)
+        self.assertIsNone(sd.get('missing'))
+        self.assertRaises(KeyError, lambda: sd['missing'])
+        self.assertEqual(sd.setdefault(('key', 3), 'new'), 3)
+        self.assertEqual(sd.pop(('key', 3)), 3)
+        self.assertEqual(sd.pop(('key', 3), None), None)
+        del sd[('key', 4)]
+        self.assertEqual(
+            sorted(sd.values()), [ii for ii in range(20) if ii not in (3, 4)])
+
+        log.info('Iteration is over a snapshot so the dict can change.')
+        for key in sd:
+            del sd[key]
+        self.assertEqual(len(sd), 0)
+
+        log.info('Concurrent writers to one stripe do not lose updates.')
+        sd['count'] = 0
+
+        def increment():
+            for _ in range(1000):
+                with sd.lock_for('count'):
+                    sd['count'] += 1
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        self.assertEqual(sd['count'], 4000)
@@ -27,20 +27,23 @@ on the socket.
 
 from .base import (
     SOCK_TYPES, SOCK_TYPES_NAMES, SOCK_TYPE_IP_NAMES, SOCK_FAMILIES,
-    SOCK_FAMILY_NAMES, DEFAULT_SOCK_FAMILY,
+    SOCK_FAMILY_NAMES, DEFAULT_SOCK_FAMILY, MAX_DATAGRAM_SIZE,
     digitrange, DIGIT, HEXDIG, IPv4address,
     IPv6address, IPaddress, port, hex4_re, IPv4address_re, IPv4address_only_re,
     IPv6address_re, IPv6address_only_re, IPaddress_re, IPaddress_only_re,
     NameAll, NameLANHostname, NameLoopbackAddress, SendFromAddressNameAny,
     SpecialNames, address_as_tuple, AllAddressesFromFamily, default_hostname,
-    IPAddressFamilyFromName, is_null_address, IsSpecialName, IsValidPortNum,
-    IsValidTransportName, LoopbackAddressFromFamily, UnregisteredPortGenerator,
+    IPAddressFamilyFromName, is_null_address, IsSpecialName,
+    IsValidDatagramSize, IsValidPortNum, IsValidTransportName, LoopbackAddressFromFamily, UnregisteredPortGenerator,
     TransportException, BadNetwork, SocketInUseError, SockFamilyName,
-    SockTypeName, SockTypeFromName,
+    SockType, SockTypeName, SockTypeFromName,
     GetBoundSocket,
     ListenDescription, ConnectedAddressDescription,
     SocketOwner,
+    ReceiveBufferPool,
+    LocalAddressCache,
     SocketProxy,
+    SocketProxyIndex,
     Transport
 )
 
@@ -19,24 +19,29 @@ limitations under the License.
 from __future__ import absolute_import
 
 from abc import ABCMeta, abstractmethod
-from collections import Callable
+from collections import Callable, deque, OrderedDict
 from copy import copy
+from errno import EAGAIN, EINPROGRESS, EWOULDBLOCK
 import logging
 from numbers import Integral
+import os
 import re
 from six import iteritems, PY2
+import socket as socket_module
 from socket import (
     AF_INET, AF_INET6, error as socket_error, gaierror,
-    getaddrinfo, gethostname,
-    SHUT_RDWR, socket as socket_class, SOCK_STREAM, SOCK_DGRAM)
+    getaddrinfo, gethostname, inet_pton,
+    SHUT_RDWR, socket as socket_class, SO_ERROR, SOCK_STREAM, SOCK_DGRAM,
+    SOL_SOCKET)
 import sys
+import threading
 from weakref import WeakValueDictionary
 from ..classmaker import classbuilder
 from ..deepclass import (dck, DeepClass)
 from ..fsm import (RetryThread)
 from ..vb import ValueBinder
 from ..util import (
-    abytes, AsciiBytesEnum, astr, bglobals_g, Enum,
+    abytes, AsciiBytesEnum, astr, bglobals_g, Clock, Enum,
     Singleton, Retainable,
     TupleRepresentable, TwoCompatibleThree, WeakMethod, WeakProperty)
 
@@ -51,6 +56,10 @@ SOCK_TYPE_IP_NAMES = AsciiBytesEnum((b"TCP", b"UDP"))
 SOCK_FAMILIES = Enum((AF_INET, AF_INET6))
 SOCK_FAMILY_NAMES = Enum(("IPv4", "IPv6"))
 DEFAULT_SOCK_FAMILY = AF_INET
+# The largest UDP payload is 65507 bytes on IPv4 (a little more on IPv6
+# with jumbograms, which we don't support), so this is enough for any
+# datagram we might receive.
+MAX_DATAGRAM_SIZE = 0xffff
 log = logging.getLogger(__name__)
 prot_log = logging.getLogger(re.sub('\.[^.]+$', '.messages', __name__))
 
@@ -265,6 +274,10 @@ def IsValidPortNum(port):
     return 0 < port <= 0xffff
 
 
+def IsValidDatagramSize(size):
+    return isinstance(size, Integral) and 0 < size <= MAX_DATAGRAM_SIZE
+
+
 def IsValidTransportName(name):
     return isinstance(name, str) or IsSpecialName(name)
 
@@ -330,6 +343,16 @@ def SockTypeName(socktype):
     raise TypeError('%r is not one of %r' % (socktype, SOCK_TYPES))
 
 
+# Python < 3.7 on Linux includes these in socket.type once they have been set.
+SOCK_TYPE_FLAGS = (
+    getattr(socket_module, 'SOCK_NONBLOCK', 0) |
+    getattr(socket_module, 'SOCK_CLOEXEC', 0))
+
+
+def SockType(sck):
+    return sck.type & ~SOCK_TYPE_FLAGS
+
+
 def SockTypeFromName(socktypename):
     if socktypename == SOCK_TYPE_IP_NAMES.TCP:
         return SOCK_STREAM
@@ -338,13 +361,18 @@ def SockTypeFromName(socktypename):
     assert socktypename in SOCK_TYPE_IP_NAMES
 
 
-def GetBoundSocket(family, socktype, address, port_filter=None):
+def GetBoundSocket(family, socktype, address, port_filter=None,
+                   reuse_port=False):
     """
     :param int family: The socket family, one of AF_INET or AF_INET6.
     :param int socktype: The socket type, SOCK_STREAM or SOCK_DGRAM.
     :param tuple address: The address / port pair, like ("localhost", 5060).
     Pass None for the address or 0 for the port to choose a locally exposed IP
     address if there is one, and an arbitrary free port.
+    :param bool reuse_port:
+        Set SO_REUSEPORT, so that several processes can bind the same address
+        and the system shares the incoming packets and connections between
+        them.
     """
 
     if family is None:
@@ -384,6 +412,12 @@ def GetBoundSocket(family, socktype, address, port_filter=None):
 
     _family, _socktype, _proto, _canonname, ai_address = addrinfos[0]
     ssocket = socket_class(_family, _socktype)
+    if reuse_port:
+        so_reuseport = getattr(socket_module, 'SO_REUSEPORT', None)
+        if so_reuseport is None:
+            ssocket.close()
+            raise BadNetwork('SO_REUSEPORT is not supported here.', None)
+        ssocket.setsockopt(SOL_SOCKET, so_reuseport, 1)
 
     # Clean the address, which on some devices if it's IPv6 will have the name
     # of the interface appended after a % character.
@@ -464,17 +498,24 @@ def GetBoundSocket(family, socktype, address, port_filter=None):
                 dck.check: lambda x: IsValidTransportName(x)},
             'flowinfo': {dck.check: lambda x: isinstance(x, Integral)},
             'scopeid': {dck.check: lambda x: isinstance(x, Integral)},
-            'port_filter': {dck.check: lambda x: isinstance(x, Callable)}}),
+            'port_filter': {dck.check: lambda x: isinstance(x, Callable)},
+            'max_datagram_size': {
+                dck.check: IsValidDatagramSize,
+                dck.gen: lambda: MAX_DATAGRAM_SIZE},
+            'reuse_port': {dck.gen: lambda: False}}),
         ValueBinder,
         TupleRepresentable))
 class ListenDescription:
 
+    # The backlog passed to listen() for stream sockets.
+    listen_backlog = 128
+
     @classmethod
     def description_from_socket(cls, sck):
         sname = sck.getsockname()
 
         addr = cls(
-            name=sname[0], sock_family=sck.family, sock_type=sck.type,
+            name=sname[0], sock_family=sck.family, sock_type=SockType(sck),
             port=sname[1], flowinfo=None if len(sname) == 2 else sname[2],
             scopeid=None if len(sname) == 2 else sname[3])
         return addr
@@ -525,9 +566,17 @@ class ListenDescription:
         """
         lsck = GetBoundSocket(
             self.sock_family, self.sock_type, self.sockname_tuple,
-            self.port_filter)
+            self.port_filter, reuse_port=self.reuse_port)
 
         laddr = self.description_from_socket(lsck)
+        laddr.max_datagram_size = self.max_datagram_size
+        laddr.reuse_port = self.reuse_port
+        if laddr.sock_type == SOCK_STREAM:
+            lsck.listen(self.listen_backlog)
+
+        # So that datagrams or connections can be drained until there are no
+        # more.
+        lsck.setblocking(False)
 
         log.info('New listen socket %s', laddr)
 
@@ -557,11 +606,15 @@ class ConnectedAddressDescription(
         ListenDescription):
 
     @classmethod
-    def description_from_socket(cls, sck):
+    def description_from_socket(cls, sck, peername=None):
+        """:param peername:
+            The remote address, if the socket is still connecting and so
+            getpeername() would fail.
+        """
         cad = super(ConnectedAddressDescription, cls).description_from_socket(
             sck)
 
-        pname = sck.getpeername()
+        pname = sck.getpeername() if peername is None else peername
         cad.remote_name, cad.remote_port = pname[:2]
 
         # TODO: need to do anything to support flowinfo and scopeid?
@@ -597,21 +650,40 @@ class ConnectedAddressDescription(
 
         log.debug('Connect socket using %r', self)
         sck = socket_class(self.sock_family, self.sock_type)
-        sck.bind(self.sockname_tuple)
-        log.debug(
-            'Bind socket to %r, result %r', self.sockname_tuple,
-            sck.getsockname())
-        sck.connect(self.remote_sockname_tuple)
-        log.debug(
-            'Connect to %r, result (%r --> %r)', self.remote_sockname_tuple,
-            sck.getsockname(), sck.getpeername())
+        in_progress = False
+        try:
+            sck.bind(self.sockname_tuple)
+            log.debug(
+                'Bind socket to %r, result %r', self.sockname_tuple,
+                sck.getsockname())
+            if self.sock_type == SOCK_STREAM:
+                # Don't wait for the handshake, data is queued until the
+                # socket is writable, which is when the connect completes.
+                sck.setblocking(False)
+                err = sck.connect_ex(self.remote_sockname_tuple)
+                if err in (EINPROGRESS, EWOULDBLOCK):
+                    in_progress = True
+                elif err != 0:
+                    raise socket_error(err, os.strerror(err))
+            else:
+                sck.connect(self.remote_sockname_tuple)
+                sck.setblocking(False)
+        except socket_error:
+            sck.close()
+            raise
 
-        laddr = ConnectedAddressDescription.description_from_socket(sck)
-        log.info('New connected socket: %s', laddr)
+        laddr = ConnectedAddressDescription.description_from_socket(
+            sck, peername=self.remote_sockname_tuple if in_progress else None)
+        laddr.max_datagram_size = self.max_datagram_size
+        log.info(
+            'New connected socket%s: %s',
+            ' (connecting)' if in_progress else '', laddr)
 
         csck = SocketProxy(
             local_address=laddr, socket=sck, owner=owner,
             is_connected=True, transport=transport)
+        if in_progress:
+            csck.begin_connecting()
         return csck
 
     def __str__(self):
@@ -643,14 +715,38 @@ class SocketOwner:
             `socket` module style address tuple.
 
             E.g. `('127.0.0.1', 12345)` for an IPv4 address.
-        :param bytes data:
-            The data that was received. No guarantee is given that this is a
-            complete packet or that it has a certain length or anything.
+        :param data:
+            The data that was received, as a `memoryview` (`bytes` on Python
+            2) that is only valid for the duration of the call, so copy it if
+            it needs to be kept. No guarantee is given that this is a complete
+            packet or that it has a certain length or anything.
+        :returns:
+            For streams, the number of bytes at the start of `data` that have
+            been consumed. Data not consumed is passed again, with more
+            appended, when more is received. `None` means all of it.
         """
         raise NotImplementedError(
             'consume_data must be implemented by concrete subclasses of '
             'SocketOwner')
 
+    def consume_datagrams(self, datagrams):
+        """Optional: Consume a batch of datagrams received together.
+
+        :param list datagrams:
+            `(socket_proxy, remote_address, data)` tuples in the order they
+            were received, each as would be passed to `consume_data`.
+
+        The default implementation passes each datagram to `consume_data`,
+        logging any exception so that the rest of the batch is still
+        consumed.
+        """
+        for socket_proxy, remote_address, data in datagrams:
+            try:
+                self.consume_data(socket_proxy, remote_address, data)
+            except Exception:
+                log.exception(
+                    'Exception consuming datagram from %s', remote_address)
+
     def handle_closed_socket(self, socket_proxy):
         """Optional: Handle a normal socket closure.
 
@@ -686,6 +782,18 @@ class SocketOwner:
             SockTypeName(socket_proxy.type),
             socket_proxy.getsockname(), exception))
 
+    def handle_connect_failure(self, socket_proxy, exception, unsent_data):
+        """Optional: Handle failure of a connect that was still in progress
+        when the socket proxy was returned.
+
+        :param list unsent_data:
+            The data that was queued to send on the socket, which has been
+            discarded.
+
+        The default implementation calls `handle_terminal_socket_exception`.
+        """
+        self.handle_terminal_socket_exception(socket_proxy, exception)
+
     def handle_terminal_socket_exception(self, socket_proxy, exception):
         """Optional: Handle a terminal exception.
 
@@ -699,6 +807,96 @@ class SocketOwner:
             socket_proxy.getsockname(), exception))
 
 
+class ReceiveBufferPool(object):
+    """A pool of preallocated buffers to receive datagrams into, so that
+    receiving does not allocate a new bytes object per datagram.
+    """
+
+    buffer_size = MAX_DATAGRAM_SIZE + 1
+    max_free_buffers = 64
+
+    def __init__(self):
+        super(ReceiveBufferPool, self).__init__()
+        self._rbp_freeBuffers = []
+
+    def acquire(self):
+        try:
+            return self._rbp_freeBuffers.pop()
+        except IndexError:
+            return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        if len(self._rbp_freeBuffers) < self.max_free_buffers:
+            self._rbp_freeBuffers.append(buf)
+
+
+class LocalAddressCache(object):
+    """Remembers the local address that the system routes to each remote
+    subnet from, so that working out the address to use for a new peer of a
+    listen socket bound to a null address doesn't need a socket each time.
+    """
+
+    max_entries = 4096
+
+    # Seconds before an entry is looked up again, in case routes change.
+    ttl = 60
+
+    # Remote addresses with the same leading bytes are assumed to share a
+    # route.
+    prefix_bytes = {AF_INET: 3, AF_INET6: 8}
+
+    def __init__(self):
+        super(LocalAddressCache, self).__init__()
+        self._lac_entries = OrderedDict()
+        self._lac_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def local_address(self, sock_family, remote_address):
+        """:returns: The local address to talk to `remote_address` from."""
+        key = self._lac_key(sock_family, remote_address[0])
+        now = Clock()
+        entries = self._lac_entries
+        with self._lac_lock:
+            entry = entries.pop(key, None)
+            if entry is not None and now < entry[1]:
+                # Move it to the most recently used end.
+                entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        lname = self._lac_resolve(sock_family, remote_address)
+        with self._lac_lock:
+            entries[key] = (lname, now + self.ttl)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+        return lname
+
+    def clear(self):
+        with self._lac_lock:
+            self._lac_entries.clear()
+
+    def _lac_key(self, sock_family, remote_name):
+        try:
+            packed = inet_pton(sock_family, remote_name)
+        except (socket_error, ValueError):
+            return sock_family, remote_name
+        return sock_family, packed[:self.prefix_bytes[sock_family]]
+
+    @staticmethod
+    def _lac_resolve(sock_family, remote_address):
+        # Connecting a UDP socket doesn't send anything, but does make the
+        # system choose the local address.
+        log.debug('Find local address for %s', remote_address[0])
+        tsck = socket_class(sock_family, SOCK_DGRAM)
+        try:
+            tsck.connect(remote_address)
+            return tsck.getsockname()[0]
+        finally:
+            tsck.close()
+
+
 class SocketProxy(
         DeepClass('_sck_', {
             'local_address': {dck.check: lambda x: isinstance(
@@ -717,39 +915,135 @@ class SocketProxy(
     socket_proxies = []
     socket_info = {}
 
+    # The most datagrams read from a non-blocking socket each time it is
+    # selected. Since the RetryThread services every ready socket on each
+    # pass, this stops one flooded socket from starving the others.
+    max_datagrams_per_select = 64
+
+    # Datagrams are only ever received on the RetryThread, so one pool does.
+    receive_buffer_pool = ReceiveBufferPool()
+
+    # Routes are the same for every socket, so the cache is shared.
+    local_address_cache = LocalAddressCache()
+
+    # The most connections accepted on a listen socket each time it is
+    # selected, for the same reason as max_datagrams_per_select.
+    max_accepts_per_select = 16
+
+    stream_read_size = 0x10000
+
+    # If a stream buffers more than this without its owner consuming any of
+    # it, the stream is not framed properly, so it is closed.
+    max_stream_buffer_size = 0x40000
+
+    def __init__(self, **kwargs):
+        super(SocketProxy, self).__init__(**kwargs)
+
+        # Outbound (data, remote address) pairs not yet sent, because the
+        # socket was not writable. The remote address is None for connected
+        # sockets.
+        self._sck_sendQueue = deque()
+        self._sck_sendLock = threading.Lock()
+        self._sck_waitingForWritable = False
+        self._sck_connecting = False
+        self._sck_lastActivityTime = self._sck_lastSendTime = Clock()
+
+        # Data received on a stream that the owner hasn't yet consumed.
+        self._sck_recvBuffer = bytearray()
+
+        # Whether the local address is a null address, worked out when first
+        # needed.
+        self._sck_isNullAddress = None
+
     @property
     def family(self):
         return self.socket.family
 
     @property
     def type(self):
-        return self.socket.type
+        return SockType(self.socket)
+
+    @property
+    def max_datagram_size(self):
+        lad = self.local_address
+        if lad is None:
+            return MAX_DATAGRAM_SIZE
+        return lad.max_datagram_size
 
     def getsockname(self):
         return self.socket.getsockname()
 
+    @property
+    def send_queue_length(self):
+        return len(self._sck_sendQueue)
+
+    @property
+    def is_connecting(self):
+        return self._sck_connecting
+
+    @property
+    def last_activity_time(self):
+        """The `Clock` time data was last sent or received, not counting
+        keepalives."""
+        return self._sck_lastActivityTime
+
+    @property
+    def last_send_time(self):
+        """The `Clock` time data (including keepalives) was last sent."""
+        return self._sck_lastSendTime
+
+    def begin_connecting(self):
+        """Mark the socket as having a connect in progress, so that data is
+        queued until it completes.
+        """
+        with self._sck_sendLock:
+            self._sck_connecting = True
+            self._sck_wait_for_writable(True)
+
     def send(self, data):
+        self.send_many((data,))
 
-        sck = self.socket
+    def send_keepalive(self, data):
+        """Send `data`, without it counting as activity on the socket."""
+        self.send_many((data,), is_activity=False)
 
-        def log_send(sname, pname, data):
+    def send_many(self, datas, is_activity=True):
+        """Send each of the `datas` in order.
 
-            prot_log.info(
-                "Sent %r -> %r\n>>>>>\n%s\n>>>>>", sname, pname,
-                Transport.FormatBytesForLogging(data))
+        As much as possible is sent immediately, and the rest is queued and
+        sent from the RetryThread when the socket is writable, so this does
+        not block on a non-blocking socket whose send buffer is full.
 
+        If sending fails other than because the socket would block, the data
+        being sent is dropped, the rest is still sent and the first exception
+        is re-raised.
+        """
+        sck = self.socket
         if isinstance(sck, socket_class):
-            log_send(sck.getsockname(), sck.getpeername(), data)
-            return sck.send(data)
+            sck_proxy = self
+            paddr = None
+        else:
+            # Socket shares a socket, so need to sendto.
+            sck_proxy = sck
+            assert(SockType(sck_proxy.socket) == SOCK_DGRAM)
+            paddr = self.local_address.remote_sockname_tuple
+
+        now = Clock()
+        self._sck_lastSendTime = now
+        if is_activity:
+            self._sck_lastActivityTime = now
+        with sck_proxy._sck_sendLock:
+            sck_proxy._sck_sendQueue.extend((data, paddr) for data in datas)
+            if sck_proxy._sck_waitingForWritable:
+                log.debug('Queued data until socket is writable')
+                return
+            exceptions = sck_proxy._sck_flush_send_queue()
 
-        # Socket shares a socket, so need to sendto.
-        sck = sck.socket
-        assert(sck.type == SOCK_DGRAM)
-        paddr = self.local_address.remote_sockname_tuple
-        log_send(sck.getsockname(), paddr, data)
-        sck.sendto(data, paddr)
+        if exceptions:
+            raise exceptions[0]
 
     def close(self):
+        self._sck_sendQueue.clear()
         sck = self.socket
         if isinstance(sck, socket_class):
             try:
@@ -762,9 +1056,40 @@ class SocketProxy(
     #
     # =================== CALLBACKS ===========================================
     #
+    def socket_writable(self, sock):
+        assert sock is self.socket, (sock, self.socket)
+        connect_exc = None
+        with self._sck_sendLock:
+            if self._sck_connecting:
+                self._sck_connecting = False
+                err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+                if err != 0:
+                    log.debug('Connect failed: %s', os.strerror(err))
+                    connect_exc = socket_error(err, os.strerror(err))
+                    unsent_data = [data for data, _ in self._sck_sendQueue]
+                    self._sck_sendQueue.clear()
+                else:
+                    log.debug('Connected %s', self.local_address)
+
+            if connect_exc is None:
+                exceptions = self._sck_flush_send_queue()
+
+        owner = self.owner
+        if connect_exc is not None:
+            if owner is not None:
+                owner.handle_connect_failure(self, connect_exc, unsent_data)
+            self._sck_remove_from_transport()
+            return
+
+        for exc in exceptions:
+            if owner is None:
+                log.warning('Exception sending with no owner: %s', exc)
+                continue
+            owner.handle_nonterminal_socket_exception(self, exc)
+
     def socket_selected(self, sock):
         assert sock is self.socket, (sock, self.socket)
-        if sock.type == SOCK_STREAM:
+        if SockType(sock) == SOCK_STREAM:
             return self._stream_socket_selected()
         return self._dgram_socket_selected()
 
@@ -793,86 +1118,232 @@ class SocketProxy(
     # =================== INTERNAL METHODS ====================================
     #
     def _stream_socket_selected(self):
-        self._readable_socket_selected()
-
-    def _dgram_socket_selected(self):
-        self._readable_socket_selected()
-
-    def _readable_socket_selected(self):
-
-        sname = self.getsockname()
+        if self.is_connected:
+            if self._sck_connecting:
+                # A failed connect is readable before it is writable, so
+                # finish the connect first.
+                self.socket_writable(self.socket)
+                if self.socket is None:
+                    return
+            self._readable_socket_selected()
+        else:
+            self._listen_socket_selected()
 
+    def _listen_socket_selected(self):
+        """Accept new connections on a listen socket."""
         owner = self.owner
         if owner is None:
             log.warning('No owner for %r' % (self,))
             return
 
-        log.debug(
-            '%s.recvfrom %s local:%r', type(self.socket).__name__,
-            SockTypeName(self.socket.type), sname)
-        try:
-            data, addr = self.socket.recvfrom(4096)
-        except socket_error as exc:
-            log.debug('Exception %s receiving data', exc)
-            owner.handle_terminal_socket_exception(self, exc)
-            if PY2:
-                sys.exc_clear()
-            return
-
         tp = self.transport
         if tp is None:
             log.warning('No transport for %r' % (self,))
             return
 
-        if len(data) == 0:
-            log.debug('Socket is closed')
-            owner.handle_closed_socket(self)
-            tp.release_listen_address(self.local_address)
+        sck = self.socket
+        budget = (
+            self.max_accepts_per_select if sck.gettimeout() == 0.0 else 1)
+        for _ in range(budget):
+            try:
+                csck, addr = sck.accept()
+            except socket_error as exc:
+                if exc.args and exc.args[0] in (EAGAIN, EWOULDBLOCK):
+                    break
+                owner.handle_nonterminal_socket_exception(self, exc)
+                if PY2:
+                    sys.exc_clear()
+                break
+
+            csck.setblocking(False)
+            cad = ConnectedAddressDescription.description_from_socket(csck)
+            log.info('Accepted connection %s', cad)
+            csp = SocketProxy(
+                local_address=cad, socket=csck, owner=owner,
+                is_connected=True, transport=tp)
+            owner.handle_new_connected_socket(csp)
+            tp.add_connected_socket_proxy(csp)
+
+    def _sck_flush_send_queue(self):
+        """Send from the queue until it is empty or the socket would block.
+
+        Must be called with the send lock.
+
+        :returns: A list of the exceptions raised sending data, which was
+            dropped.
+        """
+        sck = self.socket
+        queue = self._sck_sendQueue
+        log_sends = prot_log.isEnabledFor(logging.INFO)
+        exceptions = []
+        while queue:
+            data, paddr = queue[0]
+            try:
+                if paddr is None:
+                    sent = sck.send(data)
+                else:
+                    sent = sck.sendto(data, paddr)
+            except socket_error as exc:
+                if exc.args and exc.args[0] in (EAGAIN, EWOULDBLOCK):
+                    log.debug('Socket not writable, %d queued', len(queue))
+                    self._sck_wait_for_writable(True)
+                    return exceptions
+                log.debug('Exception %s sending data', exc)
+                queue.popleft()
+                exceptions.append(exc)
+                continue
+
+            if log_sends:
+                prot_log.info(
+                    "Sent %r -> %r\n>>>>>\n%s\n>>>>>", sck.getsockname(),
+                    sck.getpeername() if paddr is None else paddr,
+                    Transport.FormatBytesForLogging(data[:sent]))
+
+            if sent < len(data):
+                # Partial send, which only happens on streams.
+                queue[0] = (data[sent:], paddr)
+                continue
+            queue.popleft()
+
+        self._sck_wait_for_writable(False)
+        return exceptions
+
+    def _sck_wait_for_writable(self, wait):
+        if wait == self._sck_waitingForWritable:
             return
 
-        prot_log.info(
-            " received %r -> %r\n<<<<<\n%s\n<<<<<", addr, sname,
-            Transport.FormatBytesForLogging(data))
+        tp = self.transport
+        if tp is None:
+            log.warning(
+                'No transport for %r to wait for it to be writable', self)
+            return
 
-        if self.is_connected:
-            log.debug('Passing connected socket data to owner %r', owner)
-            owner.consume_data(self, addr, data)
+        self._sck_waitingForWritable = wait
+        if wait:
+            tp.watch_for_writable(self)
+        else:
+            tp.stop_watching_for_writable(self)
+
+    def _dgram_socket_selected(self):
+        """Read datagrams until there are no more or the budget is used up,
+        and pass them to the owner together.
+
+        Datagrams are received into buffers from the receive_buffer_pool and
+        passed to the owner as memoryviews, which are released once the owner
+        has consumed them, so owners must copy any data they want to keep.
+        """
+        owner = self.owner
+        if owner is None:
+            log.warning('No owner for %r' % (self,))
             return
 
+        sck = self.socket
+        budget = (
+            self.max_datagrams_per_select if sck.gettimeout() == 0.0 else 1)
+        max_size = self.max_datagram_size
+        pool = self.receive_buffer_pool
+        log_datagrams = prot_log.isEnabledFor(logging.INFO)
+        buffers = []
+        datagrams = []
+        exception = None
+        try:
+            for _ in range(budget):
+                buf = pool.acquire()
+                buffers.append(buf)
+                try:
+                    # Ask for one more byte than we allow so that we can tell
+                    # if the datagram was too large.
+                    nbytes, addr = sck.recvfrom_into(buf, max_size + 1)
+                except socket_error as exc:
+                    if exc.args and exc.args[0] in (EAGAIN, EWOULDBLOCK):
+                        break
+                    log.debug('Exception %s receiving data', exc)
+                    exception = exc
+                    if PY2:
+                        sys.exc_clear()
+                    break
+
+                if nbytes == 0:
+                    # An empty datagram is not an error (unlike on a stream),
+                    # but there is nothing to consume.
+                    continue
+
+                if nbytes > max_size:
+                    log.warning(
+                        'Discarding datagram from %r larger than %d bytes',
+                        addr, max_size)
+                    continue
+
+                if PY2:
+                    # Python 2's re module can't search memoryviews.
+                    data = bytes(buf[:nbytes])
+                else:
+                    data = memoryview(buf)[:nbytes]
+
+                if log_datagrams:
+                    prot_log.info(
+                        " received %r -> %r\n<<<<<\n%s\n<<<<<", addr,
+                        self.getsockname(),
+                        Transport.FormatBytesForLogging(bytes(data)))
+
+                if self.is_connected:
+                    datagrams.append((self, addr, data))
+                    continue
+
+                csp = self._connected_proxy_for_remote(addr)
+                if csp is not None:
+                    datagrams.append((csp, addr, data))
+
+            if len(datagrams) == 1:
+                owner.consume_data(*datagrams[0])
+            elif datagrams:
+                log.debug('Pass %d datagrams to owner', len(datagrams))
+                owner.consume_datagrams(datagrams)
+        finally:
+            if not PY2:
+                for _, _, data in datagrams:
+                    data.release()
+            for buf in buffers:
+                pool.release(buf)
+
+        if exception is not None:
+            owner.handle_terminal_socket_exception(self, exception)
+
+    def _connected_proxy_for_remote(self, addr):
+        """Get the connected socket proxy using this listen socket to talk to
+        `addr`, creating it if this is the first data from `addr`.
+        """
+        tp = self.transport
+        if tp is None:
+            log.warning('No transport for %r' % (self,))
+            return None
+
+        csp = self.connected_sockets.get(addr)
+        if csp is not None:
+            return csp
+
         # Receiving data on non-connected socket can happen to UDP listen
         # sockets, which aren't bound to a remote address.
         lad = self.local_address
-        if is_null_address(lad.name):
+        if self._sck_isNullAddress is None:
+            self._sck_isNullAddress = is_null_address(lad.name)
+        if self._sck_isNullAddress:
             # if we're listening on a null address, then we need to fix the
-            # address we actually received on. This is quite quick (since a
-            # connect on UDP is not really a connect), but it's not an
-            # ideal solution (as will probably generate some control
-            # packets at least), but this is optimized for flexibility /
-            # ease of use so worth it. If you don't want this, don't use
-            # null addresses to listen on!
+            # address we actually received on, which is the one the system
+            # would send to addr from.
             log.debug('null listen address, convert to reachable')
-            tsck = socket_class(lad.sock_family, lad.sock_type)
-            tsck.connect(addr)
-            lname = tsck.getsockname()[0]
-            tsck.close()
+            lname = self.local_address_cache.local_address(
+                lad.sock_family, addr)
         else:
             lname = lad.sockname_tuple[0]
         log.debug('Use local address %s', lname)
 
-        csp = self.connected_sockets.get((lname, addr))
-        if csp is not None:
-            log.debug('Passing connected socket data to owner')
-            owner.consume_data(csp, addr, data)
-            return
-
         log.debug('First receipt of data on this listen socket')
         # Therefore need to create a new 'connected' socket proxy that
         # uses our socket to send on.
-
-        desc = self.local_address
         cad = ConnectedAddressDescription(
-            sock_family=desc.sock_family, sock_type=desc.sock_type,
-            name=lname, port=desc.port,
+            sock_family=lad.sock_family, sock_type=lad.sock_type,
+            name=lname, port=lad.port,
             remote_name=addr[0], remote_port=addr[1])
         csp = SocketProxy(
             local_address=cad, socket=self, is_connected=True,
@@ -880,11 +1351,248 @@ class SocketProxy(
         log.info(
             'New connected socket proxy using UDP listen socket: '
             '%s' % (cad,))
-        self.connected_sockets[(lname, addr)] = csp
-        owner.handle_new_connected_socket(csp)
+        self.connected_sockets[addr] = csp
+        owner = self.owner
+        if owner is not None:
+            owner.handle_new_connected_socket(csp)
         tp.add_connected_socket_proxy(csp)
-        owner.consume_data(csp, addr, data)
-        log.debug('_readable_socket_selected done')
+        return csp
+
+    def _readable_socket_selected(self):
+        """Read from a connected stream, and pass the owner the data it has
+        not yet consumed until it stops consuming any.
+        """
+        owner = self.owner
+        if owner is None:
+            log.warning('No owner for %r' % (self,))
+            return
+
+        sck = self.socket
+        log.debug(
+            '%s.recv %s local:%r', type(sck).__name__,
+            SockTypeName(self.type), self.local_address)
+        try:
+            data = sck.recv(self.stream_read_size)
+        except socket_error as exc:
+            if exc.args and exc.args[0] in (EAGAIN, EWOULDBLOCK):
+                return
+            log.debug('Exception %s receiving data', exc)
+            self._sck_stream_closed(exc)
+            if PY2:
+                sys.exc_clear()
+            return
+
+        if len(data) == 0:
+            log.debug('Socket is closed')
+            self._sck_stream_closed()
+            return
+
+        self._sck_lastActivityTime = Clock()
+        lad = self.local_address
+        addr = (
+            lad.remote_sockname_tuple
+            if isinstance(lad, ConnectedAddressDescription) else
+            sck.getpeername())
+        if prot_log.isEnabledFor(logging.INFO):
+            prot_log.info(
+                " received %r -> %r\n<<<<<\n%s\n<<<<<", addr,
+                self.getsockname(), Transport.FormatBytesForLogging(data))
+
+        buf = self._sck_recvBuffer
+        buf.extend(data)
+        consumed = self._sck_consume_stream(owner, addr, buf)
+        del buf[:consumed]
+
+        if len(buf) > self.max_stream_buffer_size:
+            log.warning(
+                'Closing %s which has %d unconsumed bytes', lad, len(buf))
+            self._sck_stream_closed()
+
+    def _sck_consume_stream(self, owner, addr, buf):
+        """Pass the owner the data in `buf` until it stops consuming it.
+
+        :returns: the number of bytes consumed.
+        """
+        offset = 0
+        view = buf if PY2 else memoryview(buf)
+        try:
+            while offset < len(buf):
+                data = view[offset:]
+                if PY2:
+                    data = bytes(data)
+                log.debug('Passing socket data to owner %r', owner)
+                try:
+                    consumed = owner.consume_data(self, addr, data)
+                finally:
+                    if not PY2:
+                        data.release()
+                if consumed is None:
+                    # Owner doesn't report what it consumed, so it had all.
+                    consumed = len(buf) - offset
+                if not consumed:
+                    break
+                offset += consumed
+        finally:
+            if not PY2:
+                view.release()
+        return offset
+
+    def _sck_stream_closed(self, exception=None):
+        """Tell the owner the stream is closed, or has failed with
+        `exception`, and remove it from the transport.
+        """
+        owner = self.owner
+        if owner is not None:
+            if exception is None:
+                owner.handle_closed_socket(self)
+            else:
+                owner.handle_terminal_socket_exception(self, exception)
+        self._sck_remove_from_transport()
+
+    def _sck_remove_from_transport(self):
+        self._sck_recvBuffer = bytearray()
+        tp = self.transport
+        if tp is None:
+            log.warning('No transport for %r' % (self,))
+            return
+        tp.close_socket_proxy(self)
+
+
+class SocketProxyIndex(object):
+    """Socket proxies indexed by their addresses.
+
+    Each proxy is stored under the key of its local address (see `key_for`).
+    Lookups with wildcards use secondary indexes of the proxies with the same
+    remote address, and the same remote address and local name, so that they
+    only need to check the few proxies that share those.
+    """
+
+    @staticmethod
+    def key_for(description):
+        """:returns:
+            `(sock_family, sock_type, remote_name, remote_port, name, port,
+            flowinfo, scopeid)` for `description`, where the remote parts are
+            `None` for listen addresses and the IPv6 parts are `None` for
+            other families.
+        """
+        if isinstance(description, ConnectedAddressDescription):
+            remote_name = description.remote_name
+            remote_port = description.remote_port
+        else:
+            remote_name = remote_port = None
+
+        if description.sock_family == AF_INET6:
+            flowinfo = description.flowinfo
+            scopeid = description.scopeid
+        else:
+            flowinfo = scopeid = None
+
+        return (
+            description.sock_family, description.sock_type, remote_name,
+            remote_port, description.name, description.port, flowinfo,
+            scopeid)
+
+    def __init__(self):
+        super(SocketProxyIndex, self).__init__()
+        self._spi_lock = threading.Lock()
+        self._spi_proxies = {}
+        self._spi_byRemote = {}
+        self._spi_byRemoteAndName = {}
+
+    def __len__(self):
+        return len(self._spi_proxies)
+
+    def values(self):
+        with self._spi_lock:
+            return list(self._spi_proxies.values())
+
+    def add(self, socket_proxy):
+        key = self.key_for(socket_proxy.local_address)
+        with self._spi_lock:
+            self._spi_proxies[key] = socket_proxy
+            self._spi_byRemote.setdefault(key[:4], {})[key] = socket_proxy
+            self._spi_byRemoteAndName.setdefault(key[:5], {})[key] = (
+                socket_proxy)
+
+    def remove(self, socket_proxy):
+        """Remove `socket_proxy`.
+
+        :returns: `False` if `socket_proxy` wasn't in the index.
+        """
+        key = self.key_for(socket_proxy.local_address)
+        with self._spi_lock:
+            if self._spi_proxies.get(key) is not socket_proxy:
+                return False
+
+            del self._spi_proxies[key]
+            for index, index_key in (
+                    (self._spi_byRemote, key[:4]),
+                    (self._spi_byRemoteAndName, key[:5])):
+                bucket = index[index_key]
+                del bucket[key]
+                if not bucket:
+                    del index[index_key]
+        return True
+
+    def find(self, description):
+        """Find a proxy matching `description`.
+
+        The socket family and type may be `None` to match any, the name may
+        be `NameAll` or `SendFromAddressNameAny`, the port may be 0 or `None`
+        to match any port that passes the description's `port_filter`, and
+        the IPv6 flowinfo and scopeid may be `None` to match any.
+        """
+        key = self.key_for(description)
+        with self._spi_lock:
+            proxy = self._spi_proxies.get(key)
+            if proxy is not None:
+                return proxy
+
+            sock_family, sock_type, rname, rport, name = key[:5]
+            for family in (
+                    SOCK_FAMILIES if sock_family is None else (sock_family,)):
+                for stype in (
+                        SOCK_TYPES if sock_type is None else (sock_type,)):
+                    if name is SendFromAddressNameAny:
+                        bucket = self._spi_byRemote.get(
+                            (family, stype, rname, rport))
+                    else:
+                        bucket = self._spi_byRemoteAndName.get((
+                            family, stype, rname, rport,
+                            AllAddressesFromFamily(family)
+                            if name is NameAll else name))
+                    if not bucket:
+                        continue
+
+                    for pkey, proxy in iteritems(bucket):
+                        if self._spi_matches(
+                                pkey, key, description.port_filter):
+                            return proxy
+        return None
+
+    def find_any(self, remote_key):
+        """Find a proxy with `remote_key`, `(sock_family, sock_type,
+        remote_name, remote_port)`, from any local address.
+        """
+        with self._spi_lock:
+            bucket = self._spi_byRemote.get(remote_key)
+            if not bucket:
+                return None
+            return next(iter(bucket.values()))
+
+    @staticmethod
+    def _spi_matches(key, find_key, port_filter):
+        port = find_key[5]
+        if port:
+            if key[5] != port:
+                return False
+        elif port_filter is not None and not port_filter(key[5]):
+            return False
+
+        for ii in (6, 7):
+            if find_key[ii] is not None and key[ii] != find_key[ii]:
+                return False
+        return True
 
 
 class Transport(Singleton):
@@ -897,6 +1605,30 @@ class Transport(Singleton):
     DefaultPort = 0
     DefaultFamily = AF_INET
 
+    # Outbound stream connections are pooled by destination. A new
+    # connection is only opened when all the existing ones have data queued,
+    # up to this many.
+    MaxConnectionsPerDestination = 1
+
+    # Pooled connections which haven't sent or received anything (other than
+    # keepalives) for this many seconds are closed. None to keep them open.
+    ConnectionIdleTimeout = 300
+
+    # If not None, ConnectionKeepaliveData is sent on pooled connections
+    # which haven't sent anything for this many seconds.
+    ConnectionKeepaliveInterval = None
+    ConnectionKeepaliveData = None
+
+    # Finding or creating sockets to the same address is serialized by one
+    # of this many locks, so that threads sending to different addresses
+    # don't block each other.
+    LockStripeCount = 16
+
+    # How many (sock_type, sock_family, remote_name, remote_port) lookups
+    # to remember the resolved address of, for get_send_from_address's fast
+    # path.
+    MaxCachedRemoteKeys = 1024
+
     @staticmethod
     def FormatBytesForLogging(mbytes):
         return '\\n\n'.join(
@@ -907,35 +1639,38 @@ class Transport(Singleton):
     #
     @property
     def connected_socket_count(self):
-        return self._tp_count_vals_in_dict(self._tp_connected_sockets)
+        return len(self._tp_connected_sockets)
 
     @property
     def listen_socket_count(self):
-        return self._tp_count_vals_in_dict(self._tp_listen_sockets)
-
-    def _tp_count_vals_in_dict(self, rdict):
-        count = 0
-        for sock in self.yield_vals(rdict):
-            count += 1
-        return count
+        return len(self._tp_listen_sockets)
 
     def __init__(self):
         log.info('%s.__init__()', type(self).__name__)
         super(Transport, self).__init__()
         self._tp_retryThread = RetryThread()
 
-        # Series of dictionaries keyed by (in order):
-        # - socket family (AF_INET etc.)
-        # - socket type (SOCK_STREAM etc.)
-        # - socket name
-        # - socket port
-        self._tp_listen_sockets = {}
-        self._tp_connected_sockets = {}
+        self._tp_listen_sockets = SocketProxyIndex()
+        self._tp_connected_sockets = SocketProxyIndex()
+        self._tp_lockStripes = [
+            threading.RLock() for _ in range(self.LockStripeCount)]
+
+        # The SocketProxyIndex remote keys for get_send_from_address calls
+        # that only give a remote address, keyed by their arguments.
+        self._tp_remoteKeys = {}
+
+        # Lists of outbound stream socket proxies keyed by (sock_family,
+        # sock_type, remote_name, remote_port).
+        self._tp_connectionPool = {}
+
+        # RetryHandles for the next idle / keepalive check of each pooled
+        # connection (or None if there are no checks), keyed by id().
+        self._tp_poolCheckHandles = {}
 
     def listen_for_me(self, owner, sock_type=None, sock_family=None,
                       name=NameAll, port=0, port_filter=None, flowinfo=None,
                       scopeid=None, listen_description=None,
-                      reuse_socket=True):
+                      reuse_socket=True, reuse_port=False):
 
         if listen_description is None:
             sock_family = self.fix_sock_family(sock_family)
@@ -947,25 +1682,23 @@ class Transport(Singleton):
             provisional_laddr = ListenDescription(
                 sock_family=sock_family, sock_type=sock_type, name=name,
                 port=port, flowinfo=flowinfo, scopeid=scopeid,
-                port_filter=port_filter)
+                port_filter=port_filter, reuse_port=reuse_port)
         else:
             provisional_laddr = copy(listen_description)
         provisional_laddr.deduce_missing_values()
 
-        tpl = self.convert_listen_description_into_find_tuple(
-            provisional_laddr)
-        path, lsck = self.find_cached_object(self._tp_listen_sockets, tpl)
+        with self._tp_lock_for(SocketProxyIndex.key_for(provisional_laddr)):
+            lsck = self._tp_listen_sockets.find(provisional_laddr)
+            if lsck is not None:
+                if reuse_socket:
+                    lsck.retain()
+                    return lsck.local_address
 
-        if lsck is not None:
-            if reuse_socket:
-                lsck.retain()
-                return lsck.local_address
+                raise SocketInUseError(
+                    'All sockets matcing Description %s are already in '
+                    'use.' % (provisional_laddr,))
 
-            raise SocketInUseError(
-                'All sockets matcing Description %s are already in use.' % (
-                    provisional_laddr))
-
-        lsck = self.create_listen_socket(provisional_laddr, owner)
+            lsck = self.create_listen_socket(provisional_laddr, owner)
         return lsck.local_address
 
     # connect
@@ -1008,8 +1741,25 @@ class Transport(Singleton):
                     ...)
         :param SocketOwner owner: The owner of the socket.
 
+        Stream connections from any local port are taken from the connection
+        pool (see `MaxConnectionsPerDestination`), which closes them when
+        they have been idle for `ConnectionIdleTimeout`.
+
         :returns: SocketProxy instance.
         """
+        fast_key = None
+        if (name is SendFromAddressNameAny and not port and
+                flowinfo is None and scopeid is None and
+                port_filter is None):
+            # Fast path for the common case of only caring about the remote
+            # address, which avoids creating a description.
+            fast_key = (sock_type, sock_family, remote_name, remote_port)
+            remote_key = self._tp_remoteKeys.get(fast_key)
+            if remote_key is not None:
+                sck = self._tp_find_send_from_socket_by_remote(remote_key)
+                if sck is not None:
+                    return sck
+
         if sock_family is None:
             sock_family = IPAddressFamilyFromName(remote_name)
 
@@ -1031,6 +1781,11 @@ class Transport(Singleton):
 
         fsck = self.find_or_create_send_from_socket(cad, owner)
 
+        if fast_key is not None and cad.sock_family is not None:
+            remote_keys = self._tp_remoteKeys
+            if len(remote_keys) >= self.MaxCachedRemoteKeys:
+                remote_keys.clear()
+            remote_keys[fast_key] = SocketProxyIndex.key_for(cad)[:4]
         return fsck
 
     def create_listen_socket(self, local_address, owner):
@@ -1040,59 +1795,46 @@ class Transport(Singleton):
 
     def find_send_from_socket(self, cad):
         log.debug('Attempt to find send from address')
-        tpl = self.convert_connected_address_description_into_find_tuple(cad)
-        path, sck = self.find_cached_object(self._tp_connected_sockets, tpl)
+        sck = self._tp_connected_sockets.find(cad)
         if sck is not None:
             sck.retain()
-        return path, sck
+        return sck
 
     def find_or_create_send_from_socket(self, cad, owner=None):
 
-        path, sck = self.find_send_from_socket(cad)
-        if sck is not None:
-            log.debug('Found existing send from socket')
-            return sck
+        key = SocketProxyIndex.key_for(cad)
+        with self._tp_lock_for(key):
+            if cad.sock_type == SOCK_STREAM and not cad.port:
+                return self._tp_pooled_connection(cad, owner)
 
-        sck = cad.connect(self, owner)
+            sck = self.find_send_from_socket(cad)
+            if sck is not None:
+                log.debug('Found existing send from socket')
+                return sck
 
-        self.add_connected_socket_proxy(sck, path=path)
+            sck = cad.connect(self, owner)
+            self.add_connected_socket_proxy(sck)
         return sck
 
-    def add_connected_socket_proxy(self, socket_proxy, *args, **kwargs):
+    def add_connected_socket_proxy(self, socket_proxy):
         log.debug('Adding connected socket proxy %s', socket_proxy)
-        tpl = self.convert_connected_address_description_into_find_tuple(
-            socket_proxy.local_address)
-        self._add_socket_proxy(
-            socket_proxy, self._tp_connected_sockets, tpl, *args, **kwargs)
-        log.detail('connected sockets now: %r', self._tp_connected_sockets)
-
-    def add_listen_socket_proxy(self, listen_socket_proxy, *args, **kwargs):
-        tpl = self.convert_listen_description_into_find_tuple(
-            listen_socket_proxy.local_address)
-        self._add_socket_proxy(
-            listen_socket_proxy, self._tp_listen_sockets, tpl, *args, **kwargs)
-
-    def find_cached_object(self, cache_dict, find_tuple):
-
-        log.debug('Find tuple: %r', [_item[0] for _item in find_tuple])
-        full_path_len = len(find_tuple)
-        path = [
-            (key, obj) for key, obj in self.yield_dict_path(
-                cache_dict, find_tuple)]
-
-        log.debug(
-            'Path is %d long, full find tuple is %d long', len(path),
-            full_path_len)
+        self._tp_add_socket_proxy(self._tp_connected_sockets, socket_proxy)
+        log.detail(
+            '%d connected sockets now', len(self._tp_connected_sockets))
 
-        assert not (len(path) == 7 and full_path_len == 8), path[-1]
+    def add_listen_socket_proxy(self, listen_socket_proxy):
+        self._tp_add_socket_proxy(
+            self._tp_listen_sockets, listen_socket_proxy)
 
-        assert len(path) <= full_path_len
-        if len(path) == full_path_len:
-            lsck = path[-1][1]
-            log.debug('Found object %r', lsck)
-            return path, lsck
+    def watch_for_writable(self, socket_proxy):
+        self._tp_retryThread.addOutputFD(
+            socket_proxy.socket, WeakMethod(socket_proxy, 'socket_writable'))
 
-        return path, None
+    def stop_watching_for_writable(self, socket_proxy):
+        try:
+            self._tp_retryThread.rmOutputFD(socket_proxy.socket)
+        except KeyError:
+            pass
 
     def release_listen_address(self, description=None, **kwargs):
         log.debug('Release %r', description)
@@ -1108,17 +1850,8 @@ class Transport(Singleton):
             description = ListenDescription(**kwargs)
             description.deduce_missing_values()
 
-        if isinstance(description, ConnectedAddressDescription):
-            log.debug('Release connected address')
-            root_dict = self._tp_connected_sockets
-            ftup = self.convert_connected_address_description_into_find_tuple(
-                description)
-        else:
-            log.debug('Release listen address')
-            root_dict = self._tp_listen_sockets
-            ftup = self.convert_listen_description_into_find_tuple(description)
-
-        path, lsck = self.find_cached_object(root_dict, ftup)
+        index = self._tp_index_for(description)
+        lsck = index.find(description)
         if lsck is None:
             raise KeyError(
                 '%r was not a known ListenDescription.' % (description,))
@@ -1126,26 +1859,26 @@ class Transport(Singleton):
         lsck.release()
         if not lsck.is_retained:
             log.debug('Listen address no longer retained')
-            ldict = path[-2][1]
-            key = path[-1][0]
+            if index.remove(lsck):
+                self._tp_close_removed_socket_proxy(lsck)
 
-            if isinstance(lsck.socket, socket_class):
-                self._tp_retryThread.rmInputFD(lsck.socket)
-            try:
-                lsck.close()
-            except Exception as exc:
-                log.warning(
-                    'Exception closing socket for %s: %s', self, exc)
-            del ldict[key]
+    def close_socket_proxy(self, socket_proxy):
+        """Close `socket_proxy` and forget it, however many times it has been
+        retained. Does nothing if it has already been closed.
+        """
+        lad = socket_proxy.local_address
+        if not self._tp_index_for(lad).remove(socket_proxy):
+            log.debug('%s already closed', lad)
+            return
+
+        log.debug('Close %s', lad)
+        self._tp_close_removed_socket_proxy(socket_proxy)
 
     def close_all(self):
         """Last ditch attempt to avoid leaving sockets lying around."""
         log.info('Closing all sockets.')
-        for sock_dicts in (
-                self._tp_listen_sockets, self._tp_connected_sockets):
-            socks = [path[-1][1] for path in self.yield_vals(dict(sock_dicts))]
-            for sock in socks:
-                assert sock is not None
+        for index in (self._tp_listen_sockets, self._tp_connected_sockets):
+            for sock in index.values():
                 self.release_listen_address(sock.local_address)
 
     #
@@ -1163,152 +1896,136 @@ class Transport(Singleton):
     #
     # =================== INTERNAL METHODS ====================================
     #
-    def _add_socket_proxy(self, socket_proxy, root_dict, find_tuple, path=()):
+    def _tp_lock_for(self, key):
+        """:returns: The lock stripe for the SocketProxyIndex key `key`."""
+        stripes = self._tp_lockStripes
+        return stripes[hash(key[:4]) % len(stripes)]
+
+    def _tp_index_for(self, description):
+        if isinstance(description, ConnectedAddressDescription):
+            return self._tp_connected_sockets
+        return self._tp_listen_sockets
+
+    def _tp_add_socket_proxy(self, index, socket_proxy):
         if isinstance(socket_proxy.socket, socket_class):
             self._tp_retryThread.addInputFD(
                 socket_proxy.socket,
                 WeakMethod(socket_proxy, 'socket_selected'))
         socket_proxy.retain()
-        full_keys_path = [obj[0] for obj in find_tuple]
-        keys = full_keys_path[len(path):]
-        log.debug('Add new socket proxy at path: %r', keys)
-
-        sub_root = path[-1][1] if len(path) > 0 else root_dict
-        self.insert_cached_object(
-            sub_root, keys, socket_proxy)
-
-    @staticmethod
-    def insert_cached_object(root, path, obj):
-        next_dict = root
-        for key in path[:-1]:
-            new_dict = next_dict.get(key, {})
-            next_dict[key] = new_dict
-            next_dict = new_dict
-        next_dict[path[-1]] = obj
-        return
-
-    @staticmethod
-    def convert_listen_description_into_find_tuple(listen_address):
-
-        pfilter = listen_address.port_filter
+        index.add(socket_proxy)
 
-        def first_entry_if_key_else_new(cond):
-            def find_first_entry(pdict, key):
-                if cond(key):
-                    for key, val in iteritems(pdict):
-                        return key, val
-                return None, None
+    def _tp_find_send_from_socket_by_remote(self, remote_key):
+        if remote_key[1] == SOCK_STREAM:
+            with self._tp_lock_for(remote_key):
+                return self._tp_idle_pooled_connection(remote_key)
 
-            return find_first_entry
-
-        def find_suitable_port(pdict, port):
-            if port:
-                return None, None
-
-            for port, next_dict in iteritems(pdict):
-                if pfilter is None or pfilter(port):
-                    return port, next_dict
-
-            return None, None
-
-        def find_suitable_name(pdict, name):
-            log.debug('Find name for %r in keys %r', name, pdict.keys())
-            if name is NameAll:
-                for _all in (
-                        AllAddressesFromFamily(AF_INET),
-                        AllAddressesFromFamily(AF_INET6)):
-                    if _all in pdict:
-                        return _all, pdict[_all]
-
-                return None, None
-
-            if name is SendFromAddressNameAny:
-                for name, name_dict in iteritems(pdict):
-                    return name, name_dict
+        sck = self._tp_connected_sockets.find_any(remote_key)
+        if sck is not None:
+            sck.retain()
+        return sck
 
-            return None, None
+    def _tp_close_removed_socket_proxy(self, socket_proxy):
+        if isinstance(socket_proxy.socket, socket_class):
+            self._tp_retryThread.rmInputFD(socket_proxy.socket)
+            self.stop_watching_for_writable(socket_proxy)
+
+        if id(socket_proxy) in self._tp_poolCheckHandles:
+            key = self._tp_pool_key(socket_proxy.local_address)
+            with self._tp_lock_for(key):
+                handle = self._tp_poolCheckHandles.pop(id(socket_proxy))
+                if handle is not None:
+                    handle.cancel()
+                conns = self._tp_connectionPool[key]
+                conns.remove(socket_proxy)
+                if not conns:
+                    del self._tp_connectionPool[key]
 
-        def find_suitable_flowinfo_or_scopeid(pdict, val):
-            log.debug(
-                'Find flowinfo or scopeid for %r in keys %r', val,
-                pdict.keys())
-            if val is not None:
-                return None, None
-
-            for name, name_dict in iteritems(pdict):
-                return name, name_dict
-
-            return None, None
-
-        rtup = (
-            (listen_address.sock_family, first_entry_if_key_else_new(
-                lambda key: key is None)),
-            (listen_address.sock_type, first_entry_if_key_else_new(
-                lambda key: key is None)),
-            (listen_address.name, find_suitable_name),
-            (listen_address.port, find_suitable_port),
-            (listen_address.flowinfo, find_suitable_flowinfo_or_scopeid),
-            (listen_address.scopeid, find_suitable_flowinfo_or_scopeid))
-
-        sock_family = listen_address.sock_family or DEFAULT_SOCK_FAMILY
-        if sock_family == AF_INET:
-            return rtup[:-2]
-        return rtup
+        try:
+            socket_proxy.close()
+        except Exception as exc:
+            log.warning(
+                'Exception closing socket for %s: %s', self, exc)
 
     @staticmethod
-    def convert_connected_address_description_into_find_tuple(cad):
-
-        ladtuple = Transport.convert_listen_description_into_find_tuple(cad)
-
-        # The remote address is more significant than the local one. So we
-        # allow a caller to request a connection to a particular address, but
-        # leave the local address undefined.
-
-        return (
-            ladtuple[:2] + ((cad.remote_name, None), (cad.remote_port, None)) +
-            ladtuple[2:])
+    def _tp_pool_key(cad):
+        return (cad.sock_family, cad.sock_type, cad.remote_name,
+                cad.remote_port)
+
+    def _tp_idle_pooled_connection(self, key):
+        for conn in self._tp_connectionPool.get(key, ()):
+            if conn.send_queue_length == 0 and not conn.is_connecting:
+                log.debug('Use pooled connection %s', conn.local_address)
+                return conn
+        return None
 
-    _yield_sentinel = type('YieldDictPathSentinel', (), {})()
+    def _tp_pooled_connection(self, cad, owner):
+        """Get a connection to `cad`'s remote address from the pool, opening
+        a new one if there are none or all are busy and there is room.
+        """
+        key = self._tp_pool_key(cad)
+        conn = self._tp_idle_pooled_connection(key)
+        if conn is not None:
+            return conn
+
+        conns = self._tp_connectionPool.setdefault(key, [])
+        if conns and len(conns) >= self.MaxConnectionsPerDestination:
+            log.debug('Pool full, use least busy connection')
+            return min(conns, key=lambda conn: conn.send_queue_length)
+
+        conn = cad.connect(self, owner)
+        self.add_connected_socket_proxy(conn)
+        conns.append(conn)
+        self._tp_poolCheckHandles[id(conn)] = None
+        log.debug(
+            '%d pooled connections to %s:%s', len(conns), cad.remote_name,
+            cad.remote_port)
+        self._tp_schedule_pooled_connection_check(conn)
+        return conn
+
+    def _tp_schedule_pooled_connection_check(self, conn):
+        times = []
+        if self.ConnectionIdleTimeout is not None:
+            times.append(conn.last_activity_time + self.ConnectionIdleTimeout)
+        if self.ConnectionKeepaliveInterval is not None:
+            times.append(
+                conn.last_send_time + self.ConnectionKeepaliveInterval)
+        if not times:
+            return
 
-    @classmethod
-    def yield_dict_path(cls, root_dict, lookups):
-        next_dict = root_dict
-        sentinel = cls._yield_sentinel
-        for key, finder in lookups:
-            log.debug('Find next key %r from keys %r', key, next_dict.keys())
-            obj = next_dict.get(key, sentinel)
-            if obj is sentinel:
-                if not isinstance(finder, Callable):
-                    return
+        self._tp_poolCheckHandles[id(conn)] = (
+            self._tp_retryThread.addRetryTime(
+                min(times),
+                action=WeakMethod(self, '_tp_check_pooled_connection'),
+                owner=conn))
 
-                key, obj = finder(next_dict, key)
-                if obj is None:
-                    return
-                next_dict[key] = obj
-            yield key, obj
-            if not isinstance(obj, dict):
-                # We're done.
-                return
-            next_dict = obj
+    def _tp_check_pooled_connection(self, conn):
+        """Close `conn` if it has been idle too long, or send a keepalive if
+        it is due.
+        """
+        if conn.socket is None:
+            # Already closed.
+            return
 
-    @classmethod
-    def yield_vals(cls, root_dict, path_so_far=None):
-        """Yield all vals in the dictionary passed in with the path to them."""
-        if path_so_far is None:
-            path_so_far = []
+        now = Clock()
+        idle_timeout = self.ConnectionIdleTimeout
+        if (idle_timeout is not None and conn.send_queue_length == 0 and
+                now >= conn.last_activity_time + idle_timeout):
+            log.info('Close idle connection %s', conn.local_address)
+            self.close_socket_proxy(conn)
+            return
 
-        for key, val in iteritems(root_dict):
-            if val is None:
-                continue
+        interval = self.ConnectionKeepaliveInterval
+        if (interval is not None and not conn.is_connecting and
+                now >= conn.last_send_time + interval):
+            log.debug('Send keepalive on %s', conn.local_address)
+            try:
+                conn.send_keepalive(self.ConnectionKeepaliveData)
+            except socket_error as exc:
+                log.warning(
+                    'Exception sending keepalive on %s: %s',
+                    conn.local_address, exc)
 
-            path_so_far.append((key, val))
-            if isinstance(val, dict):
-                for path in cls.yield_vals(val, path_so_far):
-                    yield path
-                continue
-            else:
-                yield tuple(path_so_far)
-            path_so_far.pop()
+        self._tp_schedule_pooled_connection_check(conn)
 
     def fix_sock_family(self, sock_family):
         if sock_family not in (None,) + tuple(SOCK_FAMILIES):
@@ -29,8 +29,10 @@ Then the following in your UT setUp method::
     See the License for the specific language governing permissions and
     limitations under the License.
 """
+from errno import EAGAIN
 import logging
 from six import PY2
+from socket import error as socket_error
 from .base import AF_INET, SOCK_STREAM
 if PY2:
     from mock import Mock
@@ -58,9 +60,10 @@ class SocketMock(object):
         self.type = type
 
         for attr in (
-            'bind', 'listen', 'accept', 'send',
+            'bind', 'listen', 'accept',
         ):
             setattr(self, attr, Mock())
+        self.send = Mock(side_effect=lambda data, *args: len(data))
 
         self.peer_name = getattr(test_case, 'peer_name', None)
         self.sockname = getattr(test_case, 'sockname', None)
@@ -69,6 +72,7 @@ class SocketMock(object):
         SocketMock._fileno += 1
 
         self.read_exception = None
+        self.timeout = None
 
     def connect(self, addr_tuple):
         self.peer_name = addr_tuple
@@ -76,9 +80,22 @@ class SocketMock(object):
             self.sockname = ('pretend-local-sockname', 12345)
         return
 
+    def connect_ex(self, addr_tuple):
+        self.connect(addr_tuple)
+        return 0
+
+    def getsockopt(self, level, optname):
+        return 0
+
     def close(self):
         pass
 
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
     def fileno(self):
         return self._fileno
 
@@ -92,10 +109,18 @@ class SocketMock(object):
         log.debug('sock mock recv numbytes %d', numbytes)
         if self.read_exception is not None:
             raise self.read_exception
+        if self.timeout == 0.0 and not hasattr(self, 'data'):
+            raise socket_error(EAGAIN, 'Resource temporarily unavailable')
         data = self.data
         del self.data
         return data
 
+    def recvfrom_into(self, buf, numbytes):
+        data, addr = self.recvfrom(numbytes)
+        data = data[:numbytes]
+        buf[:len(data)] = data
+        return len(data), addr
+
     def recvfrom(self, numbytes):
         log.debug('sock mock recvfrom numbytes %d', numbytes)
         return self.recv(numbytes), self.getpeername()
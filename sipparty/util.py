@@ -24,11 +24,13 @@ import logging
 import os
 from six import (
     add_metaclass, binary_type as bytes, iteritems, itervalues, PY2)
-from threading import currentThread
+from six.moves.queue import Full, Queue
+from threading import currentThread, Event, RLock, Thread
 import time
 import timeit
 from traceback import extract_stack
 from weakref import (ref as weakref, WeakValueDictionary)
+from zlib import crc32
 
 from .classmaker import classmaker
 
@@ -180,6 +182,12 @@ class Enum(set):
     def __or__(self, other):
         return Enum(set(self) | set(other))
 
+    def __copy__(self):
+        # The default copy would share the list with this one.
+        return type(self)(
+            self._en_list, normalize=self._en_normalize,
+            aliases=self._en_aliases)
+
     def __contains__(self, name):
         """Look up an Enum value using subscript access.
 
@@ -1187,3 +1195,203 @@ class FallbackProperty(object):
 
             raise TypeError(
                 'Bad object %r used for fallback attribute' % fallback)
+
+
+def _ShardedWorkerPoolRun(work_queue, stats, stopping):
+    while not stopping.is_set():
+        item = work_queue.get()
+        if item is None:
+            return
+        func, args = item
+        try:
+            func(*args)
+        except Exception:
+            log.exception('Exception running %r in sharded worker', func)
+        stats['processed'] += 1
+
+
+class ShardedWorkerPool(object):
+    """Runs work on a fixed number of threads, each with its own bounded
+    queue, where work with the same shard key always runs on the same
+    thread, and so in the order it was submitted.
+    """
+
+    def __init__(self, worker_count, max_queue_size=1000, name='worker'):
+        super(ShardedWorkerPool, self).__init__()
+        if worker_count < 1:
+            raise ValueError(
+                'ShardedWorkerPool needs at least one worker, not %d' % (
+                    worker_count,))
+        self.name = name
+        self.max_queue_size = max_queue_size
+        self._swp_queues = [
+            Queue(max_queue_size) for _ in range(worker_count)]
+        self._swp_stats = [
+            {'submitted': 0, 'processed': 0, 'dropped': 0, 'max_depth': 0}
+            for _ in range(worker_count)]
+        self._swp_stopping = Event()
+        self._swp_threads = []
+        for index, (work_queue, stats) in enumerate(
+                zip(self._swp_queues, self._swp_stats)):
+            thr = Thread(
+                name='%s %d' % (name, index), target=_ShardedWorkerPoolRun,
+                args=(work_queue, stats, self._swp_stopping))
+            thr.daemon = True
+            thr.start()
+            self._swp_threads.append(thr)
+
+    @property
+    def worker_count(self):
+        return len(self._swp_queues)
+
+    @property
+    def queue_depths(self):
+        return [work_queue.qsize() for work_queue in self._swp_queues]
+
+    @property
+    def stats(self):
+        """A list of dictionaries for each worker, with the number of items
+        submitted, processed and dropped because the queue was full, and
+        the deepest the queue has been.
+        """
+        return [dict(stats) for stats in self._swp_stats]
+
+    def shard_index(self, shard_key):
+        if shard_key is None:
+            return 0
+        return (crc32(abytes(shard_key)) & 0xffffffff) % len(self._swp_queues)
+
+    def submit(self, shard_key, func, args=(), block=False):
+        """Run `func(*args)` on the worker for `shard_key`.
+
+        :param block:
+            Whether to wait if the worker's queue is full. If not, the work
+            is dropped.
+        :returns: `False` if the work was dropped.
+        """
+        index = self.shard_index(shard_key)
+        work_queue = self._swp_queues[index]
+        stats = self._swp_stats[index]
+        try:
+            work_queue.put((func, args), block)
+        except Full:
+            log.warning(
+                '%s %d queue full, drop %r', self.name, index, func)
+            stats['dropped'] += 1
+            return False
+
+        stats['submitted'] += 1
+        depth = work_queue.qsize()
+        if depth > stats['max_depth']:
+            stats['max_depth'] = depth
+        return True
+
+    def stop(self, wait=True):
+        """Stop the workers once they have finished the work already
+        submitted.
+
+        :param wait:
+            Whether to wait for the workers to finish. If not, this never
+            blocks, so is safe to call from a finalizer, and the workers
+            stop after the work they are doing, dropping any that is queued.
+        """
+        if not wait:
+            self._swp_stopping.set()
+            for work_queue in self._swp_queues:
+                try:
+                    # Wakes the worker if it is waiting for work.
+                    work_queue.put_nowait(None)
+                except Full:
+                    pass
+            return
+
+        for work_queue in self._swp_queues:
+            work_queue.put(None)
+        for thr in self._swp_threads:
+            if thr is not currentThread():
+                thr.join()
+
+
+class StripedDict(object):
+    """A dictionary split by key hash into stripes, each with its own lock,
+    so that threads changing different keys rarely contend.
+
+    Lookups do not lock, as a single dictionary operation is atomic anyway.
+    Changes lock only the stripe for the key, and `lock_for` gives access to
+    that lock for compound operations such as get-or-create. Iteration is
+    over a snapshot, so the dictionary may change while it is iterated.
+    """
+
+    def __init__(self, stripe_count=16):
+        super(StripedDict, self).__init__()
+        if stripe_count < 1:
+            raise ValueError(
+                'StripedDict needs at least one stripe, not %d' % (
+                    stripe_count,))
+        self._sd_stripes = [{} for _ in range(stripe_count)]
+        self._sd_locks = [RLock() for _ in range(stripe_count)]
+
+    @property
+    def stripe_count(self):
+        return len(self._sd_stripes)
+
+    def lock_for(self, key):
+        """:returns: The (reentrant) lock for the stripe containing `key`.
+        """
+        return self._sd_locks[hash(key) % len(self._sd_locks)]
+
+    def get(self, key, default=None):
+        return self._sd_stripe_for(key).get(key, default)
+
+    def setdefault(self, key, default=None):
+        with self.lock_for(key):
+            return self._sd_stripe_for(key).setdefault(key, default)
+
+    def pop(self, key, *default):
+        with self.lock_for(key):
+            return self._sd_stripe_for(key).pop(key, *default)
+
+    def snapshot(self):
+        """:returns: A list of the (key, value) pairs, each stripe copied
+        while holding its lock.
+        """
+        items = []
+        for stripe, lock in zip(self._sd_stripes, self._sd_locks):
+            with lock:
+                items.extend(stripe.items())
+        return items
+
+    def items(self):
+        return self.snapshot()
+
+    def keys(self):
+        return [key for key, _ in self.snapshot()]
+
+    def values(self):
+        return [value for _, value in self.snapshot()]
+
+    def __getitem__(self, key):
+        return self._sd_stripe_for(key)[key]
+
+    def __setitem__(self, key, value):
+        with self.lock_for(key):
+            self._sd_stripe_for(key)[key] = value
+
+    def __delitem__(self, key):
+        with self.lock_for(key):
+            del self._sd_stripe_for(key)[key]
+
+    def __contains__(self, key):
+        return key in self._sd_stripe_for(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self._sd_stripes)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.snapshot()))
+
+    def _sd_stripe_for(self, key):
+        return self._sd_stripes[hash(key) % len(self._sd_stripes)]